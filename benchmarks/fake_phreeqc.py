@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Stand-in for the phreeqc binary used by the benchmarks.
+
+Takes the arguments of phreeqc (input file, output file, database) and
+writes a synthetic selected-output file, so the timings measure ml4scm and
+not the chemistry. The size of the output is set through the environment:
+
+ML4SCM_BENCH_STEPS: react steps written per simulation (default 6)
+ML4SCM_BENCH_COLS:  extra columns written besides sim, state, pH and U (default 0)
+
+Every simulation's U column is sum(numbers in the database) * step * 1e-6,
+so different parameter values give different concentrations.
+"""
+import os
+import re
+import sys
+from typing import IO, List
+
+NUMBER = re.compile(r'(?<![\w.])-?\d+\.?\d*(?:[eE][-+]?\d+)?')
+
+
+def write_sel(f: IO, totals: List[float], steps: int = 6, extra_cols: int = 0) -> None:
+    """
+    Write a selected-output table with one i_soln row and steps react rows
+    for every simulation total.
+    """
+    extra = ''.join('\t{:>12s}'.format('x{}'.format(i)) for i in range(extra_cols))
+    f.write('{:>12s}\t{:>10s}\t{:>12s}\t{:>12s}{}\t\n'.format('sim', 'state', 'pH', 'U', extra))
+    filler = '\t{:12.4e}'.format(1.0) * extra_cols
+    for sim, total in enumerate(totals, start=1):
+        f.write('{:12d}\t{:>10s}\t{:12.4f}\t{:12.4e}{}\t\n'.format(sim, 'i_soln', 7.0, 0.0, filler))
+        for step in range(1, steps + 1):
+            f.write('{:12d}\t{:>10s}\t{:12.4f}\t{:12.4e}{}\t\n'.format(
+                sim, 'react', 7.0 + step / steps, total * step * 1e-6, filler))
+
+
+def main(argv: List[str]) -> None:
+    in_file, out_file, db_file = argv[1:4]
+    with open(db_file) as fd:
+        db_total = sum(float(x) for x in NUMBER.findall(fd.read()))
+
+    sel_file = 'selected.out'
+    num_sims = 0
+    with open(in_file) as fd:
+        for line in fd:
+            m = re.match(r'\s*-file\s+(.*?)\s*$', line)
+            if m:
+                sel_file = m.group(1)
+            elif line.strip().upper() == 'END':
+                num_sims += 1
+
+    with open(sel_file, 'w') as fd:
+        write_sel(fd, [db_total] * max(num_sims, 1),
+                  steps=int(os.environ.get('ML4SCM_BENCH_STEPS', '6')),
+                  extra_cols=int(os.environ.get('ML4SCM_BENCH_COLS', '0')))
+    with open(out_file, 'w') as fd:
+        fd.write('fake phreeqc listing\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Benchmarks of ml4scm's own overhead, apart from PHREEQC's chemistry time.
+
+PHREEQC is replaced by fake_phreeqc.py, which writes synthetic selected
+output, and the post-processing stages are fed precomputed results, so every
+stage times ml4scm alone:
+
+render:            PHREEQC.write_db_from_template, one database per row
+render_template:   DatabaseTemplate.write with the template compiled once
+spawn:             PHREEQC.run_phreeqc, one stub process per row (capped by --max-spawn)
+parse:             PHREEQC.read_output of a .sel file holding every row
+grid_search:       grid_search post-processing of every row
+bayes_resample:    bayes_resample over --trials generations of size rows
+bayes_param_count: bayes_param_count of the bayes_resample particles
+
+Results are written as JSON; pass a previous file to --compare to print the
+ratio of every timing against it.
+
+    PYTHONPATH=src python benchmarks/run_benchmarks.py --sizes 10 100 1000 -o bench.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import ml4scm
+from ml4scm.bayes import bayes_param_count, bayes_resample
+from ml4scm.grid_search import grid_search
+from ml4scm.phreeqc import PHREEQC, DatabaseTemplate
+from ml4scm.simulation import Bound, Problem, SimulationRunner
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_phreeqc import write_sel  # noqa: E402
+
+PARS = ['PAR_A', 'PAR_B']
+
+
+class ReplayRunner(SimulationRunner):
+    """
+    SimulationRunner that answers every row with a synthetic result instead
+    of running phreeqc, so that only the post-processing is timed.
+    """
+    def __init__(self, steps: int) -> None:
+        super().__init__(PHREEQC(path=sys.executable))
+        self.steps = steps
+
+    def iter_sims(self, values_mtrx: np.ndarray, pars: List[str], input_filename: str, output_filename: str,
+                  db_template_filename: str, analytes: Optional[List[str]] = None,
+                  template: Optional[DatabaseTemplate] = None,
+                  input_template: Any = None) -> Iterator[Tuple[int, np.ndarray]]:
+        steps = np.arange(1, self.steps + 1)
+        for i, row in enumerate(np.asarray(values_mtrx)):
+            yield i, np.vstack([np.ones(self.steps), np.sum(row) * steps * 1e-6])
+
+
+def _fake_phreeqc(bin_dir: str) -> str:
+    # the stub with this interpreter in its #! line
+    path = os.path.join(bin_dir, 'phreeqc')
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_phreeqc.py')) as fd:
+        source = fd.read().split('\n', 1)[1]
+    with open(path, 'w') as fd:
+        fd.write('#!{}\n{}'.format(sys.executable, source))
+    os.chmod(path, 0o755)
+    return path
+
+
+def _files(directory: str) -> Problem:
+    with open(os.path.join(directory, 'db.tpl'), 'w') as fd:
+        fd.write('# benchmark database template\nSOLUTION_MASTER_SPECIES\nlog_k PAR_A\ndelta_h PAR_B\n')
+    with open(os.path.join(directory, 'input.pqi'), 'w') as fd:
+        fd.write('SELECTED_OUTPUT\n    -file output.sel\nEND\n')
+    return Problem(names=PARS, bounds=[Bound(1, 2), Bound(3, 4)], num_vars=len(PARS),
+                   db_template_filename=os.path.join(directory, 'db'),
+                   input_filename=os.path.join(directory, 'input.pqi'),
+                   output_filename='output.sel')
+
+
+@contextlib.contextmanager
+def _environ(name: str, value: str) -> Iterator[None]:
+    # sets an environment variable for the stub processes, restoring it after
+    saved = os.environ.get(name)
+    os.environ[name] = value
+    try:
+        yield
+    finally:
+        if saved is None:
+            del os.environ[name]
+        else:
+            os.environ[name] = saved
+
+
+def _time(f: Callable[[], Any], repeat: int) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(sizes: List[int], repeat: int = 3, steps: int = 6, trials: int = 10,
+                   max_spawn: int = 100, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Time every stage for every ensemble size.
+
+    return: one record per stage and size with the number of items timed and
+            the min / median seconds over repeat runs
+    """
+    records = []
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory(prefix='ml4scm-bench-') as directory, \
+            _environ('ML4SCM_BENCH_STEPS', str(steps)):
+        problem = _files(directory)
+        phreeqc = PHREEQC(_fake_phreeqc(directory))
+        template = problem.db_template()
+        db_out = os.path.join(directory, 'rendered')
+        runner = ReplayRunner(steps)
+        exp_U = list(3.0 * np.arange(1, steps + 1))
+
+        def record(stage: str, size: int, items: int, f: Callable[[], Any]) -> None:
+            times = _time(f, repeat)
+            records.append({'stage': stage, 'size': size, 'items': items,
+                            'min': min(times), 'median': statistics.median(times)})
+
+        for size in sizes:
+            params = rng.uniform([1, 3], [2, 4], size=(size, len(PARS)))
+
+            def render() -> None:
+                for row in params:
+                    PHREEQC.write_db_from_template(problem.db_template_filename, PARS,
+                                                   [str(v) for v in row], outfile=db_out)
+            record('render', size, size, render)
+
+            def render_template() -> None:
+                for row in params:
+                    template.write(row, outfile=db_out)
+            record('render_template', size, size, render_template)
+
+            spawns = min(size, max_spawn)
+            template.write(params[0], outfile=db_out)
+
+            def spawn() -> None:
+                for _ in range(spawns):
+                    phreeqc.run_phreeqc(problem.input_filename, os.path.join(directory, 'output.out'),
+                                        db_out + '.txt', cwd=directory)
+            record('spawn', size, spawns, spawn)
+
+            sel = os.path.join(directory, 'bench.sel')
+            with open(sel, 'w') as fd:
+                write_sel(fd, list(np.sum(params, axis=1)), steps=steps)
+            record('parse', size, size, lambda: PHREEQC.read_output(sel, ['U']))
+
+            record('grid_search', size, size, lambda: grid_search(runner, problem, params))
+
+            result: Dict[str, Any] = {}
+
+            def resample() -> None:
+                result.update(bayes_resample(runner, problem, exp_U, trials, size, rng=seed))
+            record('bayes_resample', size, size * trials, resample)
+            record('bayes_param_count', size, size * trials, lambda: bayes_param_count(result['pp']))
+    return records
+
+
+def _metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'ml4scm': ml4scm.__version__, 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'time': time.time()}
+
+
+def compare(records: List[Dict[str, Any]], baseline: List[Dict[str, Any]]) -> List[str]:
+    """
+    Lines of 'stage size min baseline-min ratio' for records also in baseline.
+    """
+    old = {(r['stage'], r['size']): r for r in baseline}
+    lines = []
+    for r in records:
+        b = old.get((r['stage'], r['size']))
+        if b is not None and b['min'] > 0:
+            lines.append('{:18s} {:>8d} {:10.4f}s {:10.4f}s {:6.2f}x'.format(
+                r['stage'], r['size'], r['min'], b['min'], r['min'] / b['min']))
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='ensemble sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage; the minimum is kept')
+    parser.add_argument('--steps', type=int, default=6, help='react steps per simulation')
+    parser.add_argument('--trials', type=int, default=10, help='bayes_resample generations')
+    parser.add_argument('--max-spawn', type=int, default=100, help='maximum stub processes per size')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='JSON file to write')
+    parser.add_argument('--compare', help='previous JSON results to compare against')
+    args = parser.parse_args(argv)
+
+    records = run_benchmarks(args.sizes, repeat=args.repeat, steps=args.steps, trials=args.trials,
+                             max_spawn=args.max_spawn)
+    with open(args.output, 'w') as fd:
+        json.dump({'meta': _metadata(), 'args': vars(args), 'results': records}, fd, indent=2)
+
+    for r in records:
+        print('{:18s} {:>8d} {:10.4f}s {:12.3e}s/item'.format(r['stage'], r['size'], r['min'],
+                                                             r['min'] / max(r['items'], 1)))
+    if args.compare:
+        with open(args.compare) as fd:
+            print('\n'.join(['', 'against {}'.format(args.compare)] + compare(records, json.load(fd)['results'])))
+
+
+if __name__ == '__main__':
+    main()
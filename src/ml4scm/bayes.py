@@ -1,99 +1,170 @@
 import numpy as np
-from typing import Callable, List, cast, Tuple
+from typing import Callable, Dict, List, Optional, cast, Tuple
 from .simulation import SimulationRunner, Problem
 from .grid_search import gs_resample
-from .estimators import log_likelihood
+from .estimators import log_likelihoods, normalize_log_weights, Sigma
+from . import resampling, sampling
 
 
-def _get_norm_weights(concentrations, conc_measured):
-    weights = [log_likelihood(concentrations[0], conc_measured)]
-    for run in concentrations[1:]:
-        weights.append(log_likelihood(run, conc_measured))
+def _get_norm_weights(concentrations, conc_measured, sigma=None):
+    # normalized weights of every run, computed in log space
+    return normalize_log_weights(log_likelihoods(concentrations, conc_measured, sigma))
 
-    norm_weights = np.array(weights) / np.sum(weights)
-    return norm_weights
 
-
-def _bayes_1params(lower, upper, pool_size=100):
-    # helper function for returning 1 set of params
-    params = []
-    for i in range(len(lower)):
-        sample = np.linspace(lower[i], upper[i], num=pool_size)
-        params.append(np.random.choice(sample, p=None))
-    return params
-
-
-def _bayes_init_params(num_sets, lower, upper, pool_size=100):
-    # generates 1 set of parameters to be used in run_bayes()
-    # num_sets: number of parameter sets to generate
-    # lower, upper: list of parameter bounds
-    # pool_size: number of linspace samples to sample from when picking each parameter
-    # return: num_sets sets of params as a matrix
-
-    plist = _bayes_1params(lower, upper, pool_size)
-    while num_sets > 1:
-        plist = np.vstack((plist, _bayes_1params(lower, upper, pool_size)))
-        num_sets -= 1
-    return plist
-
-
-def _bayes_eval(sim: SimulationRunner, problem: Problem, params: np.ndarray, exp_U: List[float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+def _bayes_eval(sim: SimulationRunner, problem: Problem, params: np.ndarray, exp_U: List[float],
+                sigma: Sigma = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     # evaluates parameters and returns concentrations, new weights, and parameters given
 
-    # run phreeqc for matrix of U concentrations
-    run = sim.run_problem(problem=problem, values=params, analytes=['U'])
-    concs = np.array(run)[:, 1::2].reshape((np.shape(params)[0], 6))
+    # run phreeqc for matrix of U concentrations, one row per parameter set;
+    # failed runs are nan rows, which get weight 0 and are never resampled
+    concs = sim.run_results(problem=problem, values=params, analytes=['U'])['U']
 
     # get matrix of new weights
-    new_weights = _get_norm_weights(concs, exp_U)
+    new_weights = _get_norm_weights(concs, exp_U, sigma)
 
     return concs, new_weights, params
 
 
+def _generation_stats(weights: np.ndarray, params: np.ndarray) -> Tuple[float, np.ndarray, np.ndarray]:
+    # effective sample size and weighted posterior mean and std of a generation
+    mean = weights @ params
+    std = np.sqrt(weights @ np.square(params - mean))
+    return 1.0 / float(np.sum(np.square(weights))), mean, std
+
+
 def bayes_resample(
         sim: SimulationRunner,
         problem: Problem,
         exp_U: List[float],
         num_trials: int,
         num_sets: int,
-        pool_size: int=100):
+        pool_size: int=100,
+        sampler: str='grid',
+        rng: sampling.Seed=None,
+        sigma: Sigma=None,
+        scheme: str='multinomial',
+        ess_threshold: Optional[float]=None,
+        tol: Optional[float]=None):
     # samples num_trials times and stacks results
-    # remaining input parameters are inputs for bayes_init_params()
-    # return: matrix for concs, params, new_weights
-    lower = [x.lower for x in problem.bounds]
-    upper = [x.upper for x in problem.bounds]
-    cc, nw, pp = _bayes_eval(sim, problem, _bayes_init_params(num_sets, lower, upper, pool_size), exp_U)
-    cc = np.array([cc])
-    nw = np.array([nw])
-    pp = np.array([pp])
-    while num_trials > 1:
-        # resample parameters with new weights and stack into master list
-        re_pp = [pp[-1][np.random.choice(np.arange(len(pp[-1])), p=nw[-1])] for i in range(len(pp[-1]))]
-        #         print(pp, re_pp)
-        pp = np.vstack((pp, [re_pp]))
-
-        # evaluate and stack other values
-        re_cc, re_nw, _ = _bayes_eval(sim, problem, pp[-1], exp_U)
-        cc = np.vstack((cc, [re_cc]))
-        nw = np.vstack((nw, [re_nw]))
-        num_trials -= 1
-    return {'cc': cc, 'nw': nw, 'pp': pp}
+    # sampler: method drawing the initial particles, see sampling.SAMPLERS;
+    #          'grid' picks from pool_size evenly spaced values per parameter
+    # rng: seed or numpy Generator for the initial particles and resampling
+    # sigma: noise model for the likelihood, see estimators.log_likelihoods
+    # scheme: resampling scheme, see resampling.RESAMPLERS
+    # ess_threshold: resample only while the effective sample size of the
+    #          weights is below ess_threshold * num_sets; once it is not, the
+    #          weights are balanced, another generation cannot change them
+    #          and the run stops
+    # tol: stop once the weighted posterior mean and std of every parameter
+    #          move less than tol times its bounds width between two
+    #          generations, or the particles have collapsed onto one point
+    # return: matrix for concs, params, new_weights, the generations actually
+    #          run; 'diagnostics' holds per generation arrays of 'ess',
+    #          'mean', 'std', 'drift' and 'unique' particles, and 'stopped'
+    #          why the run ended ('num_trials', 'ess', 'tol' or 'collapsed')
+    if ess_threshold is not None and not 0 < ess_threshold <= 1:
+        raise ValueError('ess_threshold must be a fraction of num_sets in (0, 1]')
+    rng = sampling.make_rng(rng)
+    if sampler == 'grid':
+        init = sampling.grid(problem.bounds, num_sets, rng=rng, pool_size=pool_size)
+    else:
+        init = sampling.sample(problem.bounds, num_sets, method=sampler, rng=rng)
+    c0, w0, p0 = _bayes_eval(sim, problem, init, exp_U, sigma)
+
+    # histories are preallocated once instead of re-stacked every generation
+    num_trials = max(num_trials, 1)
+    cc = np.empty((num_trials,) + np.shape(c0))
+    nw = np.empty((num_trials,) + np.shape(w0))
+    pp = np.empty((num_trials,) + np.shape(p0))
+    cc[0], nw[0], pp[0] = c0, w0, p0
+
+    width = np.array([b.upper - b.lower for b in problem.bounds], dtype=float)
+    width[width <= 0] = 1.0
+    diagnostics: Dict[str, np.ndarray] = {
+        'ess': np.empty(num_trials),
+        'mean': np.empty((num_trials, np.shape(p0)[1])),
+        'std': np.empty((num_trials, np.shape(p0)[1])),
+        'drift': np.full(num_trials, np.nan),
+        'unique': np.empty(num_trials, dtype=int),
+    }
+
+    def record(t: int) -> None:
+        ess, mean, std = _generation_stats(nw[t], pp[t])
+        diagnostics['ess'][t], diagnostics['mean'][t], diagnostics['std'][t] = ess, mean, std
+        diagnostics['unique'][t] = len(np.unique(pp[t], axis=0))
+        if t > 0:
+            moved = np.abs(np.concatenate([mean - diagnostics['mean'][t - 1], std - diagnostics['std'][t - 1]]))
+            diagnostics['drift'][t] = np.max(moved / np.tile(width, 2))
+
+    record(0)
+    stopped, end = 'num_trials', num_trials
+    for t in range(1, num_trials):
+        if ess_threshold is not None and diagnostics['ess'][t - 1] >= ess_threshold * len(pp[t - 1]):
+            stopped, end = 'ess', t
+            break
+
+        # resample parameters with new weights, a whole generation at once
+        draw = resampling.resample(nw[t - 1], len(pp[t - 1]), scheme, rng)
+        pp[t] = pp[t - 1][draw]
+
+        # every particle is a copy of an evaluated one, so the simulations
+        # are reused rather than run again
+        cc[t] = cc[t - 1][draw]
+        nw[t] = _get_norm_weights(cc[t], exp_U, sigma)
+        record(t)
+
+        if tol is not None and diagnostics['unique'][t] == 1:
+            stopped, end = 'collapsed', t + 1
+            break
+        if tol is not None and diagnostics['drift'][t] < tol:
+            stopped, end = 'tol', t + 1
+            break
+    return {'cc': cc[:end], 'nw': nw[:end], 'pp': pp[:end],
+            'diagnostics': {k: v[:end] for k, v in diagnostics.items()}, 'stopped': stopped}
+
+
+def _original_indices(pp_mtrx, original_params):
+    # maps every particle of every generation to the index of the first
+    # matching row of original_params (what list.index used to return)
+    # pp_mtrx: (generations, particles) or (generations, particles, params)
+    # original_params: (rows,) or (rows, params)
+    # return: (generations, particles) array of indices into original_params
+    original = np.asarray(original_params)
+    pp = np.asarray(pp_mtrx)
+    num_params = 1 if original.ndim == 1 else original.shape[1]
+    original = original.reshape(len(original), num_params)
+    if len(pp) == 0:
+        return np.zeros((0, 0), dtype=int)
+
+    # index rows by value once: np.unique gives every distinct row an id,
+    # and the ids of the original rows point back to their positions
+    combined = np.concatenate([original, pp.reshape(-1, num_params)])
+    _, inverse = np.unique(combined, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    lookup = np.full(inverse.max() + 1, -1)
+    # assigned back to front so the first of any duplicate originals wins
+    lookup[inverse[:len(original)][::-1]] = np.arange(len(original))[::-1]
+    idx = lookup[inverse[len(original):]]
+    if np.any(idx < 0):
+        raise ValueError('particle not found in the original parameters')
+    return idx.reshape(len(pp), -1)
+
+
+def param_counts_by_generation(pp_mtrx, original_params):
+    # returns a (generations, len(original_params)) matrix with the number of
+    # times each original parameter set occurs in every generation
+    idx = _original_indices(pp_mtrx, original_params)
+    n = len(original_params)
+    offsets = np.arange(len(idx))[:, None] * n
+    return np.bincount((idx + offsets).ravel(), minlength=len(idx) * n).reshape(len(idx), n)
 
 
 def bayes_param_count(pp_mtrx):
     # returns list of summed counts of each original parameter
 
     params_count = np.ones(len(pp_mtrx[0]))
-    # summing while accounting for the shape of input
-    if len(np.shape(pp_mtrx)) > 2:
-        for i in range(1, len(pp_mtrx)):
-            for p in pp_mtrx[i]:
-                params_count[pp_mtrx[0].tolist().index(list(p))] += 1
-    else:
-        for i in range(1, len(pp_mtrx)):
-            for p in pp_mtrx[i]:
-                params_count[pp_mtrx[0].tolist().index(p)] += 1
-    return params_count
+    counts = param_counts_by_generation(pp_mtrx[1:], pp_mtrx[0])
+    return params_count + np.sum(counts, axis=0)
 
 
 def bayes_param_count_by_original(pp_mtrx, original_params):
@@ -101,40 +172,32 @@ def bayes_param_count_by_original(pp_mtrx, original_params):
     # returns list of summed counts of each original parameter
 
     params_count = np.zeros(len(original_params))
-    # summing while accounting for the shape of input
-    if len(np.shape(pp_mtrx)) > 2:
-        for i in range(len(pp_mtrx)):
-            for p in pp_mtrx[i]:
-                params_count[original_params.tolist().index(list(p))] += 1
-    else:
-        for i in range(len(pp_mtrx)):
-            for p in pp_mtrx[i]:
-                params_count[original_params.tolist().index(p)] += 1
-    return params_count
+    counts = param_counts_by_generation(pp_mtrx, original_params)
+    return params_count + np.sum(counts, axis=0)
 
 
 def best_params_by_num_samples(resamp_gs, step_size, xx, yy):
     steps = range(step_size, len(resamp_gs[0])+1, step_size)
-    prev_s = 0
-    gspc = np.zeros(len(resamp_gs[0]))
+    # counts of all generations at once; each step adds the next slice
+    counts = param_counts_by_generation(resamp_gs, resamp_gs[0])
     samples_dict = dict()
     for s in steps:
-        gspc = gspc + bayes_param_count_by_original(resamp_gs[prev_s:s], resamp_gs[0])
+        gspc = np.sum(counts[:s], axis=0).astype(float)
         yy_maxvals = np.amax(gspc.reshape(50,50), 0)
         xx_max_idx = np.argmax(yy_maxvals)
         xx_maxvals = np.amax(gspc.reshape(50,50), 1)
         yy_max_idx = np.argmax(xx_maxvals)
-        prev_s = s
         samples_dict[s] = (xx[0,:][xx_max_idx], yy[:,0][yy_max_idx])
     return samples_dict
 
 
-def consecutive_resample(max_samples, step_size, gsll, xx, yy):
+def consecutive_resample(max_samples, step_size, gsll, xx, yy, log=False):
+    # log: gsll holds log likelihoods, see gs_resample
     steps = range(step_size, max_samples + 1, step_size)
     samples_dict = dict()
 
     for s in steps:
-        gspc = bayes_param_count(gs_resample(s, gsll))
+        gspc = bayes_param_count(gs_resample(s, gsll, log=log))
         yy_maxvals = np.amax(gspc.reshape(50,50), 0)
         xx_max_idx = np.argmax(yy_maxvals)
         xx_maxvals = np.amax(gspc.reshape(50,50), 1)
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import os.path
+import tempfile
+from typing import List, Optional, Tuple, cast
+
+import numpy as np
+
+
+class RunCache:
+    """
+    Content-addressed on-disk cache of parsed phreeqc output.
+
+    Entries are .npy files named by a hash of everything that determines the
+    result of a run: the rendered database, the input file, the requested
+    analytes and the phreeqc binary. The total size is bounded by evicting
+    the least recently used entries.
+    """
+    def __init__(self, directory: str, max_bytes: int = 1 << 30) -> None:
+        """
+        directory: cache location; created if missing
+        max_bytes: upper bound on the total size of cached arrays
+        """
+        if max_bytes <= 0:
+            raise ValueError('max_bytes must be positive')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+        return
+
+    @staticmethod
+    def make_key(db_digest: str, input_digest: str, analytes: List[str], binary: str) -> str:
+        """
+        Combine the identity of a run into a cache key.
+
+        db_digest:    digest of the rendered database, see DatabaseTemplate.digest
+        input_digest: digest of the input file contents
+        analytes:     analytes read from the selected output
+        binary:       identity of the phreeqc binary, see PHREEQC.identity
+        """
+        h = hashlib.sha256()
+        for part in [db_digest, input_digest, '\t'.join(analytes), binary]:
+            h.update(part.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        # (last use, path, size) of every cached array
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.npy'):
+                    st = os.stat(os.path.join(root, name))
+                    entries.append((st.st_mtime, os.path.join(root, name), st.st_size))
+        return entries
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Return the cached output for key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            output = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # the modification time doubles as the LRU timestamp
+        os.utime(path)
+        return cast(np.ndarray, output)
+
+    def put(self, key: str, output: np.ndarray) -> None:
+        """
+        Store output under key and evict old entries if over max_bytes.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see partial arrays
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, output)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp, path)
+        self._size += os.path.getsize(path) - old_size
+        if self._size > self.max_bytes:
+            self._evict()
+        return
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+        return
+
+    def clear(self) -> None:
+        """
+        Remove every cached entry.
+        """
+        for _, path, _ in self._entries():
+            os.remove(path)
+        self._size = 0
+        return
@@ -0,0 +1,227 @@
+"""
+Command-line batch interface, e.g. for scheduler array jobs.
+
+    ml4scm sample problem.json -n 10000 --method sobol --seed 1 -o params.npy
+    ml4scm run problem.json --params params.npy --shard $SLURM_ARRAY_TASK_ID/100 -o shards/
+    ml4scm merge shards/*.npz -o ensemble.npz
+
+run simulates the rows of one shard (a contiguous slice of the parameter
+matrix) and writes them to a compact .npz file; merge checks that the shard
+files cover every row exactly once and combines them into one file holding
+params, results ((n_runs, n_steps, n_analytes), the layout of
+SimulationRunner.run_problem_matrix) and analytes.
+
+The problem file is JSON, or YAML if PyYAML is installed, holding the fields
+of Problem; bounds are [lower, upper] pairs and relative file names are
+relative to the problem file.
+"""
+import argparse
+import json
+import os
+import os.path
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Sequence, Tuple, cast
+
+import numpy as np
+
+from . import sampling
+from .cache import RunCache
+from .phreeqc import PHREEQC, SubprocessEngine
+from .simulation import Bound, Problem, SimulationRunner, ram_scratch_dir
+
+_PATH_FIELDS = ('db_template_filename', 'input_filename', 'input_template_filename')
+
+# characters of phreeqc's stdout / stderr kept per run with --minimal-io
+_MINIMAL_IO_OUTPUT = 4096
+
+
+def load_problem(filename: str) -> Problem:
+    """
+    Read a Problem from a JSON or YAML file.
+    """
+    with open(filename, 'r') as fd:
+        if os.path.splitext(filename)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError('reading {} requires PyYAML'.format(filename))
+            spec = yaml.safe_load(fd)
+        else:
+            spec = json.load(fd)
+
+    spec = dict(spec)
+    spec['bounds'] = [Bound(**b) if isinstance(b, dict) else Bound(*b) for b in spec['bounds']]
+    spec.setdefault('num_vars', len(spec['names']))
+    base = os.path.dirname(os.path.abspath(filename))
+    for key in _PATH_FIELDS:
+        if spec.get(key) is not None:
+            spec[key] = os.path.join(base, spec[key])
+    return Problem(**spec)
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """
+    Parse 'i/n', shard i (counting from 0) of n.
+    """
+    try:
+        index, count = (int(x) for x in text.split('/'))
+    except ValueError:
+        raise ValueError('shard must be given as i/n, not {!r}'.format(text))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('shard {} is not in 0..{}'.format(index, count - 1))
+    return index, count
+
+
+def shard_rows(num_rows: int, index: int, count: int) -> np.ndarray:
+    """
+    Row indices of shard index of count: contiguous slices whose sizes
+    differ by at most one.
+    """
+    return np.array_split(np.arange(num_rows), count)[index]
+
+
+def _save(filename: str, **arrays: Any) -> None:
+    # a shard file only exists once it is complete
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, filename)
+
+
+def merge_shards(filenames: Sequence[str]) -> Dict[str, np.ndarray]:
+    """
+    Combine shard files written by 'ml4scm run' into params, results and
+    analytes of the whole ensemble.
+    """
+    if not filenames:
+        raise ValueError('no shard files to merge')
+    params: Optional[np.ndarray] = None
+    results: Optional[np.ndarray] = None
+    analytes: Optional[List[str]] = None
+    covered: Optional[np.ndarray] = None
+    for filename in filenames:
+        with np.load(filename) as shard:
+            num_rows = int(shard['num_rows'])
+            if params is None or results is None or covered is None:
+                params = np.empty((num_rows,) + shard['params'].shape[1:])
+                results = np.empty((num_rows,) + shard['results'].shape[1:], dtype=shard['results'].dtype)
+                analytes = list(shard['analytes'])
+                covered = np.zeros(num_rows, dtype=bool)
+            if num_rows != len(params) or list(shard['analytes']) != analytes or \
+                    shard['results'].shape[1:] != results.shape[1:]:
+                raise ValueError('{} belongs to a different ensemble'.format(filename))
+            rows = shard['rows']
+            if np.any(covered[rows]):
+                raise ValueError('{} repeats rows of another shard'.format(filename))
+            covered[rows] = True
+            params[rows] = shard['params']
+            results[rows] = shard['results']
+    assert params is not None and results is not None and covered is not None
+    if not np.all(covered):
+        raise ValueError('{} of {} rows are missing from the shards'.format(np.sum(~covered), len(covered)))
+    return {'params': params, 'results': results, 'analytes': np.array(analytes)}
+
+
+###############################################################################
+# commands
+###############################################################################
+def _parameters(args: argparse.Namespace, problem: Problem) -> np.ndarray:
+    if args.params is not None:
+        if args.params.endswith('.npy'):
+            return cast(np.ndarray, np.load(args.params))
+        return np.loadtxt(args.params, delimiter=',', ndmin=2)
+    return sampling.sample(problem.bounds, args.num_sets, method=args.method, rng=args.seed)
+
+
+def _sample(args: argparse.Namespace) -> None:
+    problem = load_problem(args.problem)
+    np.save(args.output, _parameters(args, problem))
+
+
+def _run(args: argparse.Namespace) -> None:
+    index, count = parse_shard(args.shard)
+    if args.params is None and args.seed is None and count > 1:
+        raise ValueError('shards of a sampled design need --seed to agree on the design')
+    output = args.output or '.'
+    if os.path.isdir(output) or output.endswith(os.sep):
+        output = os.path.join(output, 'shard-{:05d}-of-{:05d}.npz'.format(index, count))
+    output = os.path.abspath(output)
+    if os.path.exists(output) and not args.force:
+        print('{} exists, skipping'.format(output), file=sys.stderr)
+        return
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    problem = load_problem(args.problem)
+    params = _parameters(args, problem)
+    rows = shard_rows(len(params), index, count)
+    engine = SubprocessEngine(args.phreeqc, timeout=args.timeout, keep_files=not args.minimal_io,
+                              max_output=_MINIMAL_IO_OUTPUT if args.minimal_io else None)
+    # every run gets a private scratch directory, so concurrent shards never
+    # share rendered files or phreeqc output
+    scratch_dir = args.scratch or (ram_scratch_dir() if args.minimal_io else tempfile.gettempdir())
+    runner = SimulationRunner(PHREEQC(engine=engine), max_workers=args.workers, batch_size=args.batch_size,
+                              cache=RunCache(args.cache) if args.cache else None, retries=args.retries,
+                              on_error='mask' if args.mask_failures else 'raise', scratch_dir=scratch_dir)
+    results = runner.run_results(problem, params[rows], analytes=args.analytes,
+                                 dtype=np.float32 if args.float32 else np.float64)
+
+    _save(output, rows=rows, num_rows=len(params), params=results.params, results=results.data,
+          analytes=np.array(results.analytes))
+    print(runner.metrics.to_json(), file=sys.stderr)
+
+
+def _merge(args: argparse.Namespace) -> None:
+    _save(os.path.abspath(args.output), **merge_shards(args.shards))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='ml4scm', description='Run ml4scm ensembles in batch.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def design_options(p: argparse.ArgumentParser) -> None:
+        p.add_argument('problem', help='problem file (.json, .yaml)')
+        p.add_argument('--params', help='parameter matrix (.npy, or comma separated text)')
+        p.add_argument('-n', '--num-sets', type=int, default=100, help='number of parameter sets to sample')
+        p.add_argument('--method', default='lhs', choices=sorted(sampling.SAMPLERS), help='sampling method')
+        p.add_argument('--seed', type=int, help='seed of the sampler')
+
+    p = commands.add_parser('sample', help='write a sampled parameter matrix')
+    design_options(p)
+    p.add_argument('-o', '--output', default='params.npy', help='.npy file to write')
+    p.set_defaults(func=_sample)
+
+    p = commands.add_parser('run', help='run one shard of the parameter matrix')
+    design_options(p)
+    p.add_argument('--shard', default='0/1', help='i/n: run shard i (from 0) of n')
+    p.add_argument('-o', '--output', help='.npz file or directory to write; Defaults to the current directory')
+    p.add_argument('--force', action='store_true', help='rerun a shard whose output exists')
+    p.add_argument('--analytes', nargs='+', default=['U'], help='analytes to keep')
+    p.add_argument('--phreeqc', help='phreeqc binary; PATH is searched if not given')
+    p.add_argument('--workers', type=int, help='worker processes')
+    p.add_argument('--batch-size', type=int, default=100, help='rows per phreeqc run with an input template')
+    p.add_argument('--cache', help='run cache directory')
+    p.add_argument('--timeout', type=float, help='seconds after which a phreeqc run is killed')
+    p.add_argument('--retries', type=int, default=0, help='times a failed phreeqc run is repeated')
+    p.add_argument('--mask-failures', action='store_true',
+                   help='store runs that keep failing as nan rows instead of stopping')
+    p.add_argument('--float32', action='store_true', help='store the results in single precision')
+    p.add_argument('--scratch', help='directory for run scratch files; Defaults to the system temporary directory')
+    p.add_argument('--minimal-io', action='store_true',
+                   help='discard the phreeqc listing, cap the kept screen output and default --scratch to /dev/shm')
+    p.set_defaults(func=_run)
+
+    p = commands.add_parser('merge', help='combine shard files into one ensemble')
+    p.add_argument('shards', nargs='+', help='shard files written by run')
+    p.add_argument('-o', '--output', default='ensemble.npz', help='.npz file to write')
+    p.set_defaults(func=_merge)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except (ValueError, RuntimeError, OSError) as e:
+        parser.exit(1, '{}: error: {}\n'.format(parser.prog, e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+"""
+Coordinator / worker execution of SimulationRunner over TCP.
+
+A Coordinator listens on a TCP address; ml4scm-worker processes on any node
+connect to it and run phreeqc for the tasks it hands out:
+
+    coordinator = Coordinator(('0.0.0.0', 5555))
+    runner = SimulationRunner(PHREEQC(), coordinator=coordinator)
+
+    ML4SCM_AUTHKEY=... ml4scm-worker coordinator-host:5555
+
+Connections are authenticated with the shared key in ML4SCM_AUTHKEY (or
+the authkey argument); messages are pickled, so only run workers and
+coordinators that trust each other. A worker receives the compiled
+templates, the input file and the PHREEQC wrapper once per job, then one
+task (a block of parameter rows) at a time, which it runs in a scratch
+directory. Workers send heartbeats while running; a worker that
+disconnects or stays silent longer than the timeout is dropped and its
+task is handed to another worker.
+"""
+import argparse
+import os
+import queue
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .metrics import RunStats
+from .phreeqc import PHREEQC, DatabaseTemplate, InputTemplate
+from .simulation import _run_rows
+
+AUTHKEY_ENV = 'ML4SCM_AUTHKEY'
+
+Address = Tuple[str, int]
+
+
+class TaskFailed(RuntimeError):
+    """
+    A task raised on its worker, or was lost by max_attempts workers.
+
+    index: position of the task in the list given to Coordinator.run
+    """
+    def __init__(self, index: int, message: str) -> None:
+        super().__init__(message)
+        self.index = index
+
+
+def _authkey(authkey: Union[str, bytes, None]) -> bytes:
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError('no authentication key; pass authkey or set {}'.format(AUTHKEY_ENV))
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class Coordinator:
+    """
+    Hands tasks to the connected workers and gathers their results.
+
+    Workers may connect and disconnect at any time; run blocks until every
+    task has been answered, however many workers there are.
+    """
+    def __init__(self, address: Address = ('127.0.0.1', 0), authkey: Union[str, bytes, None] = None,
+                 timeout: float = 60.0, max_attempts: int = 3) -> None:
+        """
+        address:      (host, port) to listen on; port 0 picks a free port,
+                      see self.address
+        authkey:      shared key of the workers; Defaults to $ML4SCM_AUTHKEY
+        timeout:      seconds of silence after which a busy worker is
+                      considered dead; workers send heartbeats four times
+                      per timeout
+        max_attempts: workers a task may be handed to before giving up
+        """
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be a positive integer')
+        self._authkey = _authkey(authkey)
+        self._listener = Listener(address, authkey=self._authkey)
+        self.address: Address = self._listener.address
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.workers = 0
+        self._pending: 'queue.Queue[Tuple[int, int, np.ndarray]]' = queue.Queue()
+        self._results: 'queue.Queue[Tuple[Any, ...]]' = queue.Queue()
+        self._job = 0
+        self._setup: Dict[str, Any] = {}
+        self._run_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._closed = threading.Event()
+        threading.Thread(target=self._accept, name='ml4scm-coordinator', daemon=True).start()
+        return
+
+    def __enter__(self) -> 'Coordinator':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Stop listening and tell the idle workers to exit.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        # wake up the accepting thread
+        try:
+            Client(self.address, authkey=self._authkey).close()
+        except OSError:
+            pass
+        self._listener.close()
+        return
+
+    def _accept(self) -> None:
+        while not self._closed.is_set():
+            try:
+                conn = self._listener.accept()
+            except (AuthenticationError, EOFError):
+                continue
+            except OSError:
+                if self._closed.is_set():
+                    return
+                continue
+            if self._closed.is_set():
+                conn.close()
+                return
+            with self._count_lock:
+                self.workers += 1
+            threading.Thread(target=self._serve, args=(conn,), name='ml4scm-worker-link', daemon=True).start()
+
+    def _serve(self, conn: Connection) -> None:
+        # one thread per worker: hand out a task, wait for its answer
+        sent_job = None
+        item = None
+        try:
+            while not self._closed.is_set():
+                try:
+                    item = self._pending.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                job, index, values = item
+                if job != self._job:
+                    item = None
+                    continue
+                if sent_job != job:
+                    conn.send(('job', self._setup))
+                    sent_job = job
+                conn.send(('task', job, index, values))
+                self._results.put(('started', job, index))
+                self._results.put(self._receive(conn))
+                item = None
+            conn.send(('stop',))
+        except (EOFError, OSError):
+            if item is not None:
+                self._results.put(('lost',) + item)
+        finally:
+            conn.close()
+            with self._count_lock:
+                self.workers -= 1
+
+    def _receive(self, conn: Connection) -> Tuple[Any, ...]:
+        while True:
+            if not conn.poll(self.timeout):
+                raise TimeoutError('worker silent for {}s'.format(self.timeout))
+            message = conn.recv()
+            if message[0] != 'heartbeat':
+                return tuple(message)
+
+    def run(self, tasks: List[np.ndarray], phreeqc: PHREEQC, template: DatabaseTemplate,
+            input_template: Optional[InputTemplate], input_filename: str, db_template_filename: str,
+            analytes: List[str], retries: int = 0, started: Optional[Callable[[int], None]] = None
+            ) -> Iterator[Tuple[int, List[np.ndarray], Optional[RunStats], Optional[TaskFailed]]]:
+        """
+        Run every task (a matrix of rows for one phreeqc invocation, see
+        SimulationRunner) on the workers. Arguments after tasks are those
+        of run_sims.
+
+        retries: times a task that raised on its worker is handed out again
+        started: called with the task index when the task is first handed
+                 to a worker, from the thread iterating over run
+        return:  (task index, outputs, stats, None) in completion order, or
+                 (task index, [], None, TaskFailed) for a task that failed
+                 retries + 1 times or was lost by max_attempts workers
+        """
+        if input_template is None:
+            # the workers may not share our file system
+            with open(input_filename, 'r') as fd:
+                input_text: Optional[str] = fd.read()
+        else:
+            input_text = None
+        setup = dict(phreeqc=phreeqc,
+                     template=template,
+                     input_template=input_template,
+                     db_filename=os.path.basename(db_template_filename),
+                     input_filename=os.path.basename(input_filename),
+                     input_text=input_text,
+                     analytes=analytes,
+                     heartbeat=self.timeout / 4)
+
+        with self._run_lock:
+            # the setup is in place before tasks of the new job are queued
+            self._setup = setup
+            self._job += 1
+            job = self._job
+            for index, values in enumerate(tasks):
+                self._pending.put((job, index, values))
+            attempts = [1] * len(tasks)
+            errors = [0] * len(tasks)
+            done = [False] * len(tasks)
+            handed_out = [False] * len(tasks)
+            remaining = len(tasks)
+            try:
+                while remaining:
+                    kind, job_id, index, *rest = self._results.get()
+                    if job_id != job or done[index]:
+                        continue
+                    if kind == 'started':
+                        if not handed_out[index] and started is not None:
+                            started(index)
+                        handed_out[index] = True
+                        continue
+                    if kind == 'lost' and attempts[index] < self.max_attempts:
+                        attempts[index] += 1
+                        self._pending.put((job, index, rest[0]))
+                        continue
+                    if kind == 'error' and errors[index] < retries:
+                        errors[index] += 1
+                        self._pending.put((job, index, tasks[index]))
+                        continue
+                    done[index] = True
+                    remaining -= 1
+                    if kind == 'lost':
+                        yield index, [], None, TaskFailed(index, 'task {} was lost by {} workers'.format(
+                            index, attempts[index]))
+                    elif kind == 'error':
+                        yield index, [], None, TaskFailed(index, 'task {} failed: {}'.format(index, rest[0]))
+                    else:
+                        yield index, rest[0], rest[1], None
+            finally:
+                # workers skip the tasks of a finished or abandoned job
+                self._job += 1
+
+
+###############################################################################
+# worker
+###############################################################################
+def _heartbeat(conn: Connection, lock: threading.Lock, interval: float, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        try:
+            with lock:
+                conn.send(('heartbeat',))
+        except OSError:
+            return
+
+
+def _run_task(setup: Dict[str, Any], values: np.ndarray,
+              scratch_dir: Optional[str] = None) -> Tuple[List[np.ndarray], RunStats]:
+    with tempfile.TemporaryDirectory(prefix='ml4scm-', dir=scratch_dir) as scratch:
+        if setup['input_text'] is not None:
+            with open(os.path.join(scratch, setup['input_filename']), 'w') as fd:
+                fd.write(setup['input_text'])
+        return _run_rows(phreeqc=setup['phreeqc'],
+                         template=setup['template'],
+                         input_template=setup['input_template'],
+                         values_mtrx=values,
+                         db_filename=setup['db_filename'],
+                         input_filename=setup['input_filename'],
+                         analytes=setup['analytes'],
+                         cwd=scratch)
+
+
+def serve(address: Address, authkey: Union[str, bytes, None] = None, phreeqc: Optional[PHREEQC] = None,
+          wait: float = 0.0, scratch_dir: Optional[str] = None) -> int:
+    """
+    Run tasks from the coordinator at address until it stops the worker or
+    goes away.
+
+    authkey:     shared key of the coordinator; Defaults to $ML4SCM_AUTHKEY
+    phreeqc:     PHREEQC to run instead of the coordinator's, e.g. when the
+                 binary lives elsewhere on this node
+    wait:        seconds to keep retrying while the coordinator is not up yet
+    scratch_dir: directory for the scratch directories of the runs, e.g.
+                 simulation.ram_scratch_dir(); the system temporary
+                 directory if not provided
+    return:      number of tasks run
+    """
+    key = _authkey(authkey)
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            conn = Client(address, authkey=key)
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(1.0)
+
+    lock = threading.Lock()
+    setup: Dict[str, Any] = {}
+    count = 0
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'stop':
+                break
+            if message[0] == 'job':
+                setup = message[1]
+                if phreeqc is not None:
+                    setup['phreeqc'] = phreeqc
+                continue
+
+            _, job, index, values = message
+            stop = threading.Event()
+            beat = threading.Thread(target=_heartbeat, args=(conn, lock, setup['heartbeat'], stop), daemon=True)
+            beat.start()
+            try:
+                outputs, stats = _run_task(setup, values, scratch_dir)
+                reply: Tuple[Any, ...] = ('result', job, index, outputs, stats)
+            except Exception as e:
+                reply = ('error', job, index, '{}: {}'.format(type(e).__name__, e))
+            finally:
+                stop.set()
+                beat.join()
+            try:
+                with lock:
+                    conn.send(reply)
+            except OSError:
+                break
+            count += 1
+    finally:
+        conn.close()
+    return count
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='ml4scm-worker',
+                                     description='Run ml4scm simulations for a coordinator. '
+                                                 'The shared key is read from ${}.'.format(AUTHKEY_ENV))
+    parser.add_argument('address', help='HOST:PORT of the coordinator')
+    parser.add_argument('--phreeqc', help="phreeqc binary to run instead of the coordinator's")
+    parser.add_argument('--wait', type=float, default=0.0, help='seconds to wait for the coordinator to come up')
+    parser.add_argument('--scratch', help='directory for run scratch files, e.g. /dev/shm')
+    args = parser.parse_args(argv)
+
+    host, _, port = args.address.rpartition(':')
+    if not host or not port.isdigit():
+        parser.error('address must be HOST:PORT')
+    phreeqc = PHREEQC(args.phreeqc) if args.phreeqc else None
+    serve((host, int(port)), phreeqc=phreeqc, wait=args.wait, scratch_dir=args.scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,81 @@
 import numpy as np
-from typing import Callable, List, cast
+from typing import Callable, List, Optional, Union, cast
+
+# noise model for log_likelihoods: None for the historical per-run std form,
+# a scalar for a fixed sigma, or one sigma per observation
+Sigma = Union[None, float, List[float], np.ndarray]
+
+
+def _observed(concs: np.ndarray, conc_measured: Union[List[float], np.ndarray]) -> np.ndarray:
+    # concs as an (n_runs, n_obs) matrix. a batch in which every run failed
+    # comes back from collect_results with no steps at all; it is widened to
+    # nan rows so those runs cost nan like any other failed run
+    concs = np.atleast_2d(np.asarray(concs, dtype=float))
+    if concs.shape[1] == 0:
+        return np.full((len(concs), np.size(conc_measured)), np.nan)
+    return concs
+
+
+def log_likelihoods(concs: np.ndarray, conc_measured: np.ndarray, sigma: Sigma = None,
+                    scale: float = 1e6) -> np.ndarray:
+    # log likelihoods of all runs at once
+    # concs: (n_runs, n_obs) matrix of concentrations from phreeqc, or a single run
+    # conc_measured: (n_obs,) measured concentrations
+    # sigma: None uses -sum(r**2) / std(run)**2 with the std of each scaled run
+    #        (the form log_likelihood has always used); a scalar or an (n_obs,)
+    #        array gives the gaussian -0.5 * sum((r / sigma)**2)
+    # scale: factor applied to concs before comparing, 1e6 for mol/kgw to ppm-ish units
+    # return: (n_runs,) log likelihoods, or a scalar for a single run
+    single = np.ndim(concs) == 1
+    concs = _observed(concs, conc_measured) * scale
+    resid = concs - np.asarray(conc_measured, dtype=float)
+    if sigma is None:
+        ll = -np.sum(np.square(resid), axis=1) / np.var(concs, axis=1)
+    else:
+        ll = -0.5 * np.sum(np.square(resid / np.asarray(sigma, dtype=float)), axis=1)
+    return cast(np.ndarray, ll[0] if single else ll)
+
+
+def normalize_log_weights(log_weights: np.ndarray) -> np.ndarray:
+    # turns log weights into normalized weights with log-sum-exp, so
+    # large residuals do not underflow every weight to 0. nan log weights,
+    # from failed runs, get weight 0
+    log_weights = np.asarray(log_weights, dtype=float)
+    log_weights = np.where(np.isnan(log_weights), -np.inf, log_weights)
+    top = np.max(log_weights)
+    if not np.isfinite(top):
+        raise ValueError('no run has a finite log likelihood')
+    w = np.exp(log_weights - top)
+    return cast(np.ndarray, w / np.sum(w))
 
 
 def log_likelihood(concs: np.ndarray, conc_measured: np.ndarray) -> np.ndarray:  # type: ignore
     # TODO: research builtin log-likelihood estimation in scikit
     # applies the log likelihood equation to 1 set of generated concentrations
     # concs: 1 set of concentrations from phreeqc run
-    concs = concs * 1e6
-    p = np.exp(-1 * np.sum(np.power(np.array(concs) - conc_measured, 2)) / np.power(np.std(concs), 2))
-    return cast(np.ndarray, p)
+    # return: the likelihood itself, exp of log_likelihoods
+    return cast(np.ndarray, np.exp(log_likelihoods(concs, conc_measured)))
+
+
+def ll_func(exp_U: List[float], sigma: Sigma = None) -> Callable[[np.ndarray], np.ndarray]:
+    # log likelihood function for grid_search_f; accepts one run or an
+    # (n_runs, n_obs) matrix, in which case it returns one value per run.
+    # grid_search_f already scales concs by 1e6, so they are compared as
+    # they come. the log is returned because the likelihood itself
+    # underflows to 0 for all but the closest runs; pass log=True to
+    # gs_resample to resample from it
+    def f(concs: np.ndarray) -> np.ndarray:
+        return log_likelihoods(concs, np.asarray(exp_U), sigma, scale=1.0)
+    setattr(f, 'vectorized', True)
+    return f
 
 
-def ll_func(exp_U: List[float]) -> Callable[[np.ndarray], np.ndarray]:
-    return lambda concs: log_likelihood(concs, exp_U)  # type: ignore
+def rss_func(exp_U: List[float]) -> Callable[[np.ndarray], np.ndarray]:
+    # residual sum of squares for grid_search_f, the cost grid_search_rss
+    # computes; accepts one run or an (n_runs, n_obs) matrix
+    def f(concs: np.ndarray) -> np.ndarray:
+        resid = _observed(concs, exp_U) - np.asarray(exp_U, dtype=float)
+        rss = np.sum(np.square(resid), axis=1)
+        return cast(np.ndarray, rss[0] if np.ndim(concs) == 1 else rss)
+    setattr(f, 'vectorized', True)
+    return f
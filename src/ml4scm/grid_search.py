@@ -1,51 +1,171 @@
+import itertools
 import numpy as np
-from typing import Callable, List, cast
+from typing import Callable, List, Optional, Set, Tuple, cast
 from .simulation import SimulationRunner, Problem
+from . import resampling, sampling
+from .estimators import normalize_log_weights
+
+
+def _run_U(sim: SimulationRunner, problem: Problem, params: np.ndarray) -> np.ndarray:
+    # (n_runs, n_steps) U concentrations, a view of the ResultSet the runs are
+    # collected into; callers own it and may scale it in place.
+    # runs that failed (SimulationRunner(on_error='mask')) are nan rows, so
+    # their costs are nan; adaptive_search ranks them last and gs_resample
+    # gives them weight 0
+    return sim.run_results(problem=problem, values=params, analytes=['U'])['U']
 
 
 def grid_search(sim: SimulationRunner, problem: Problem, params: np.ndarray) -> np.ndarray:
-    run = sim.run_problem(problem=problem, values=params, analytes=['U'])
-    res = np.array(run)[:, 1::2].reshape(np.shape(np.array(run))[0], np.shape(np.array(run))[2])
-    return res
+    return _run_U(sim, problem, params)
 
 
 def grid_search_rss(sim: SimulationRunner, problem: Problem, params: np.ndarray, exp_U: List[float]) -> np.ndarray:
-    run = sim.run_problem(problem=problem, values=params, analytes=['U'])
-    res = np.array(run)[:, 1::2].reshape(np.shape(np.array(run))[0], np.shape(np.array(run))[2])
-    cost = np.sum(np.square(exp_U - res[0]*1e6))
-    for row in res[1:]:
-        cost = np.vstack((cost, np.sum(np.square(exp_U - row*1e6))))
-    return cast(np.ndarray, cost)
+    # residuals are formed in place, without temporaries of the whole matrix
+    res = _run_U(sim, problem, params)
+    if res.shape[1] == 0:
+        # every run failed, so there are no steps to compare
+        return np.full((len(res), 1), np.nan)
+    res *= 1e6
+    res -= np.asarray(exp_U)
+    return cast(np.ndarray, np.sum(np.square(res, out=res), axis=1).reshape(-1, 1))
 
 
 def grid_search_f(
         sim: SimulationRunner,
         problem: Problem,
         params: np.ndarray,
-        func: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
-    run = sim.run_problem(problem=problem, values=params, analytes=['U'])
-    res = np.array(run)[:, 1::2].reshape(np.shape(np.array(run))[0], np.shape(np.array(run))[2])
-    cost = func(res[0]*1e6)
-    for row in res[1:]:
-        cost = np.vstack((cost, func(row*1e6)))
-    return cast(np.ndarray, cost)
+        func: Callable[[np.ndarray], np.ndarray],
+        vectorized: Optional[bool] = None) -> np.ndarray:
+    # func: cost of one run's concentrations, e.g. estimators.ll_func
+    # vectorized: func takes the whole (n_runs, n_obs) matrix and returns one
+    #             value per run; defaults to func.vectorized if it is set
+    res = _run_U(sim, problem, params)
+    res *= 1e6
+    if vectorized is None:
+        vectorized = getattr(func, 'vectorized', False)
+    if vectorized:
+        return np.asarray(func(res)).reshape(-1, 1)
+    return np.vstack([func(row) for row in res])
+
+
+def _local_grid(center: np.ndarray, step: np.ndarray, lower: np.ndarray, upper: np.ndarray,
+                levels: int) -> np.ndarray:
+    # levels points per parameter spanning center +- step, clipped to the bounds
+    axes = [np.unique(np.clip(np.linspace(c - h, c + h, levels), lo, up))
+            for c, h, lo, up in zip(center, step, lower, upper)]
+    return np.array(list(itertools.product(*axes)), dtype=float)
+
+
+def adaptive_search(
+        evaluate: Callable[[np.ndarray], np.ndarray],
+        lower: np.ndarray,
+        upper: np.ndarray,
+        levels: int = 5,
+        budget: int = 1000,
+        tol: float = 1e-3,
+        top_k: int = 3,
+        minimize: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    # coarse-to-fine search of a box: evaluates a levels^d grid over the
+    # bounds, then repeatedly lays a finer levels^d grid over the cell around
+    # each of the top_k best points not refined yet, halving the spacing for
+    # levels=5. Stops when budget points have been evaluated, when the cells
+    # of the best unrefined points are narrower than tol times the bounds,
+    # or when nothing new is left to evaluate
+    # evaluate: costs of an (n, d) matrix of points, one per row
+    # minimize: the best points have the lowest cost; False for likelihoods
+    # return: every evaluated point and its cost, in evaluation order
+    if levels < 3:
+        raise ValueError('levels must be at least 3 to refine a cell')
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    width = np.where(upper > lower, upper - lower, 1.0)
+
+    points = np.empty((0, len(lower)))
+    steps = np.empty((0, len(lower)))
+    costs = np.empty(0)
+    refined = np.empty(0, dtype=bool)
+    seen: Set[bytes] = set()
+
+    def key(p: np.ndarray) -> bytes:
+        # points equal up to round-off share a key
+        return cast(bytes, np.round((p - lower) / width, 10).tobytes())
+
+    candidates = _local_grid((lower + upper) / 2, (upper - lower) / 2, lower, upper, levels)
+    candidate_steps = np.tile((upper - lower) / (levels - 1), (len(candidates), 1))
+    while len(candidates) and len(points) < budget:
+        # neighbouring cells overlap; every point is evaluated once
+        new: List[int] = []
+        for i, p in enumerate(candidates):
+            if len(points) + len(new) >= budget:
+                break
+            if key(p) not in seen:
+                seen.add(key(p))
+                new.append(i)
+        if not new:
+            break
+        c = np.asarray(evaluate(candidates[new]), dtype=float).reshape(len(new))
+        points = np.vstack([points, candidates[new]])
+        steps = np.vstack([steps, candidate_steps[new]])
+        costs = np.concatenate([costs, c])
+        refined = np.concatenate([refined, np.zeros(len(new), dtype=bool)])
+
+        # refine around the best points not refined yet; once their cells
+        # are narrower than tol the search has converged
+        order = np.argsort(np.where(np.isnan(costs), np.inf, costs if minimize else -costs), kind='stable')
+        best = [i for i in order if not refined[i]][:top_k]
+        open_cells = [i for i in best if np.any(steps[i] / width > tol)]
+        refined[open_cells] = True
+        grids = [_local_grid(points[i], steps[i], lower, upper, levels) for i in open_cells]
+        candidates = np.vstack(grids) if grids else np.empty((0, len(lower)))
+        candidate_steps = np.vstack([np.tile(2 * steps[i] / (levels - 1), (len(g), 1))
+                                     for i, g in zip(open_cells, grids)]) if grids else np.empty((0, len(lower)))
+    return points, costs
 
 
-def gs_resample(num_trials: int, gsll: np.ndarray) -> List[np.ndarray]:
+def adaptive_grid_search(
+        sim: SimulationRunner,
+        problem: Problem,
+        func: Callable[[np.ndarray], np.ndarray],
+        levels: int = 5,
+        budget: int = 1000,
+        tol: float = 1e-3,
+        top_k: int = 3,
+        minimize: bool = True,
+        vectorized: Optional[bool] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # adaptive alternative to grid_search_f over problem.bounds; see
+    # adaptive_search. Each refinement round is one run_problem call
+    # func: cost of the concentrations as in grid_search_f, e.g.
+    #       estimators.rss_func (minimize) or estimators.ll_func (minimize=False)
+    # return: (n, num_vars) evaluated parameters and their (n,) costs
+    lower = np.array([b.lower for b in problem.bounds], dtype=float)
+    upper = np.array([b.upper for b in problem.bounds], dtype=float)
+
+    def evaluate(params: np.ndarray) -> np.ndarray:
+        return grid_search_f(sim, problem, params, func, vectorized)
+
+    return adaptive_search(evaluate, lower, upper, levels=levels, budget=budget, tol=tol, top_k=top_k,
+                           minimize=minimize)
+
+
+def gs_resample(num_trials: int, gsll: np.ndarray, scheme: str = 'multinomial',
+                rng: sampling.Seed = None, log: bool = False) -> np.ndarray:
     # samples num_trials times from gs_log_likelihood grid and stacks results
+    # scheme: resampling scheme, see resampling.RESAMPLERS
+    # rng: seed or numpy Generator
+    # log: gsll holds log weights, e.g. grid_search_f with estimators.ll_func;
+    #      they are normalized in log space so they do not underflow
     # return: num_trials by 2500 matrix of each index sampled from gsll grid
 
     # summing the indices of the grid search
-    pp = [np.arange(len(gsll))]
-
-    while num_trials > 1:
-        # resample parameters with new weights and stack into master list
-        samples = gsll[[np.arange(len(gsll))][-1]]
-        samples = samples / np.sum(samples)
-        re_pp = [pp[-1][np.random.choice(pp[-1], p=samples.T[0])] for i in range(len(pp[-1]))]
-        pp = np.vstack((pp, re_pp))  # type: ignore
-        num_trials -= 1
+    if log:
+        samples = normalize_log_weights(np.ravel(gsll))
+    else:
+        samples = np.nan_to_num(np.ravel(gsll), nan=0.0)
+    # the weights are fixed, so every generation's draw is made up front;
+    # row t is then replaced in place by the particles it picks: the draw
+    # picks a position whose entry indexes the previous generation, as the
+    # per-particle np.random.choice(pp[-1], p=...) loop did
+    pp = resampling.resample_history(samples, num_trials, scheme, rng)
+    for t in range(1, num_trials):
+        pp[t] = pp[t - 1][pp[t - 1][pp[t]]]
     return pp
-
-
-
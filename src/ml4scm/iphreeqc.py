@@ -0,0 +1,146 @@
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import os.path
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+from .phreeqc import Engine, PHREEQC, PHREEQCOutput
+
+
+class _Instance:
+    # the IPhreeqc instance of one thread, destroyed along with the
+    # thread's locals when the thread ends
+    def __init__(self, iid: int) -> None:
+        self.id = iid
+        self.db: Optional[str] = None
+
+
+class IPhreeqcEngine(Engine):
+    """
+    Runs phreeqc in-process through the IPhreeqc shared library.
+
+    Each thread keeps its own IPhreeqc instance alive between runs; the
+    database is only reloaded when its text changes, and selected output is
+    read from memory instead of from files. An instance is destroyed when
+    its thread ends, or by close.
+    """
+    in_memory = True
+
+    def __init__(self, library: Optional[str] = None) -> None:
+        """
+        library: path to libiphreeqc; the usual library search path is
+                 used if not provided
+        """
+        if library is None:
+            library = ctypes.util.find_library('iphreeqc') or ctypes.util.find_library('IPhreeqc')
+        if library is None:
+            raise RuntimeError('Cannot find the IPhreeqc library, please specify the path to libiphreeqc')
+        self.library = library
+        self._lib: Any = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._finalizers: List[weakref.finalize] = []
+        return
+
+    def close(self) -> None:
+        """
+        Destroy the IPhreeqc instances of every thread; threads running
+        again afterwards create new ones.
+        """
+        with self._lock:
+            finalizers, self._finalizers = self._finalizers, []
+            self._local = threading.local()
+        for finalizer in finalizers:
+            finalizer()
+        return
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # library handles and instances are per process; workers reload them
+        return {'library': self.library}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state['library'])  # type: ignore
+
+    def _load(self) -> Any:
+        with self._lock:
+            if self._lib is None:
+                lib = ctypes.CDLL(self.library)
+                lib.CreateIPhreeqc.restype = ctypes.c_int
+                lib.CreateIPhreeqc.argtypes = []
+                lib.DestroyIPhreeqc.restype = ctypes.c_int
+                lib.DestroyIPhreeqc.argtypes = [ctypes.c_int]
+                for name in ['LoadDatabaseString', 'RunString']:
+                    getattr(lib, name).restype = ctypes.c_int
+                    getattr(lib, name).argtypes = [ctypes.c_int, ctypes.c_char_p]
+                for name in ['GetErrorString', 'GetWarningString', 'GetSelectedOutputString']:
+                    getattr(lib, name).restype = ctypes.c_char_p
+                    getattr(lib, name).argtypes = [ctypes.c_int]
+                for name in ['SetOutputFileOn', 'SetErrorFileOn', 'SetLogFileOn',
+                             'SetSelectedOutputFileOn', 'SetSelectedOutputStringOn']:
+                    getattr(lib, name).restype = ctypes.c_int
+                    getattr(lib, name).argtypes = [ctypes.c_int, ctypes.c_int]
+                self._lib = lib
+        return self._lib
+
+    def _instance(self) -> Tuple[Any, _Instance]:
+        lib = self._load()
+        local = self._local
+        instance = getattr(local, 'instance', None)
+        if instance is None:
+            iid = lib.CreateIPhreeqc()
+            if iid < 0:
+                raise RuntimeError('CreateIPhreeqc failed')
+            instance = _Instance(iid)
+            with self._lock:
+                self._finalizers = [f for f in self._finalizers if f.alive]
+                self._finalizers.append(weakref.finalize(instance, lib.DestroyIPhreeqc, iid))
+            # no listing, log or selected-output files, selected output in memory
+            for name in ['SetOutputFileOn', 'SetErrorFileOn', 'SetLogFileOn', 'SetSelectedOutputFileOn']:
+                getattr(lib, name)(iid, 0)
+            lib.SetSelectedOutputStringOn(iid, 1)
+            local.instance = instance
+        return lib, instance
+
+    def identity(self) -> str:
+        st = os.stat(self.library) if os.path.exists(self.library) else None
+        return 'iphreeqc:{}:{}:{}'.format(self.library, st.st_size if st else '', st.st_mtime_ns if st else '')
+
+    def run_strings(self, db_text: str, input_text: str, analytes: Optional[List[str]] = None) -> PHREEQCOutput:
+        lib, instance = self._instance()
+        iid = instance.id
+
+        # the library returns NULL rather than an empty string at times
+        def text(name: str) -> str:
+            return (getattr(lib, name)(iid) or b'').decode()
+
+        start = time.perf_counter()
+        digest = hashlib.sha256(db_text.encode()).hexdigest()
+        if instance.db != digest:
+            instance.db = None
+            if lib.LoadDatabaseString(iid, db_text.encode()) != 0:
+                raise RuntimeError('failed to load database: {}'.format(text('GetErrorString')))
+            instance.db = digest
+
+        if lib.RunString(iid, input_text.encode()) != 0:
+            raise RuntimeError('phreeqc failed: {}'.format(text('GetErrorString')))
+
+        ran = time.perf_counter()
+        selected = text('GetSelectedOutputString')
+        output = PHREEQC.parse_output(io.StringIO(selected), analytes)
+        return PHREEQCOutput(stdout=text('GetWarningString'),
+                             stderr=text('GetErrorString'),
+                             output=output,
+                             timings={'run': ran - start, 'parse': time.perf_counter() - ran},
+                             bytes_read=len(selected))
+
+    def run(self, db_filename: str, in_filename: str, analytes: Optional[List[str]] = None,
+            cwd: Optional[str] = None) -> PHREEQCOutput:
+        with open(os.path.join(cwd or '', f'{db_filename}.txt'), 'r') as fd:
+            db_text = fd.read()
+        with open(os.path.join(cwd or '', in_filename), 'r') as fd:
+            input_text = fd.read()
+        return self.run_strings(db_text=db_text, input_text=input_text, analytes=analytes)
@@ -0,0 +1,182 @@
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, IO, List, Optional
+
+import numpy as np
+
+
+@dataclass
+class RunStats:
+    """
+    Cost of one phreeqc invocation, see PHREEQCOutput.
+
+    timings:       seconds per stage: 'render', 'run' and 'parse'
+    bytes_written: bytes of database and input rendered for the run
+    bytes_read:    bytes of selected output read back
+    """
+    timings: Dict[str, float] = field(default_factory=dict)
+    bytes_written: int = 0
+    bytes_read: int = 0
+
+
+@dataclass
+class RunEvent:
+    """
+    One phreeqc invocation of SimulationRunner, as seen by a RunObserver.
+
+    num_rows:  number of parameter rows simulated by the invocation
+    start:     time.time() when the run started; runs waiting for a worker
+               or for a free slot have not started yet
+    latency:   seconds from start to finish or failure
+    stats:     stage timings and bytes, once finished
+    error:     the exception, if the run failed
+    in_flight: runs started and not yet finished; includes this one in
+               on_start, excludes it in on_finish and on_failure
+    queued:    runs waiting for a worker or a free slot, including retries
+               waiting to run again
+    """
+    num_rows: int
+    start: float
+    latency: float = 0.0
+    stats: Optional[RunStats] = None
+    error: Optional[BaseException] = None
+    in_flight: int = 0
+    queued: int = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        d: Dict[str, Any] = {'rows': self.num_rows, 'start': self.start, 'latency': self.latency,
+                             'in_flight': self.in_flight, 'queued': self.queued}
+        if self.stats is not None:
+            d.update(timings=self.stats.timings, bytes_written=self.stats.bytes_written,
+                     bytes_read=self.stats.bytes_read)
+        if self.error is not None:
+            d['error'] = repr(self.error)
+        return d
+
+
+class RunObserver:
+    """
+    Callbacks for the runs of a SimulationRunner; override what is needed.
+    Callbacks run in the thread driving run_sims / iter_sims, in the pool
+    threads for submit and on the event loop for create_tasks; the runner
+    makes one callback at a time.
+    """
+    def on_start(self, event: RunEvent) -> None:
+        pass
+
+    def on_finish(self, event: RunEvent) -> None:
+        pass
+
+    def on_failure(self, event: RunEvent) -> None:
+        pass
+
+
+class RunMetrics(RunObserver):
+    """
+    Aggregates run events into throughput, latency percentiles, stage
+    timings and queue depth.
+    """
+    def __init__(self) -> None:
+        self.started = 0
+        self.finished = 0
+        self.failed = 0
+        self.rows = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.first_start: Optional[float] = None
+        self.last_finish: Optional[float] = None
+        self.latencies: List[float] = []
+        self.timings: Dict[str, float] = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        return
+
+    def on_start(self, event: RunEvent) -> None:
+        self.started += 1
+        if self.first_start is None:
+            self.first_start = event.start
+        self.in_flight = event.in_flight
+        self.max_in_flight = max(self.max_in_flight, event.in_flight)
+        self._queue_depth(event)
+
+    def on_finish(self, event: RunEvent) -> None:
+        self.finished += 1
+        self.rows += event.num_rows
+        self._done(event)
+        if event.stats is not None:
+            for stage, seconds in event.stats.timings.items():
+                self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+            self.bytes_written += event.stats.bytes_written
+            self.bytes_read += event.stats.bytes_read
+
+    def on_failure(self, event: RunEvent) -> None:
+        self.failed += 1
+        self._done(event)
+
+    def _done(self, event: RunEvent) -> None:
+        self.in_flight = event.in_flight
+        self._queue_depth(event)
+        self.latencies.append(event.latency)
+        self.last_finish = event.start + event.latency
+
+    def _queue_depth(self, event: RunEvent) -> None:
+        self.queued = event.queued
+        self.max_queued = max(self.max_queued, event.queued)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        The metrics as a plain, JSON serializable dict.
+        """
+        elapsed = 0.0
+        if self.first_start is not None and self.last_finish is not None:
+            elapsed = self.last_finish - self.first_start
+        latency: Dict[str, float] = {}
+        if self.latencies:
+            p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99])
+            latency = {'mean': float(np.mean(self.latencies)), 'p50': float(p50), 'p90': float(p90),
+                       'p99': float(p99), 'max': float(np.max(self.latencies))}
+        return {'time': time.time(),
+                'started': self.started,
+                'finished': self.finished,
+                'failed': self.failed,
+                'rows': self.rows,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'queued': self.queued,
+                'max_queued': self.max_queued,
+                'elapsed': elapsed,
+                'rows_per_second': self.rows / elapsed if elapsed > 0 else 0.0,
+                'latency': latency,
+                'timings': dict(self.timings),
+                'bytes_written': self.bytes_written,
+                'bytes_read': self.bytes_read}
+
+    def to_json(self) -> str:
+        """
+        The metrics as a single JSON line.
+        """
+        return json.dumps(self.as_dict())
+
+
+class JsonLinesObserver(RunObserver):
+    """
+    Writes every run event to f as a JSON line, e.g. for log shipping.
+    """
+    def __init__(self, f: IO) -> None:
+        self.f = f
+
+    def _write(self, kind: str, event: RunEvent) -> None:
+        self.f.write(json.dumps(dict(event.as_dict(), event=kind)) + '\n')
+        self.f.flush()
+
+    def on_start(self, event: RunEvent) -> None:
+        self._write('start', event)
+
+    def on_finish(self, event: RunEvent) -> None:
+        self._write('finish', event)
+
+    def on_failure(self, event: RunEvent) -> None:
+        self._write('failure', event)
@@ -1,10 +1,17 @@
+import abc
 import os.path
 import shutil
 import subprocess
+import asyncio
+import functools
+import tempfile
+import itertools
+import hashlib
+import time
 import numpy as np
 import re
-from dataclasses import dataclass
-from typing import Optional, Tuple, List, cast, IO
+from dataclasses import dataclass, field
+from typing import Optional, Tuple, List, Dict, Sequence, Any, cast, IO
 
 @dataclass
 class PHREEQCOutput:
@@ -14,28 +21,238 @@ class PHREEQCOutput:
     stdout, stderr: string-output of the command execution
     output: numpy n-dimensional array of simulation number vs
             analyte concentration from the .sel file
+    timings: seconds spent per stage; 'render' (writing the database
+             and input), 'run' (phreeqc itself, process spawn and wait
+             or the in-process call) and 'parse' (reading selected output)
+    bytes_written, bytes_read: size of the rendered database and input,
+             and of the selected output read back
     """
     stdout: str
     stderr: str
     output: np.ndarray
+    timings: Dict[str, float] = field(default_factory=dict)
+    bytes_written: int = 0
+    bytes_read: int = 0
+
+
+class DatabaseTemplate:
+    """
+    A thermodynamic database template compiled for a fixed list of parameters.
+
+    The template text is split once at every placeholder occurrence, so that
+    rendering a row of values is a single join rather than a re-read of the
+    .tpl file and one full-string replace per parameter.
+    """
+    def __init__(self, text: str, pars: Sequence[str], source: Optional[str] = None,
+                 strict: bool = True) -> None:
+        """
+        text:   template text, placeholders included
+        pars:   parameter names; each must occur in text
+        source: optional name of the template, used in error messages
+        strict: if False, names missing from text are allowed and ignored
+        """
+        missing = [p for p in pars if p not in text]
+        if missing and strict:
+            raise ValueError('parameters {} not found in template {}'.format(missing, source or ''))
+
+        self.pars = list(pars)
+        self.source = source
+        # first index wins, the same as repeated str.replace would do
+        slot_of: Dict[str, int] = {}
+        for i, p in enumerate(self.pars):
+            if p not in missing:
+                slot_of.setdefault(p, i)
+
+        if slot_of:
+            # longest names first so that e.g. K10 is not matched as K1
+            names = sorted(slot_of, key=len, reverse=True)
+            parts = re.split('({})'.format('|'.join(re.escape(n) for n in names)), text)
+        else:
+            parts = [text]
+        self._literals = parts[0::2]
+        self._slots = [slot_of[n] for n in parts[1::2]]
+        # values that actually appear in the rendered text
+        self.used = sorted(set(self._slots))
+
+        h = hashlib.sha256()
+        for literal in self._literals:
+            h.update(literal.encode())
+            h.update(b'\0')
+        h.update(repr(self._slots).encode())
+        self.fingerprint = h.hexdigest()
+        return
+
+    @staticmethod
+    def read(template_filename: str) -> str:
+        """
+        Return the text of template_filename.tpl; the first line of the file
+        is discarded, as in PHREEQC.write_db_from_template.
+        """
+        with open(template_filename + '.tpl', 'r') as fd:
+            fd.readline()  # Discard first line of file
+            return fd.read()
+
+    @classmethod
+    def from_file(cls, template_filename: str, pars: Sequence[str], strict: bool = True) -> 'DatabaseTemplate':
+        """
+        Compile template_filename.tpl, see read.
+        """
+        return cls(cls.read(template_filename), pars, source=template_filename + '.tpl', strict=strict)
+
+    def render(self, values: Sequence[Any]) -> str:
+        """
+        Return the database text with each parameter replaced by
+        the corresponding entry of values.
+        """
+        if len(values) != len(self.pars):
+            raise ValueError('expected {} values, got {}'.format(len(self.pars), len(values)))
+        strs = [str(v) for v in values]
+        chunks = [''] * (2 * len(self._literals) - 1)
+        chunks[0::2] = self._literals
+        chunks[1::2] = [strs[i] for i in self._slots]
+        return ''.join(chunks)
+
+    def digest(self, values: Sequence[Any]) -> str:
+        """
+        Return a digest identifying the database rendered from values.
+        Equal digests imply equal rendered text, without rendering it.
+        """
+        h = hashlib.sha256(self.fingerprint.encode())
+        for i in self.used:
+            h.update(b'\0')
+            h.update(str(values[i]).encode())
+        return h.hexdigest()
+
+    def write(self, values: Sequence[Any], outfile: str) -> int:
+        """
+        Render values and write the database to outfile.txt;
+        returns the number of characters written
+        """
+        with open(outfile + '.txt', 'w') as fd:
+            return fd.write(self.render(values))
+
+
+# phreeqc keywords, used to find where a keyword data block ends
+_PHREEQC_KEYWORDS = frozenset([
+    'ADVECTION', 'CALCULATE_VALUES', 'COPY', 'DATABASE', 'DELETE', 'DUMP', 'END',
+    'EQUILIBRIUM_PHASES', 'EQUILIBRIUM', 'EQUILIBRIA', 'PURE_PHASES', 'PURE',
+    'EXCHANGE', 'EXCHANGE_MASTER_SPECIES', 'EXCHANGE_SPECIES', 'GAS_PHASE',
+    'INCLUDE$', 'INCREMENTAL_REACTIONS', 'INVERSE_MODELING', 'ISOTOPE_ALPHAS',
+    'ISOTOPE_RATIOS', 'ISOTOPES', 'KINETICS', 'KNOBS', 'LLNL_AQUEOUS_MODEL_PARAMETERS',
+    'MIX', 'NAMED_EXPRESSIONS', 'PHASES', 'PITZER', 'PRINT', 'RATES', 'REACTION',
+    'REACTION_PRESSURE', 'REACTION_PRESSURES', 'REACTION_TEMPERATURE',
+    'REACTION_TEMPERATURES', 'RUN_CELLS', 'SAVE', 'SELECTED_OUTPUT', 'SELECTED_OUT',
+    'SELECT_OUTPUT', 'SIT', 'SOLID_SOLUTIONS', 'SOLID_SOLUTION', 'SOLUTION',
+    'SOLUTION_MASTER_SPECIES', 'SOLUTION_SPECIES', 'SOLUTION_SPREAD', 'SOLUTION_S',
+    'SURFACE', 'SURFACE_MASTER_SPECIES', 'SURFACE_SPECIES', 'TITLE', 'TRANSPORT',
+    'USE', 'USER_GRAPH', 'USER_PRINT', 'USER_PUNCH',
+])
+
+# data blocks that only need to be defined once per phreeqc run
+_OUTPUT_KEYWORDS = frozenset(['SELECTED_OUTPUT', 'SELECTED_OUT', 'SELECT_OUTPUT', 'USER_PUNCH'])
+
+
+def _keyword(line: str) -> Optional[str]:
+    # the keyword starting line, or None for a data line
+    fields = line.split()
+    if not fields:
+        return None
+    word = fields[0].upper()
+    for suffix in ('_RAW', '_MODIFY'):
+        if word.endswith(suffix):
+            word = word[:-len(suffix)]
+    return word if word in _PHREEQC_KEYWORDS else None
+
+
+class InputTemplate(DatabaseTemplate):
+    """
+    A phreeqc input file template.
+
+    Several rows of values can be packed into a single input file as
+    consecutive simulations, so that one phreeqc process and one database
+    load serve the whole batch; the selected output is split back per row
+    using its sim column.
+    """
+    def __init__(self, text: str, pars: Sequence[str], source: Optional[str] = None,
+                 strict: bool = True) -> None:
+        # every row must close its last simulation, or it would run
+        # together with the next row
+        keywords = [_keyword(line) for line in text.splitlines()]
+        if [k for k in keywords if k is not None][-1:] != ['END']:
+            text = text.rstrip('\n') + '\nEND\n'
+            keywords.append('END')
+        super().__init__(text, pars, source=source, strict=strict)
+        self.num_simulations = keywords.count('END')
+        return
+
+    @staticmethod
+    def _strip_output_blocks(text: str) -> str:
+        # SELECTED_OUTPUT and USER_PUNCH definitions persist between
+        # simulations; redefining them would reopen (truncate) the file
+        lines = []
+        skipping = False
+        for line in text.splitlines(keepends=True):
+            keyword = _keyword(line)
+            if keyword is not None:
+                skipping = keyword in _OUTPUT_KEYWORDS
+            if not skipping:
+                lines.append(line)
+        return ''.join(lines)
+
+    def render_batch(self, values_mtrx: np.ndarray) -> str:
+        """
+        Render one input file running every row of values_mtrx, one after
+        the other, each as num_simulations simulations.
+        """
+        texts = [self.render(values_mtrx[0])]
+        texts += [self._strip_output_blocks(self.render(values)) for values in values_mtrx[1:]]
+        return ''.join(texts)
+
+    def split_output(self, output: np.ndarray, num_rows: int) -> List[np.ndarray]:
+        """
+        Split the [sim, analyte...] output of a batch rendered by
+        render_batch into one array per row, renumbering sims from 1 as if
+        each row had been run on its own.
+        """
+        k = self.num_simulations
+        bounds = np.searchsorted(output[0], np.arange(num_rows + 1) * k + 0.5)
+        parts = []
+        for j in range(num_rows):
+            part = output[:, bounds[j]:bounds[j + 1]].copy()
+            part[0] -= j * k
+            parts.append(part)
+        return parts
 
 
 class PHREEQC:
     """
     phreeqc invocation wrapper class
     """
-    def __init__(self, path: Optional[str] = None) -> None:
+    def __init__(self, path: Optional[str] = None, engine: Optional['Engine'] = None,
+                 timeout: Optional[float] = None) -> None:
         """
-        path: absolute path to phreeqc binary.
-              PATH will be searched if not provided.
+        path:    absolute path to phreeqc binary.
+                 PATH will be searched if not provided.
+        engine:  backend running phreeqc; defaults to a SubprocessEngine
+                 for the binary at path. See iphreeqc.IPhreeqcEngine for
+                 the in-process alternative.
+        timeout: seconds after which the default SubprocessEngine kills a
+                 run and raises subprocess.TimeoutExpired
         """
-        self._path = path
-        if self._path is None:
-            self._path = shutil.which(cmd='phreeqc')
-        if self._path is None:
-            raise RuntimeError('Cannot find phreeqc, please specify absolute path to phreeqc')
+        if engine is None:
+            engine = SubprocessEngine(path, timeout=timeout)
+        elif timeout is not None:
+            raise ValueError('pass the timeout to the engine')
+        self.engine = engine
+        self._path = getattr(engine, 'path', None)
         return
 
+    def identity(self) -> str:
+        """
+        Identify the phreeqc backend for caching purposes.
+        """
+        return self.engine.identity()
+
     @staticmethod
     def write_db_from_template(template_filename: str, pars: List[str], values: List[str],
                                outfile: Optional[str] = None) -> None:
@@ -69,12 +286,8 @@ class PHREEQC:
     # helper function to get col indices of "sim", "state", and "U" for use in readOutput
     # so it can be more robust with different phreeqc output formats
     @staticmethod
-    def _get_col_indices(file: IO, elems: List[str]) -> list:
-        # file: file object to read
-        # return: list of 2 indices and an analytes list for use in readOutput
-        c = file.readline()
-        headers = re.split(r"[\s,\"]+", c)
-
+    def _find_col_indices(headers: List[str], elems: List[str]) -> list:
+        # headers: header fields of the selected output
         # try to find the indices if they exist
         # otherwise print error message
         try:
@@ -103,8 +316,72 @@ class PHREEQC:
         return [sim, state, analytes]
 
     @staticmethod
-    def _filter_react_states(input_obs: List[str], idx: int) -> List[List[str]]:
-        return [x for x in [re.split(r"[\s,\"]+", line) for line in input_obs] if x[idx] == "react"]
+    def _split_fields(line: str) -> List[str]:
+        # same separators as the historical r"[\s,\"]+" split, without the
+        # empty leading/trailing fields
+        return line.replace(',', ' ').replace('"', ' ').split()
+
+    @classmethod
+    def _chunk_tokens(cls, lines: List[str], num_cols: int) -> List[str]:
+        # splits a block of selected-output rows into one flat, row-major
+        # list of fields; column i is then tokens[i::num_cols]. rows are
+        # split one at a time so a short or long row cannot shift the
+        # columns of its neighbours; blank rows are skipped
+        tokens: List[str] = []
+        for line in lines:
+            row = cls._split_fields(line)
+            if row and len(row) != num_cols:
+                raise ValueError('selected output row has {} fields, expected {}: {!r}'.format(
+                    len(row), num_cols, line.rstrip('\n')))
+            tokens.extend(row)
+        return tokens
+
+    @classmethod
+    def parse_output(cls, f: IO, analytes: Optional[List[str]] = None,
+                     chunk_rows: int = 65536) -> np.ndarray:
+        """
+        Parse selected output from an open file object; see read_output.
+        The header is resolved once, then rows are read chunk_rows at a time,
+        so memory use is bounded by the chunk size and the result itself.
+
+        f:          file object positioned at the header line
+        analytes:   list of analytes names to find; Defaults to U concentration
+        chunk_rows: number of lines parsed per block
+        return:     numpy array of simulation number vs analyte concentration
+        """
+        if analytes is None:
+            analytes = ['U']
+
+        headers = cls._split_fields(f.readline())
+        num_cols = len(headers)
+        i_sm, i_st, i_elems = cls._find_col_indices(headers, analytes)
+        cols = [i_sm] + i_elems
+
+        # preallocated; grown geometrically if the file has more react rows
+        opt = np.empty((len(cols), chunk_rows))
+        n = 0
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                break
+            tokens = cls._chunk_tokens(lines, num_cols)
+            num_rows = len(tokens) // num_cols
+
+            # filter out states for 'react' state (assuming all states are i_soln or react)
+            react = np.array(tokens[i_st::num_cols]) == 'react'
+            k = int(np.count_nonzero(react))
+            if n + k > opt.shape[1]:
+                grown = np.empty((len(cols), max(2 * opt.shape[1], n + k)))
+                grown[:, :n] = opt[:, :n]
+                opt = grown
+
+            # only the wanted columns are converted, each in one pass
+            for j, col in enumerate(cols):
+                values = np.fromiter(map(float, tokens[col::num_cols]), dtype=float, count=num_rows)
+                opt[j, n:n + k] = values[react]
+            n += k
+
+        return opt[:, :n].copy() if n < opt.shape[1] else opt
 
     @classmethod
     def read_output(cls, filename: str, analytes: Optional[List[str]] = None) -> np.ndarray:
@@ -116,35 +393,187 @@ class PHREEQC:
         analytes: list of analytes names to find; Defaults to U concentration
         return:   numpy array of simulation number vs analyte concentration
         """
-        if analytes is None:
-            analytes = ['U']
-
         with open(filename, 'r') as f:
             try:
-                # assign indices
-                i_sm, i_st, i_elems = cls._get_col_indices(f, analytes)
-            except ValueError:
-                raise ValueError("failed to parse columns of {}".format(filename))
+                return cls.parse_output(f, analytes)
+            except ValueError as e:
+                raise ValueError("failed to parse columns of {}: {}".format(filename, e))
+
+    @staticmethod
+    def find_selected_output_filename(in_filename: str) -> str:
+        with open(in_filename, 'r') as fd:
+            for line in fd.readlines():
+                m = re.match(r'\s*-file\s+(.*?)\s*$', line)
+                if m:
+                    return m.group(1)
+        return 'selected.out'
+
+    def _subprocess_engine(self) -> 'SubprocessEngine':
+        if not isinstance(self.engine, SubprocessEngine):
+            raise RuntimeError('run_phreeqc requires the subprocess engine')
+        return self.engine
+
+    def run_phreeqc(self, in_file: str, out_file: str,
+                    db_file: str, screen_output: Optional[str] = None,
+                    cwd: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Low-level method to invoke the phreeqc binary, see
+        SubprocessEngine.run_phreeqc.
+        """
+        return self._subprocess_engine().run_phreeqc(in_file, out_file, db_file, screen_output, cwd)
 
-            # finish reading the file if getColIndicies didn't error
-            input_obs = f.readlines()
+    async def run_phreeqc_async(self, in_file: str, out_file: str,
+                                db_file: str, screen_output: Optional[str] = None,
+                                cwd: Optional[str] = None) -> Tuple[str, str]:
+        """
+        asyncio counterpart of run_phreeqc.
+        """
+        return await self._subprocess_engine().run_phreeqc_async(in_file, out_file, db_file, screen_output, cwd)
+
+    def run(self, db_filename: str, in_filename: str, analytes: Optional[List[str]]=None,
+            cwd: Optional[str] = None) -> PHREEQCOutput:
+        """
+        Run phreeqc with input and database files.
+        Output will be output.out and output.sel.
+        Reads output into numpy array and returns a PHREEQCOutput.
+
+        db_filename: name of database to pass to phreeqc
+        in_filename: name of input file to pass to phreeqc
+        cwd:         directory to run phreeqc in; output files are written
+                     there. Defaults to the current working directory
+        return:      PHREEQCOutput
+        """
+        return self.engine.run(db_filename=db_filename, in_filename=in_filename, analytes=analytes, cwd=cwd)
 
-        # filter out states for 'react' state (assuming all states are i_soln or react)
-        obs = PHREEQC._filter_react_states(input_obs, i_st)
+    async def run_async(self, db_filename: str, in_filename: str, analytes: Optional[List[str]] = None,
+                        cwd: Optional[str] = None) -> PHREEQCOutput:
+        """
+        asyncio counterpart of run.
+        """
+        return await self.engine.run_async(db_filename=db_filename, in_filename=in_filename,
+                                           analytes=analytes, cwd=cwd)
 
-        # set up output matrix
+    def run_strings(self, db_text: str, input_text: str, analytes: Optional[List[str]] = None) -> PHREEQCOutput:
+        """
+        Run phreeqc on database and input text rather than files;
+        in-memory engines never touch the disk.
+        """
+        return self.engine.run_strings(db_text=db_text, input_text=input_text, analytes=analytes)
 
-        # column of simulation numbers
-        opt = np.array([int(row[i_sm]) for row in obs])
 
-        for i_elem in i_elems:
-            values = np.array([float(row[i_elem]) for row in obs])
-            opt = np.vstack((opt, values))
+class Engine(abc.ABC):
+    """
+    Backend running phreeqc for PHREEQC.
+
+    Engines with in_memory set work on database and input text directly
+    (run_strings) and only read files when asked to through run.
+    """
+    in_memory = False
+
+    @abc.abstractmethod
+    def run(self, db_filename: str, in_filename: str, analytes: Optional[List[str]] = None,
+            cwd: Optional[str] = None) -> PHREEQCOutput:
+        """
+        Run with db_filename.txt and in_filename, relative to cwd.
+        """
+
+    def run_strings(self, db_text: str, input_text: str, analytes: Optional[List[str]] = None) -> PHREEQCOutput:
+        """
+        Run with database and input text; by default through temporary files.
+        """
+        with tempfile.TemporaryDirectory(prefix='ml4scm-') as scratch:
+            start = time.perf_counter()
+            with open(os.path.join(scratch, 'database.txt'), 'w') as fd:
+                fd.write(db_text)
+            with open(os.path.join(scratch, 'input.pqi'), 'w') as fd:
+                fd.write(input_text)
+            render = time.perf_counter() - start
+            result = self.run(db_filename='database', in_filename='input.pqi', analytes=analytes, cwd=scratch)
+        result.timings['render'] = result.timings.get('render', 0.0) + render
+        result.bytes_written += len(db_text) + len(input_text)
+        return result
+
+    async def run_async(self, db_filename: str, in_filename: str, analytes: Optional[List[str]] = None,
+                        cwd: Optional[str] = None) -> PHREEQCOutput:
+        """
+        asyncio counterpart of run; by default run in the loop's executor.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.run, db_filename, in_filename, analytes, cwd))
+
+    @abc.abstractmethod
+    def identity(self) -> str:
+        """
+        A string identifying the backend and its version, for caching.
+        """
+
+
+class SubprocessEngine(Engine):
+    """
+    Runs the phreeqc executable once per run.
+    """
+    # bytes of stdout / stderr kept for the error of a failed run
+    FAILURE_TAIL = 1 << 16
+
+    def __init__(self, path: Optional[str] = None, timeout: Optional[float] = None, keep_files: bool = True,
+                 max_output: Optional[int] = None) -> None:
+        """
+        path:       absolute path to phreeqc binary.
+                    PATH will be searched if not provided.
+        timeout:    seconds after which a run is killed and
+                    subprocess.TimeoutExpired raised; no limit if not provided
+        keep_files: False sends the listing (output.out) to os.devnull and
+                    removes the selected output as soon as it is parsed
+        max_output: characters of stdout and stderr kept from a successful
+                    run; they are spooled to files next to the run rather than
+                    held in memory, and a failed run keeps the last
+                    FAILURE_TAIL bytes. Everything is kept if not provided
+        """
+        if path is None:
+            path = shutil.which(cmd='phreeqc')
+        if path is None:
+            raise RuntimeError('Cannot find phreeqc, please specify absolute path to phreeqc')
+        if timeout is not None and timeout <= 0:
+            raise ValueError('timeout must be positive')
+        if max_output is not None and max_output < 0:
+            raise ValueError('max_output must not be negative')
+        self.path = path
+        self.timeout = timeout
+        self.keep_files = keep_files
+        self.max_output = max_output
+        return
 
-        return opt
+    @property
+    def listing(self) -> str:
+        """
+        Output file passed to phreeqc.
+        """
+        return 'output.out' if self.keep_files else os.devnull
+
+    def _spooled_output(self, out: IO[bytes], err: IO[bytes], returncode: int, args: List[str]) -> Tuple[str, str]:
+        # the start of spooled stdout / stderr, or the end for a failed run
+        def read(f: IO[bytes], tail: bool) -> str:
+            if tail:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(f.tell() - self.FAILURE_TAIL, 0))
+                return f.read().decode(errors='replace')
+            f.seek(0)
+            return f.read(self.max_output or 0).decode(errors='replace')
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args, read(out, True), read(err, True))
+        return read(out, False), read(err, False)
+
+    def identity(self) -> str:
+        """
+        Identify the phreeqc binary for caching purposes: its path,
+        size and modification time.
+        """
+        st = os.stat(self.path)
+        return f'{os.path.realpath(self.path)}:{st.st_size}:{st.st_mtime_ns}'
 
     def run_phreeqc(self, in_file: str, out_file: str,
-                    db_file: str, screen_output: Optional[str] = None) -> Tuple[str, str]:
+                    db_file: str, screen_output: Optional[str] = None,
+                    cwd: Optional[str] = None) -> Tuple[str, str]:
         """
         Low-level method to invoke phreeqc.
         Takes the same arguments as the phreeqc binary itself.
@@ -155,53 +584,146 @@ class PHREEQC:
         out_file:      output file for phreeqc
         db_file:       database file
         screen_output: screen output file
+        cwd:           working directory for phreeqc; relative file names
+                       are resolved against it. Defaults to the current
+                       working directory
         return:        a tuple of stdout, stderr
         """
 
-        if not os.path.exists(in_file):
+        if not os.path.exists(os.path.join(cwd or '', in_file)):
             raise ValueError(f'in_file: {in_file} not found')
-        if not os.path.exists(db_file):
+        if not os.path.exists(os.path.join(cwd or '', db_file)):
             raise ValueError(f'db_file: {db_file} not found')
 
-        args = [cast(str, self._path), in_file, out_file, db_file]
+        args = [self.path, in_file, out_file, db_file]
         if screen_output is not None:
             args.append(screen_output)
 
+        if self.max_output is not None:
+            with tempfile.TemporaryFile(dir=cwd) as out, tempfile.TemporaryFile(dir=cwd) as err:
+                proc = subprocess.run(args=args, shell=False, stdin=None, stdout=out, stderr=err, cwd=cwd,
+                                      timeout=self.timeout)
+                return self._spooled_output(out, err, proc.returncode, args)
+
         pid = subprocess.run(
                 args=args,
                 shell=False,
                 check=True,
                 stdin=None,
                 capture_output=True,
-                text=True
+                text=True,
+                cwd=cwd,
+                timeout=self.timeout
         )
 
         return pid.stdout, pid.stderr
 
-    @staticmethod
-    def find_selected_output_filename(in_filename: str) -> str:
-        with open(in_filename, 'r') as fd:
-            for line in fd.readlines():
-                m = re.match(r'\s*-file\s+(.*?)\s*$', line)
-                if m:
-                    return m.group(1)
-        return 'selected.out'
+    async def run_phreeqc_async(self, in_file: str, out_file: str,
+                                db_file: str, screen_output: Optional[str] = None,
+                                cwd: Optional[str] = None) -> Tuple[str, str]:
+        """
+        asyncio counterpart of run_phreeqc; the process is killed if the
+        awaiting task is cancelled.
+        """
+        if not os.path.exists(os.path.join(cwd or '', in_file)):
+            raise ValueError(f'in_file: {in_file} not found')
+        if not os.path.exists(os.path.join(cwd or '', db_file)):
+            raise ValueError(f'db_file: {db_file} not found')
+
+        args = [self.path, in_file, out_file, db_file]
+        if screen_output is not None:
+            args.append(screen_output)
+
+        if self.max_output is not None:
+            with tempfile.TemporaryFile(dir=cwd) as out, tempfile.TemporaryFile(dir=cwd) as err:
+                proc = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                            stdout=out, stderr=err, cwd=cwd)
+                await self._wait(proc, proc.wait(), args)
+                return self._spooled_output(out, err, cast(int, proc.returncode), args)
+
+        proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=cwd
+        )
+        out, err = await self._wait(proc, proc.communicate(), args)
+
+        stdout, stderr = out.decode(), err.decode()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(cast(int, proc.returncode), args, stdout, stderr)
+        return stdout, stderr
 
-    def run(self, db_filename: str, in_filename: str, analytes: Optional[List[str]]=None) -> PHREEQCOutput:
+    async def _wait(self, proc: asyncio.subprocess.Process, done: Any, args: List[str]) -> Any:
+        # awaits done, killing the process on timeout or cancellation
+        try:
+            return await asyncio.wait_for(done, self.timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise subprocess.TimeoutExpired(args, cast(float, self.timeout))
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+    def run(self, db_filename: str, in_filename: str, analytes: Optional[List[str]]=None,
+            cwd: Optional[str] = None) -> PHREEQCOutput:
         """
-        Run phreeqc with input and database files.
+        Run the phreeqc binary with input and database files.
         Output will be output.out and output.sel.
         Reads output into numpy array and returns a PHREEQCOutput.
 
         db_filename: name of database to pass to phreeqc
         in_filename: name of input file to pass to phreeqc
+        cwd:         directory to run phreeqc in; output files are written
+                     there. Defaults to the current working directory
         return:      PHREEQCOutput
         """
+        start = time.perf_counter()
         stdout, stderr = self.run_phreeqc(
             in_file=in_filename,
-            out_file='output.out',
-            db_file=f'{db_filename}.txt'
+            out_file=self.listing,
+            db_file=f'{db_filename}.txt',
+            cwd=cwd
+        )
+        ran = time.perf_counter()
+        output, consumed = self._read_selected_output(in_filename, analytes, cwd)
+
+        return PHREEQCOutput(stderr=stderr, stdout=stdout, output=output,
+                             timings={'run': ran - start, 'parse': time.perf_counter() - ran},
+                             bytes_read=consumed)
+
+    def _read_selected_output(self, in_filename: str, analytes: Optional[List[str]],
+                              cwd: Optional[str]) -> Tuple[np.ndarray, int]:
+        # finds, parses and (unless kept) removes the selected output of a
+        # finished run; returns the parsed output and its size in bytes
+        sel_filename = PHREEQC.find_selected_output_filename(os.path.join(cwd or '', in_filename))
+        sel_filename = os.path.join(cwd or '', sel_filename)
+        output = PHREEQC.read_output(sel_filename, analytes)
+        size = os.path.getsize(sel_filename)
+        if not self.keep_files:
+            os.remove(sel_filename)
+        return output, size
+
+    async def run_async(self, db_filename: str, in_filename: str, analytes: Optional[List[str]] = None,
+                        cwd: Optional[str] = None) -> PHREEQCOutput:
+        """
+        asyncio counterpart of run; the selected output is found, parsed
+        and removed in the default executor so the event loop is not blocked.
+        """
+        start = time.perf_counter()
+        stdout, stderr = await self.run_phreeqc_async(
+            in_file=in_filename,
+            out_file=self.listing,
+            db_file=f'{db_filename}.txt',
+            cwd=cwd
         )
-        output = self.read_output(self.find_selected_output_filename(in_filename), analytes)
+        ran = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        output, consumed = await loop.run_in_executor(None, self._read_selected_output, in_filename, analytes, cwd)
 
-        return PHREEQCOutput(stderr=stderr, stdout=stdout, output=output)
\ No newline at end of file
+        return PHREEQCOutput(stderr=stderr, stdout=stdout, output=output,
+                             timings={'run': ran - start, 'parse': time.perf_counter() - ran},
+                             bytes_read=consumed)
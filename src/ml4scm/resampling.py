@@ -0,0 +1,81 @@
+import numpy as np
+from typing import Callable, Dict, Optional, cast
+
+from .sampling import Seed, make_rng
+
+
+def _cumulative(weights: np.ndarray) -> np.ndarray:
+    w = np.asarray(weights, dtype=float).ravel()
+    if np.any(w < 0) or not np.sum(w) > 0:
+        raise ValueError('weights must be non-negative with a positive sum')
+    c = np.cumsum(w / np.sum(w))
+    c[-1] = 1.0  # guard against round-off leaving the last bin short
+    return cast(np.ndarray, c)
+
+
+def _invert(weights: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    # index of the bin of the cumulative weights each position falls into
+    c = _cumulative(weights)
+    return cast(np.ndarray, np.minimum(np.searchsorted(c, positions, side='right'), len(c) - 1))
+
+
+def multinomial(weights: np.ndarray, num: int, rng: np.random.Generator) -> np.ndarray:
+    '''
+    num independent draws, each index chosen with probability weights[i]
+    '''
+    return _invert(weights, rng.random(num))
+
+
+def systematic(weights: np.ndarray, num: int, rng: np.random.Generator) -> np.ndarray:
+    '''
+    one uniform offset shared by num evenly spaced positions; lowest variance
+    '''
+    return _invert(weights, (rng.random() + np.arange(num)) / num)
+
+
+def stratified(weights: np.ndarray, num: int, rng: np.random.Generator) -> np.ndarray:
+    '''
+    one independent uniform draw inside each of num equal strata
+    '''
+    return _invert(weights, (rng.random(num) + np.arange(num)) / num)
+
+
+RESAMPLERS: Dict[str, Callable[[np.ndarray, int, np.random.Generator], np.ndarray]] = {
+    'multinomial': multinomial,
+    'systematic': systematic,
+    'stratified': stratified,
+}
+
+
+def resample(weights: np.ndarray, num: Optional[int] = None, scheme: str = 'multinomial',
+             rng: Seed = None) -> np.ndarray:
+    '''
+    Draw a whole generation of particle indices in one call.
+
+    weights: non-negative particle weights; normalized here
+    num:     number of indices to draw; defaults to len(weights)
+    scheme:  'multinomial', 'systematic' or 'stratified'
+    rng:     seed or numpy Generator
+    return:  (num,) array of indices into weights
+    '''
+    if scheme not in RESAMPLERS:
+        raise ValueError('unknown resampling scheme {}; expected one of {}'.format(scheme, sorted(RESAMPLERS)))
+    if num is None:
+        num = np.size(weights)
+    return RESAMPLERS[scheme](weights, num, make_rng(rng))
+
+
+def resample_history(weights: np.ndarray, num_trials: int, scheme: str = 'multinomial',
+                     rng: Seed = None) -> np.ndarray:
+    '''
+    num_trials generations of indices resampled from fixed weights, written
+    into one preallocated (num_trials, len(weights)) array. Row 0 is the
+    identity, every later row is an independent generation.
+    '''
+    rng = make_rng(rng)
+    n = np.size(weights)
+    history = np.empty((max(num_trials, 1), n), dtype=int)
+    history[0] = np.arange(n)
+    for t in range(1, num_trials):
+        history[t] = resample(weights, n, scheme, rng)
+    return history
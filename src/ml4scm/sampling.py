@@ -0,0 +1,116 @@
+import numpy as np
+from typing import Any, Callable, Dict, Iterator, Sequence, Tuple, Union, cast
+
+# anything np.random.default_rng accepts: None, a seed or a Generator
+Seed = Union[None, int, np.random.SeedSequence, np.random.Generator]
+
+
+def make_rng(rng: Seed = None) -> np.random.Generator:
+    '''
+    Return a numpy Generator; seeds are turned into a fresh Generator,
+    Generators are passed through unchanged.
+    '''
+    return np.random.default_rng(rng)
+
+
+def _bounds_arrays(bounds: Sequence[Any]) -> Tuple[np.ndarray, np.ndarray]:
+    # bounds: sequence of simulation.Bound (anything with lower and upper)
+    lower = np.array([b.lower for b in bounds], dtype=float)
+    upper = np.array([b.upper for b in bounds], dtype=float)
+    return lower, upper
+
+
+def _scale(unit: np.ndarray, bounds: Sequence[Any]) -> np.ndarray:
+    lower, upper = _bounds_arrays(bounds)
+    return cast(np.ndarray, lower + unit * (upper - lower))
+
+
+def uniform(bounds: Sequence[Any], num_sets: int, rng: Seed = None) -> np.ndarray:
+    '''
+    num_sets by len(bounds) matrix of independent uniform draws within bounds
+    '''
+    return _scale(make_rng(rng).random((num_sets, len(bounds))), bounds)
+
+
+def latin_hypercube(bounds: Sequence[Any], num_sets: int, rng: Seed = None) -> np.ndarray:
+    '''
+    Latin hypercube design: every parameter range is cut into num_sets
+    equal strata and each stratum is sampled exactly once.
+    '''
+    rng = make_rng(rng)
+    # an independent random permutation of the strata per column
+    strata = np.argsort(rng.random((num_sets, len(bounds))), axis=0)
+    return _scale((strata + rng.random((num_sets, len(bounds)))) / num_sets, bounds)
+
+
+def _sobol_engine(dims: int, rng: Seed) -> Any:
+    try:
+        from scipy.stats import qmc
+    except ImportError:  # pragma: no cover
+        raise RuntimeError('Sobol sampling requires scipy >= 1.7')
+    return qmc.Sobol(d=dims, scramble=True, seed=make_rng(rng))
+
+
+def sobol(bounds: Sequence[Any], num_sets: int, rng: Seed = None) -> np.ndarray:
+    '''
+    Scrambled Sobol design; num_sets should be a power of 2 for the
+    sequence to keep its balance properties.
+    '''
+    return _scale(_sobol_engine(len(bounds), rng).random(num_sets), bounds)
+
+
+def grid(bounds: Sequence[Any], num_sets: int, rng: Seed = None, pool_size: int = 100) -> np.ndarray:
+    '''
+    Draw every parameter independently from pool_size evenly spaced values
+    between its bounds (the scheme bayes_resample starts from).
+    '''
+    lower, upper = _bounds_arrays(bounds)
+    levels = make_rng(rng).integers(pool_size, size=(num_sets, len(bounds)))
+    step = (upper - lower) / max(pool_size - 1, 1)
+    return cast(np.ndarray, lower + levels * step)
+
+
+SAMPLERS: Dict[str, Callable[..., np.ndarray]] = {
+    'uniform': uniform,
+    'lhs': latin_hypercube,
+    'latin_hypercube': latin_hypercube,
+    'sobol': sobol,
+    'grid': grid,
+}
+
+
+def sample(bounds: Sequence[Any], num_sets: int, method: str = 'uniform', rng: Seed = None,
+           **kwargs: Any) -> np.ndarray:
+    '''
+    Draw a num_sets by len(bounds) design with one of SAMPLERS.
+
+    bounds:   list of Bound, e.g. Problem.bounds
+    num_sets: number of parameter sets (rows)
+    method:   'uniform', 'lhs', 'sobol' or 'grid'
+    rng:      seed or numpy Generator
+    kwargs:   passed on to the sampler, e.g. pool_size for 'grid'
+    '''
+    if method not in SAMPLERS:
+        raise ValueError('unknown sampling method {}; expected one of {}'.format(method, sorted(SAMPLERS)))
+    return SAMPLERS[method](bounds, num_sets, rng=rng, **kwargs)
+
+
+def iter_design(bounds: Sequence[Any], num_sets: int, chunk_size: int, method: str = 'uniform',
+                rng: Seed = None, **kwargs: Any) -> Iterator[np.ndarray]:
+    '''
+    Yield a num_sets row design in chunks of at most chunk_size rows,
+    so very large ensembles never have to be held in memory at once.
+
+    Sobol chunks continue a single sequence; Latin hypercube chunks are
+    each a hypercube of their own.
+    '''
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be a positive integer')
+    rng = make_rng(rng)
+    engine = _sobol_engine(len(bounds), rng) if method == 'sobol' else None
+    for start in range(0, num_sets, chunk_size):
+        n = min(chunk_size, num_sets - start)
+        if engine is not None:
+            yield _scale(engine.random(n), bounds)
+        else:
+            yield sample(bounds, n, method=method, rng=rng, **kwargs)
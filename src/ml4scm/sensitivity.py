@@ -1,27 +1,45 @@
 from SALib.analyze import morris as sam
 from SALib.analyze import sobol as sas
+from SALib.sample import morris as morris_sample
+from SALib.sample import sobol as sobol_sample
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from scipy.stats import norm
+import os.path
 
 import numpy as np
 
-from .simulation import SimulationRunner
+from .simulation import ResultSet, SimulationRunner
+from .store import EnsembleStore
+from . import sampling
 
 
 # runs run_sims and formats analyte results into matrix of iteration# and observation
 # save matrix results into file
 # write function to load file later
-def ensemble_sim(phreeqc, problem, params, analyte=['U'], savefile=''):
+def ensemble_sim(phreeqc, problem, params, analyte=['U'], savefile='', store='', retries=0, on_error='raise'):
     # analyte: single analyte to measure; name of colummn from phreeqc .sel output file
     # savefile: saves results array to a .npy file. needs to contain '.npy' in name
     #    also saves params array as 'savefile_p.npy'
+    # store: directory of an EnsembleStore; every run is flushed there as it
+    #    finishes and calling again after a crash only runs the missing rows.
+    #    the result is then memory-mapped from the store
+    # retries, on_error: see SimulationRunner; with on_error='mask' runs that
+    #    keep failing are nan rows, which the analyses below leave out with
+    #    their trajectory or saltelli block
     # return: #simulations by #observations matrix
 
-    sim = SimulationRunner(phreeqc)
-    sims = sim.run_problem(problem=problem, values=params, analytes=analyte)
-
-    # [0][1] index of run_sims will be the list of analyte values
-    output = sims[0][1]
-    for sim in sims[1:]:
-        output = np.vstack((output, sim[1]))
+    sim = SimulationRunner(phreeqc, retries=retries, on_error=on_error)
+    if store:
+        ensemble = EnsembleStore.open(store, params, analyte)
+        ensemble.run(sim, problem)
+        results = ensemble.result_set()
+    else:
+        # runs are written into one preallocated array as they finish
+        results = sim.run_results(problem=problem, values=params, analytes=analyte)
+    # the first analyte of each run is its row of observations
+    output = results[results.analytes[0]]
 
     if savefile:
         if ".npy" in savefile:
@@ -42,16 +60,58 @@ def load_sim(savefile):
     return np.load(savefile)
 
 
+def _observations(Y):
+    # Y: #simulations by #observations matrix, or an EnsembleStore whose
+    # first analyte is read lazily, one observation column at a time
+    if isinstance(Y, EnsembleStore):
+        return Y.observations()
+    return Y
+
+
+# bytes of observations a vectorized analysis reads into memory at once;
+# a memory-mapped Y is read in blocks of whole columns of about this size
+_BLOCK_BYTES = 64 * 2 ** 20
+
+
+def _column_blocks(Y):
+    # column slices of the 2-d Y, each holding about _BLOCK_BYTES of float64
+    width = max(1, _BLOCK_BYTES // (8 * max(len(Y), 1)))
+    return [slice(i, i + width) for i in range(0, max(Y.shape[1], 1), width)]
+
+
+def _complete_groups(Y, size):
+    # mask of the rows of Y in groups of size consecutive rows (morris
+    # trajectories, saltelli blocks) without a failed run; runs that failed
+    # (SimulationRunner(on_error='mask')) are nan rows of ensemble_sim and
+    # the groups holding them are left out of the analyses
+    Y = np.asanyarray(Y)
+    Y = Y.reshape(len(Y), int(np.prod(Y.shape[1:])))
+    failed = np.zeros(len(Y), dtype=bool)
+    for cols in _column_blocks(Y):
+        failed |= np.isnan(np.asarray(Y[:, cols], dtype=float)).any(axis=1)
+    if not failed.any() or len(Y) % size:
+        return np.ones(len(Y), dtype=bool)
+    keep = ~failed.reshape(-1, size).any(axis=1)
+    if not keep.any():
+        raise ValueError('every group of {} runs holds a failed run'.format(size))
+    return np.repeat(keep, size)
+
+
 # generates a list of morris result dictionaries per parameter
 def morris_analysis(problem, X, Y):
+    Y = _observations(Y)
+    keep = _complete_groups(Y, problem.num_vars + 1)
+    if not keep.all():
+        X, Y = np.asarray(X)[keep], np.asarray(Y)[keep]
+    salib = problem.to_salib()
     # Perform Morris analysis on first parameter
-    morris_result = [sam.analyze(problem.to_salib(), X, Y.T[0], conf_level=0.95, num_levels=4,
+    morris_result = [sam.analyze(salib, X, Y.T[0], conf_level=0.95, num_levels=4,
                                  print_to_console=False)]
 
     # Storing the sensitivity indices as a list of dictionaries
     # each dictionary represents the results for one observation
     for i_obs in range(1, np.shape(Y)[1]):
-        Si = sam.analyze(problem.to_salib(), X, Y.T[i_obs], conf_level=0.95, num_levels=4,
+        Si = sam.analyze(salib, X, Y.T[i_obs], conf_level=0.95, num_levels=4,
                          print_to_console=False)
         morris_result.append(Si)
 
@@ -78,15 +138,253 @@ def morris_summary(morris_res):
 
 
 def sobol_analysis(problem, X, Y):
+    Y = _observations(Y)
+    keep = _complete_groups(Y, 2 * problem.num_vars + 2)
+    if not keep.all():
+        Y = np.asarray(Y)[keep]
+    salib = problem.to_salib()
     # Perform sobol analysis on parameter 1
-    sobol_result = [sas.analyze(problem.to_salib(), Y.T[0], conf_level=0.95, print_to_console=False)]
+    sobol_result = [sas.analyze(salib, Y.T[0], conf_level=0.95, print_to_console=False)]
 
     # Storing the sensitivity indices as a list of dictionaries
     # each dictionary represents the results for one observation
     # returning this list instead gets a lot more information, but it might not
     # be necessary for now
     for i_obs in range(1, np.shape(Y)[1]):
-        Si = sas.analyze(problem.to_salib(), Y.T[i_obs], conf_level=0.95, print_to_console=False)
+        Si = sas.analyze(salib, Y.T[i_obs], conf_level=0.95, print_to_console=False)
         sobol_result.append(Si)
 
-    return sobol_result
\ No newline at end of file
+    return sobol_result
+
+
+# resamples evaluated per bootstrap task; bounds the memory of one task to
+# about _BOOTSTRAP_CHUNK copies of the resampled outputs
+_BOOTSTRAP_CHUNK = 10
+
+
+def _bootstrap_index(num_samples, num_resamples, rng):
+    # num_resamples index rows drawn with replacement from range(num_samples),
+    # drawn once and shared by every parameter and every block of columns
+    return sampling.make_rng(rng).integers(num_samples, size=(num_resamples, num_samples))
+
+
+def _bootstrap_pool(max_workers):
+    # process pool for _bootstrap when max_workers > 1, otherwise a context
+    # giving None so the bootstrap runs here
+    if max_workers is not None and max_workers > 1:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return nullcontext()
+
+
+def _bootstrap(func, data, index, pool=None):
+    # evaluates func(*data, index) for chunks of the index rows, spread over
+    # pool if one is given
+    # return: func results stacked along the first (resample) axis
+    chunks = [index[i:i + _BOOTSTRAP_CHUNK] for i in range(0, len(index), _BOOTSTRAP_CHUNK)]
+    task = partial(func, *data)
+    return np.concatenate(list(map(task, chunks) if pool is None else pool.map(task, chunks)))
+
+
+def _conf(resampled, conf_level):
+    # half width of the conf_level interval from the spread of the resamples
+    if not 0 < conf_level < 1:
+        raise ValueError('conf_level must be between 0 and 1')
+    return norm.ppf(0.5 + conf_level / 2) * resampled.std(axis=0, ddof=1)
+
+
+def _morris_mu_star(ee, index):
+    # mu_star of resampled trajectories; ee: (params, trajectories, outputs)
+    # return: (len(index), params, outputs)
+    return np.abs(ee[:, index, :]).mean(axis=2).transpose(1, 0, 2)
+
+
+def morris_matrices(problem, X, Y, num_levels=4, num_resamples=100, conf_level=0.95, rng=None,
+                    max_workers=None):
+    # Morris elementary effects of every observation column of Y at once, a
+    # vectorized counterpart of morris_summary(morris_analysis(problem, X, Y))
+    # X: morris sample of problem, one trajectory of num_vars + 1 rows after another
+    # Y: #simulations by #observations matrix, or an EnsembleStore; a
+    #    memory-mapped Y is read a block of columns at a time
+    # num_resamples, conf_level: bootstrap of the mu_star confidence interval
+    # rng: seed or numpy Generator for the bootstrap
+    # max_workers: worker processes for the bootstrap; None or 1 runs it here
+    # return: mu, mu_star, sigma, mu_star_conf matrices by (parameter, observation)
+    Y = np.asanyarray(_observations(Y))
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    X = np.asarray(X, dtype=float)
+    k = problem.num_vars
+    if len(X) != len(Y) or len(Y) % (k + 1):
+        raise ValueError('X and Y must hold the same whole number of trajectories of {} rows'.format(k + 1))
+    keep = _complete_groups(Y, k + 1)
+    X = X[keep]
+    num_trajectories = len(X) // (k + 1)
+    delta = num_levels / (2.0 * (num_levels - 1))
+    index = _bootstrap_index(num_trajectories, num_resamples, rng)
+
+    # every step of a trajectory moves exactly one parameter, up or down
+    dX = np.sign(np.diff(X.reshape(num_trajectories, k + 1, k), axis=1))
+    results = []
+    with _bootstrap_pool(max_workers) as pool:
+        for cols in _column_blocks(Y):
+            dY = np.diff(np.asarray(Y[:, cols], dtype=float)[keep].reshape(num_trajectories, k + 1, -1), axis=1)
+            ee = np.einsum('tsj,tso->jto', dX, dY) / delta
+            resampled = _bootstrap(_morris_mu_star, (ee,), index, pool)
+            results.append((ee.mean(axis=1), np.abs(ee).mean(axis=1), ee.std(axis=1, ddof=1),
+                            _conf(resampled, conf_level)))
+    # mu, mu_star, sigma and mu_star_conf of the blocks, side by side
+    return tuple(np.concatenate(m, axis=-1) for m in zip(*results))
+
+
+def _divide_var(x, y_var):
+    # x / y_var, 0 where the output is constant
+    return np.divide(x, y_var, out=np.zeros(np.broadcast(x, y_var).shape), where=y_var > np.finfo(float).eps)
+
+
+def _sobol_indices(A, B, AB, BA):
+    # Saltelli 2010 first and total order and Saltelli 2002 second order
+    # estimators for all parameters and outputs at once
+    # A, B: (..., N, outputs); AB, BA: (..., N, params, outputs)
+    # return: S1, ST (..., params, outputs) and S2 (..., params, params, outputs)
+    y_var = np.concatenate([A, B], axis=-2).var(axis=-2)[..., None, :]
+    S1 = _divide_var(np.mean(B[..., None, :] * (AB - A[..., None, :]), axis=-3), y_var)
+    ST = _divide_var(0.5 * np.mean(np.square(A[..., None, :] - AB), axis=-3), y_var)
+    if BA is None:
+        return S1, ST, None
+    n = A.shape[-2]
+    Vjk = np.einsum('...njo,...nko->...jko', BA, AB) / n - np.mean(A * B, axis=-2)[..., None, None, :]
+    S2 = _divide_var(Vjk, y_var[..., None, :, :]) - S1[..., :, None, :] - S1[..., None, :, :]
+    return S1, ST, S2
+
+
+def _sobol_resampled(A, B, AB, BA, index):
+    # indices of resampled base samples; index: (resamples, N)
+    # return: (resamples, 2 [+ params], params, outputs) holding S1, ST [and S2]
+    S1, ST, S2 = _sobol_indices(A[index], B[index], AB[index], None if BA is None else BA[index])
+    S = np.stack([S1, ST], axis=1)
+    return S if S2 is None else np.concatenate([S, S2], axis=1)
+
+
+def sobol_matrices(problem, Y, calc_second_order=True, num_resamples=100, conf_level=0.95, rng=None,
+                   max_workers=None):
+    # Sobol indices of every observation column of Y at once, a vectorized
+    # counterpart of sobol_analysis
+    # Y: #simulations by #observations matrix from a saltelli sample of problem,
+    #    or an EnsembleStore; a memory-mapped Y is read a block of columns at a time
+    # calc_second_order: must match the option used for sampling
+    # num_resamples, conf_level: bootstrap of the confidence intervals
+    # rng: seed or numpy Generator for the bootstrap
+    # max_workers: worker processes for the bootstrap; None or 1 runs it here
+    # return: dict with the keys of SALib's sobol.analyze; S1, S1_conf, ST and
+    #    ST_conf are (parameter, observation) matrices, S2 and S2_conf are
+    #    (parameter, parameter, observation) with nan below the diagonal
+    Y = np.asanyarray(_observations(Y))
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    D = problem.num_vars
+    step = 2 * D + 2 if calc_second_order else D + 2
+    if len(Y) % step:
+        raise ValueError('Y must hold a whole number of saltelli blocks of {} rows; '
+                         'check calc_second_order matches the sample'.format(step))
+    keep = _complete_groups(Y, step)
+    N = int(np.sum(keep)) // step
+    index = _bootstrap_index(N, num_resamples, rng)
+
+    parts = []
+    with _bootstrap_pool(max_workers) as pool:
+        for cols in _column_blocks(Y):
+            # standardize each output as SALib does per column
+            Yb = np.asarray(Y[:, cols], dtype=float)[keep]
+            std = Yb.std(axis=0)
+            Yb = (Yb - Yb.mean(axis=0)) / np.where(std > 0, std, 1.0)
+            blocks = Yb.reshape(N, step, -1)
+            A, B, AB = blocks[:, 0], blocks[:, -1], blocks[:, 1:D + 1]
+            BA = blocks[:, D + 1:2 * D + 1] if calc_second_order else None
+
+            S1, ST, S2 = _sobol_indices(A, B, AB, BA)
+            resampled = _bootstrap(_sobol_resampled, (A, B, AB, BA), index, pool)
+            part = {'S1': S1, 'S1_conf': _conf(resampled[:, 0], conf_level),
+                    'ST': ST, 'ST_conf': _conf(resampled[:, 1], conf_level)}
+            if calc_second_order:
+                part['S2'], part['S2_conf'] = S2, _conf(resampled[:, 2:], conf_level)
+            parts.append(part)
+    # the blocks' indices side by side along the observation axis
+    result = {key: np.concatenate([part[key] for part in parts], axis=-1) for key in parts[0]}
+    if calc_second_order:
+        # only j < k pairs are estimated, as in SALib
+        upper = np.triu(np.ones((D, D), dtype=bool), k=1)[:, :, None]
+        result['S2'] = np.where(upper, result['S2'], np.nan)
+        result['S2_conf'] = np.where(upper, result['S2_conf'], np.nan)
+    return result
+
+
+def evaluate_design(sim, problem, X, analyte='U', store='', chunk_size=1000, dtype=np.float64):
+    # runs a sample design, simulating every distinct point only once
+    # X: design matrix with one parameter set per row, e.g. from a SALib sampler
+    # analyte: name of the selected-output column to observe
+    # store: directory of an EnsembleStore keyed by point; runs are flushed there
+    #    as they finish, and points already in it (an interrupted run, or the
+    #    smaller design when N grows) are not run again
+    # chunk_size: maximum number of points handed to sim at once
+    # dtype: dtype the observations are kept as without a store, e.g.
+    #    np.float32 to halve the memory of a large design
+    # return: #rows of X by #observations matrix, in design order
+    X = np.asarray(X, dtype=float)
+    points, inverse = np.unique(X, axis=0, return_inverse=True)
+    inverse = np.ravel(inverse)
+    if not store:
+        # the first chunk with a run that did not fail sizes the ensemble,
+        # later ones are collected straight into their slice of it. rows of
+        # chunks in which every run failed stay nan
+        results = None
+        for start in range(0, len(points), chunk_size):
+            rows = slice(start, start + chunk_size)
+            out = None if results is None else results.data[rows]
+            part = sim.run_results(problem, points[rows], [analyte], dtype=dtype, out=out)
+            if results is None and part.num_steps:
+                results = ResultSet(np.full((len(points),) + part.data.shape[1:], np.nan, dtype=dtype),
+                                    [analyte], points)
+                results.data[rows] = part.data
+        if results is None:
+            results = ResultSet(np.empty((len(points), 0, 1), dtype=dtype), [analyte], points)
+        return results[analyte][inverse]
+
+    if os.path.exists(os.path.join(store, 'params.npy')):
+        ensemble = EnsembleStore(store)
+        if ensemble.analytes != [analyte]:
+            raise ValueError('{} holds runs of {}, not {}'.format(store, ensemble.analytes, analyte))
+    else:
+        ensemble = EnsembleStore.open(store, points[:0], [analyte])
+    # rows of the store for every point, adding the points it does not hold yet
+    row_of = {p.tobytes(): i for i, p in enumerate(np.asarray(ensemble.params))}
+    new = [p for p in points if p.tobytes() not in row_of]
+    row_of.update((p.tobytes(), len(ensemble) + i) for i, p in enumerate(new))
+    ensemble.extend(np.array(new))
+    results = ensemble.run(sim, problem, chunk_size=chunk_size)
+    rows = np.array([row_of[p.tobytes()] for p in points], dtype=int)
+    return np.asarray(results[rows[inverse], :, 0])
+
+
+def morris_pipeline(sim, problem, num_trajectories, num_levels=4, analyte='U', store='', seed=None,
+                    chunk_size=1000, **kwargs):
+    # samples a Morris design for problem, runs its distinct points and
+    # analyses every observation
+    # kwargs: passed on to morris_matrices, e.g. num_resamples or max_workers
+    # return: X, Y and the mu, mu_star, sigma, mu_star_conf matrices
+    X = morris_sample.sample(problem.to_salib(), num_trajectories, num_levels=num_levels, seed=seed)
+    Y = evaluate_design(sim, problem, X, analyte=analyte, store=store, chunk_size=chunk_size)
+    return X, Y, morris_matrices(problem, X, Y, num_levels=num_levels, rng=seed, **kwargs)
+
+
+def sobol_pipeline(sim, problem, N, calc_second_order=True, analyte='U', store='', seed=None,
+                   chunk_size=1000, **kwargs):
+    # samples a Saltelli design of N base samples for problem, runs it and
+    # analyses every observation. the design for 2 * N with the same seed
+    # starts with the design for N, so with a store doubling N only runs the
+    # new half
+    # N: base samples, a power of 2
+    # kwargs: passed on to sobol_matrices, e.g. num_resamples or max_workers
+    # return: X, Y and the sobol_matrices dict
+    X = sobol_sample.sample(problem.to_salib(), N, calc_second_order=calc_second_order, seed=seed)
+    Y = evaluate_design(sim, problem, X, analyte=analyte, store=store, chunk_size=chunk_size)
+    return X, Y, sobol_matrices(problem, Y, calc_second_order=calc_second_order, rng=seed, **kwargs)
@@ -1,10 +1,24 @@
 from functools import reduce
-from typing import List, Optional, Dict, Any, cast
-from dataclasses import dataclass, astuple
+from typing import Iterable, Iterator, List, Optional, Dict, Set, Tuple, Any, cast, TYPE_CHECKING
+from dataclasses import dataclass, astuple, field
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import asyncio
+import os.path
+import shutil
+import tempfile
+import hashlib
+import threading
+import time
 
 import numpy as np
 
-from .phreeqc import PHREEQC
+from .phreeqc import PHREEQC, DatabaseTemplate, InputTemplate
+from .cache import RunCache
+from .metrics import RunEvent, RunMetrics, RunObserver, RunStats
+from . import sampling
+
+if TYPE_CHECKING:
+    from .cluster import Coordinator
 
 ###############################################################################
 @dataclass
@@ -26,6 +40,12 @@ class Problem:
     db_template_filename: str
     output_filename: str
     input_filename: str
+    # optional input file template (input_template_filename.tpl); when given,
+    # parameters may appear in it as well as in the database template and the
+    # rendered input is written to input_filename
+    input_template_filename: Optional[str] = None
+    _db_template: Optional[DatabaseTemplate] = field(default=None, init=False, repr=False, compare=False)
+    _input_template: Optional[InputTemplate] = field(default=None, init=False, repr=False, compare=False)
 
     ###########################################################################
     def __post_init__(self):
@@ -43,6 +63,43 @@ class Problem:
     def from_dict(problem: Dict[str, Any]):
         return Problem(**problem)
 
+    ###########################################################################
+    def _compile_templates(self) -> None:
+        db_text = DatabaseTemplate.read(self.db_template_filename)
+        if self.input_template_filename is None:
+            self._db_template = DatabaseTemplate(db_text, self.names, source=self.db_template_filename + '.tpl')
+            return
+
+        # every parameter must appear in at least one of the two templates
+        input_text = InputTemplate.read(self.input_template_filename)
+        missing = [n for n in self.names if n not in db_text and n not in input_text]
+        if missing:
+            raise ValueError('parameters {} not found in {}.tpl or {}.tpl'.format(
+                missing, self.db_template_filename, self.input_template_filename))
+        self._db_template = DatabaseTemplate(db_text, self.names, source=self.db_template_filename + '.tpl',
+                                             strict=False)
+        self._input_template = InputTemplate(input_text, self.names, source=self.input_template_filename + '.tpl',
+                                             strict=False)
+
+    ###########################################################################
+    def db_template(self) -> DatabaseTemplate:
+        '''
+        Compile the database template of this problem for its parameter names.
+        The template is read once and reused by every later call.
+        '''
+        if self._db_template is None:
+            self._compile_templates()
+        return cast(DatabaseTemplate, self._db_template)
+
+    ###########################################################################
+    def input_template(self) -> Optional[InputTemplate]:
+        '''
+        Compile the input file template of this problem, if it has one.
+        '''
+        if self.input_template_filename is not None and self._input_template is None:
+            self._compile_templates()
+        return self._input_template
+
     ###########################################################################
     def to_salib(self):
         return {'names': self.names, 'bounds': [astuple(x) for x in self.bounds], 'num_vars': self.num_vars}
@@ -54,31 +111,364 @@ class Problem:
 def get_random_values(bounds: List[Bound], num_vars: int) -> np.ndarray:
     '''
     returns a matrix of random values between lower and upper
+    uses the global np.random state; see sampling.sample for a seedable,
+    Generator-based alternative
 
     lower, upper: lists of bounds to generate within
     num_iter: number of sets to generate
     return: num_iter by len(lower) matrix
     '''
+    lower = [bound.lower for bound in bounds]
+    upper = [bound.upper for bound in bounds]
+
+    # one vectorized draw; consumes the global stream in the same row-major
+    # order as drawing one value at a time
+    return np.random.uniform(lower, upper, size=(num_vars, len(bounds)))
 
-    # generate 1st row
-    matrix = None
-    for row in range(num_vars):
-        values = np.zeros(len(bounds))
-        for i, bound in enumerate(bounds):
-            values[i] = np.random.uniform(bound.lower, bound.upper)
-        if matrix is None:
-            matrix = values
+
+###############################################################################
+# running rows
+###############################################################################
+def _run_rows(phreeqc: PHREEQC,
+              template: DatabaseTemplate,
+              input_template: Optional[InputTemplate],
+              values_mtrx: np.ndarray,
+              db_filename: str,
+              input_filename: str,
+              analytes: List[str],
+              cwd: Optional[str] = None) -> Tuple[List[np.ndarray], RunStats]:
+    '''
+    Render the database (and input file) for values_mtrx and run phreeqc once.
+    Without an input template values_mtrx holds a single row; with one, the
+    rows share their database values and run as consecutive simulations.
+    Returns the output of every row and the stage timings of the run.
+    '''
+    start = time.perf_counter()
+    if phreeqc.engine.in_memory:
+        # in-process engines take the rendered text, nothing is written
+        if input_template is not None:
+            input_text = input_template.render_batch(values_mtrx)
         else:
-            matrix = np.vstack((matrix, values))
+            with open(os.path.join(cwd or '', input_filename), 'r') as fd:
+                input_text = fd.read()
+        db_text = template.render(values_mtrx[0])
+        render = time.perf_counter() - start
+        result = phreeqc.run_strings(db_text=db_text, input_text=input_text, analytes=analytes)
+        result.bytes_written += len(db_text) + len(input_text)
+    else:
+        written = _write_rows(template, input_template, values_mtrx, db_filename, input_filename, cwd)
+        render = time.perf_counter() - start
+        result = phreeqc.run(db_filename=db_filename, in_filename=input_filename, analytes=analytes, cwd=cwd)
+        result.bytes_written += written
+    result.timings['render'] = result.timings.get('render', 0.0) + render
+    stats = RunStats(timings=result.timings, bytes_written=result.bytes_written, bytes_read=result.bytes_read)
+    return _split_rows(input_template, result.output, len(values_mtrx)), stats
+
 
-    return cast(np.ndarray, matrix)
+def _write_rows(template: DatabaseTemplate,
+                input_template: Optional[InputTemplate],
+                values_mtrx: np.ndarray,
+                db_filename: str,
+                input_filename: str,
+                cwd: Optional[str]) -> int:
+    # returns the number of bytes written
+    written = template.write(values_mtrx[0], outfile=os.path.join(cwd or '', db_filename))
+    if input_template is not None:
+        with open(os.path.join(cwd or '', input_filename), 'w') as fd:
+            written += fd.write(input_template.render_batch(values_mtrx))
+    return written
+
+
+def _split_rows(input_template: Optional[InputTemplate], output: np.ndarray, num_rows: int) -> List[np.ndarray]:
+    if input_template is None:
+        return [output]
+    return input_template.split_output(output, num_rows)
+
+
+def ram_scratch_dir() -> str:
+    '''
+    A RAM-backed directory for SimulationRunner's scratch_dir: /dev/shm if
+    it is writable, the system temporary directory otherwise.
+    '''
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _scratch_filenames(db_template_filename: str,
+                       input_filename: str,
+                       input_template: Optional[InputTemplate]) -> Tuple[str, str]:
+    # file names for runs inside a scratch directory: rendered files go into
+    # the scratch directory itself, anything else must not depend on the
+    # working directory
+    if input_template is not None:
+        input_filename = os.path.basename(input_filename)
+    else:
+        input_filename = os.path.abspath(input_filename)
+    return os.path.basename(db_template_filename), input_filename
+
+
+###############################################################################
+# collecting results
+###############################################################################
+# analytes of a run when none are given
+DEFAULT_ANALYTES = ('pH', 'U')
+
+# result of a row whose run failed, with SimulationRunner(on_error='mask')
+FAILED = np.empty((0, 0))
+FAILED.setflags(write=False)
+
+
+def _failed_outputs(num_rows: int) -> List[np.ndarray]:
+    return [FAILED] * num_rows
+
+
+def collect_results(results: Iterable[Tuple[int, np.ndarray]], num_runs: int,
+                    out: Optional[np.ndarray] = None, dtype: Any = np.float64,
+                    num_analytes: Optional[int] = None) -> np.ndarray:
+    '''
+    Write (row_index, result) pairs, e.g. from SimulationRunner.iter_sims,
+    straight into one (num_runs, n_steps, n_analytes) array. Each result is
+    a run_sims array of [sim#, analyte1, analyte2...] rows; the sim# row is
+    dropped. Failed runs (empty results) are filled with nan, see failed_runs.
+
+    out:          preallocated array to fill; allocated from the first result if omitted
+    dtype:        dtype of the allocated array, e.g. np.float32 to halve its size
+    num_analytes: analytes per step; when every run failed there is no result
+                  to take n_steps from and the array has 0 steps of these
+    return:       out
+    '''
+    failed = []
+    for i, result in results:
+        if np.size(result) == 0:
+            failed.append(i)
+            continue
+        analytes = np.asarray(result)[1:]
+        if out is None:
+            out = np.empty((num_runs, analytes.shape[1], analytes.shape[0]), dtype=dtype)
+        if analytes.shape[::-1] != out.shape[1:]:
+            raise ValueError('run {} has {} steps of {} analytes, expected {} of {}'.format(
+                i, analytes.shape[1], analytes.shape[0], out.shape[1], out.shape[2]))
+        out[i] = analytes.T
+    if out is None:
+        out = np.empty((num_runs, 0, num_analytes or 0), dtype=dtype)
+    out[failed] = np.nan
+    return out
+
+
+def failed_runs(results: np.ndarray) -> np.ndarray:
+    '''
+    Mask of the runs of a collect_results / run_problem_matrix array (or of
+    its (n_runs, n_steps) slice for one analyte) that failed.
+    '''
+    results = np.asarray(results)
+    return cast(np.ndarray, np.isnan(results).reshape(len(results), -1).all(axis=1))
+
+
+###############################################################################
+@dataclass
+class ResultSet:
+    '''
+    Results of an ensemble in one contiguous (n_runs, n_steps, n_analytes)
+    array, labelled with the analyte names and the parameter rows that
+    produced them. result_set['U'] is a view of the U concentrations of
+    every run, the (n_runs, n_steps) matrix the analyses take.
+    '''
+    data: np.ndarray
+    analytes: List[str]
+    params: Optional[np.ndarray] = None
+
+    ###########################################################################
+    def __post_init__(self):
+        # memory maps, e.g. of EnsembleStore.result_set, stay memory maps
+        self.data = np.asanyarray(self.data)
+        self.analytes = list(self.analytes)
+        if self.data.ndim != 3 or self.data.shape[2] != len(self.analytes):
+            raise ValueError('data of shape {} does not hold {} analytes per step'.format(
+                self.data.shape, len(self.analytes)))
+        if self.params is not None and len(self.params) != len(self.data):
+            raise ValueError('{} parameter rows for {} runs'.format(len(self.params), len(self.data)))
+
+    ###########################################################################
+    @staticmethod
+    def collect(results: Iterable[Tuple[int, np.ndarray]], analytes: List[str], params: np.ndarray,
+                dtype: Any = np.float64, out: Optional[np.ndarray] = None) -> 'ResultSet':
+        '''
+        Collect (row_index, result) pairs of a run of params into a
+        ResultSet; see collect_results.
+        '''
+        return ResultSet(collect_results(results, len(params), out=out, dtype=dtype, num_analytes=len(analytes)),
+                         analytes, params)
+
+    ###########################################################################
+    def __len__(self) -> int:
+        return len(self.data)
+
+    ###########################################################################
+    def __getitem__(self, analyte: str) -> np.ndarray:
+        '''
+        (n_runs, n_steps) view of the results of one analyte.
+        '''
+        if analyte not in self.analytes:
+            raise KeyError('no analyte {!r}, the results hold {}'.format(analyte, self.analytes))
+        return cast(np.ndarray, self.data[:, :, self.analytes.index(analyte)])
+
+    ###########################################################################
+    @property
+    def num_steps(self) -> int:
+        return int(self.data.shape[1])
+
+    ###########################################################################
+    @property
+    def failed(self) -> np.ndarray:
+        '''
+        Mask of the runs that failed, see failed_runs.
+        '''
+        return failed_runs(self.data)
+
+    ###########################################################################
+    def runs(self, rows: Any) -> 'ResultSet':
+        '''
+        ResultSet of the selected runs; a slice gives views, an index or
+        mask array copies.
+        '''
+        params = None if self.params is None else self.params[rows]
+        return ResultSet(self.data[rows], self.analytes, params)
+
+    ###########################################################################
+    def astype(self, dtype: Any) -> 'ResultSet':
+        '''
+        ResultSet with the data stored as dtype, e.g. np.float32; self if it
+        already is.
+        '''
+        if self.data.dtype == np.dtype(dtype):
+            return self
+        return ResultSet(self.data.astype(dtype), self.analytes, self.params)
+
+
+def _fan_out(indices: List[int], output: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+    # the rows of one run each get their own array, so writing to the result
+    # of one row never changes another; FAILED is shared as the marker it is
+    yield indices[0], output
+    for i in indices[1:]:
+        yield i, output.copy() if output.size else output
+
+
+###############################################################################
+# process-pool workers
+###############################################################################
+# Per-process state set up once by _init_worker, so that only the parameter
+# rows have to be shipped to the pool for every task.
+_worker_state: Dict[str, Any] = {}
+
+
+def _init_worker(phreeqc: PHREEQC,
+                 template: DatabaseTemplate,
+                 input_template: Optional[InputTemplate],
+                 db_filename: str,
+                 input_filename: str,
+                 analytes: List[str],
+                 scratch_dir: Optional[str] = None) -> None:
+    _worker_state.update(phreeqc=phreeqc,
+                         template=template,
+                         input_template=input_template,
+                         db_filename=db_filename,
+                         input_filename=input_filename,
+                         analytes=analytes,
+                         scratch_dir=scratch_dir)
+
+
+def _run_isolated(values_mtrx: np.ndarray) -> Tuple[List[np.ndarray], RunStats]:
+    # renders the database and runs phreeqc inside a private scratch
+    # directory, so concurrent runs never share output.out, the rendered
+    # database or the selected output file
+    state = dict(_worker_state)
+    with tempfile.TemporaryDirectory(prefix='ml4scm-', dir=state.pop('scratch_dir')) as scratch:
+        return _run_rows(values_mtrx=values_mtrx, cwd=scratch, **state)
 
 
 ###############################################################################
 class SimulationRunner:
     ###########################################################################
-    def __init__(self, phreeqc: PHREEQC) -> None:
+    def __init__(self, phreeqc: PHREEQC, max_workers: Optional[int] = None,
+                 cache: Optional[RunCache] = None, batch_size: int = 100,
+                 observers: Optional[List[RunObserver]] = None,
+                 coordinator: Optional['Coordinator'] = None,
+                 retries: int = 0, on_error: str = 'raise', scratch_dir: Optional[str] = None) -> None:
+        '''
+        phreeqc:     PHREEQC wrapper used to run the simulations
+        max_workers: number of worker processes for run_sims. None or 1 runs
+                     the simulations one at a time in the current working
+                     directory; larger values run them in a process pool, each
+                     run in its own temporary directory
+        cache:       optional RunCache; runs found in it are not repeated
+        batch_size:  with an input template, the maximum number of rows
+                     packed into one phreeqc invocation
+        observers:   RunObservers called when each phreeqc invocation starts
+                     running, finishes or fails, from run_sims / iter_sims as
+                     well as submit and create_tasks. The runner aggregates
+                     the same events in self.metrics
+        coordinator: optional cluster.Coordinator; run_sims / iter_sims then
+                     hand their phreeqc invocations to its workers instead
+                     of running them locally (max_workers is ignored)
+        retries:     times a failed phreeqc invocation is run again, e.g.
+                     after a timeout (see PHREEQC's timeout); applies to
+                     run_sims / iter_sims, submit and create_tasks alike
+        on_error:    'raise' stops at the first invocation that fails after
+                     its retries; 'mask' records its rows as failed and goes
+                     on. Failed rows are yielded as empty results (FAILED),
+                     which collect_results turns into nan, see failed_runs
+        scratch_dir: directory holding the private scratch directory of
+                     every run, e.g. ram_scratch_dir() for tmpfs. Each is
+                     removed as soon as its output is parsed. If not given,
+                     serial runs render into the template's directory and
+                     run in the working directory, and parallel runs use the
+                     system temporary directory
+        '''
+        if max_workers is not None and max_workers < 1:
+            raise ValueError('max_workers must be a positive integer')
+        if batch_size < 1:
+            raise ValueError('batch_size must be a positive integer')
+        if retries < 0:
+            raise ValueError('retries must not be negative')
+        if on_error not in ('raise', 'mask'):
+            raise ValueError("on_error must be 'raise' or 'mask'")
         self.phreeqc = phreeqc
+        self.max_workers = max_workers
+        self.cache = cache
+        self.batch_size = batch_size
+        self.metrics = RunMetrics()
+        self.observers: List[RunObserver] = [self.metrics] + list(observers or [])
+        self.coordinator = coordinator
+        self.retries = retries
+        self.on_error = on_error
+        self.scratch_dir = scratch_dir
+        self._in_flight = 0
+        self._waiting = 0
+        # submit runs rows on pool threads; observers see one event at a time
+        self._events_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._queued: Set['Future[np.ndarray]'] = set()
+        return
+
+    ###########################################################################
+    def __enter__(self) -> 'SimulationRunner':
+        return self
+
+    ###########################################################################
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    ###########################################################################
+    def close(self) -> None:
+        '''
+        Shut down the thread pool used by submit, cancelling queued runs.
+        '''
+        if self._executor is not None:
+            for future in list(self._queued):
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
         return
 
     ###########################################################################
@@ -91,15 +481,29 @@ class SimulationRunner:
                              input_filename=problem.input_filename,
                              output_filename=problem.output_filename,
                              db_template_filename=problem.db_template_filename,
-                             analytes=analytes)
+                             analytes=analytes,
+                             template=problem.db_template(),
+                             input_template=problem.input_template())
 
     ###########################################################################
-    def run_random_problem(self, problem: Problem, analytes: Optional[List[str]]=None) -> List[np.ndarray]:
+    def run_random_problem(self, problem: Problem, analytes: Optional[List[str]]=None,
+                           sampler: Optional[str] = None, rng: sampling.Seed = None,
+                           num_sets: Optional[int] = None) -> List[np.ndarray]:
         '''
         Generates randomized values using the problem bounds,
         and then runs the given problem simulation
+
+        sampler:  sampling method ('uniform', 'lhs', 'sobol', 'grid'); the
+                  legacy get_random_values is used if omitted
+        rng:      seed or numpy Generator for the sampler
+        num_sets: number of parameter sets; defaults to problem.num_vars
         '''
-        self.generated_values = get_random_values(problem.bounds, problem.num_vars)
+        if num_sets is None:
+            num_sets = problem.num_vars
+        if sampler is None:
+            self.generated_values = get_random_values(problem.bounds, num_sets)
+        else:
+            self.generated_values = sampling.sample(problem.bounds, num_sets, method=sampler, rng=rng)
         return self.run_problem(problem=problem, values=self.generated_values, analytes=analytes)
 
     ###########################################################################
@@ -109,25 +513,591 @@ class SimulationRunner:
                  input_filename: str,
                  output_filename: str,
                  db_template_filename: str,
-                 analytes: Optional[List[str]] = None) -> List[np.ndarray]:
+                 analytes: Optional[List[str]] = None,
+                 template: Optional[DatabaseTemplate] = None,
+                 input_template: Optional[InputTemplate] = None) -> List[np.ndarray]:
         '''
         runs a phreeqc simulation for each row of parameters in values_mtrx
         requires various path variables to be set correctly at beginning of file
 
         values_mtrx: matrix of values generated from get_random_values or similar function
         analytes: list of element keywords to search for in .out file generated by phreeqc
-        return: list of np arrays of [sim#, analyte1, analyte2...] (format is kind of awkward
+        template: precompiled db_template_filename template for pars; compiled here if omitted
+        input_template: optional input file template for pars, rendered to input_filename;
+                        rows that only differ in input-side values are run batch_size at
+                        a time as consecutive simulations of one phreeqc invocation
+        return: list of np arrays of [sim#, analyte1, analyte2...] (format is kind of awkward;
+                run_results collects the same runs into a ResultSet)
         '''
+        obs_all: List[np.ndarray] = [np.empty(0)] * len(values_mtrx)
+        for i, output in self.iter_sims(values_mtrx=values_mtrx,
+                                         pars=pars,
+                                         input_filename=input_filename,
+                                         output_filename=output_filename,
+                                         db_template_filename=db_template_filename,
+                                         analytes=analytes,
+                                         template=template,
+                                         input_template=input_template):
+            obs_all[i] = output
+        return obs_all
 
+    ###########################################################################
+    def iter_sims(self,
+                  values_mtrx: np.ndarray,
+                  pars: List[str],
+                  input_filename: str,
+                  output_filename: str,
+                  db_template_filename: str,
+                  analytes: Optional[List[str]] = None,
+                  template: Optional[DatabaseTemplate] = None,
+                  input_template: Optional[InputTemplate] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        '''
+        Streaming counterpart of run_sims: yields (row_index, result) as soon
+        as each run finishes, in completion order. Cached rows come first;
+        rows sharing a run are yielded together when it completes. Arguments
+        are those of run_sims.
+        '''
         if analytes is None:
-            analytes = ['pH', 'U']
+            analytes = list(DEFAULT_ANALYTES)
 
-        obs_all = []
-        for values in values_mtrx:
-            self.phreeqc.write_db_from_template(template_filename=db_template_filename,
-                                                pars=pars,
-                                                values=values)
-            result = self.phreeqc.run(db_filename=db_template_filename, in_filename=input_filename, analytes=analytes)
-            obs_all.append(result.output)
+        # the template is read and compiled once for the whole batch
+        if template is None:
+            template = DatabaseTemplate.from_file(db_template_filename, pars)
 
-        return obs_all
+        values_mtrx = np.asarray(values_mtrx)
+        if input_template is None:
+            with open(input_filename, 'rb') as fd:
+                input_digests = [hashlib.sha256(fd.read()).hexdigest()] * len(values_mtrx)
+        else:
+            input_digests = [input_template.digest(values) for values in values_mtrx]
+
+        # identical runs (common after resampling) are run once and fanned
+        # out to all of their positions
+        rows: Dict[Tuple[str, str], List[int]] = {}
+        for i, (values, input_digest) in enumerate(zip(values_mtrx, input_digests)):
+            rows.setdefault((template.digest(values), input_digest), []).append(i)
+
+        keys: Dict[Tuple[str, str], str] = {}
+        pending: List[Tuple[str, str]] = []
+        if self.cache is not None:
+            binary = self.phreeqc.identity()
+        for digest, indices in rows.items():
+            if self.cache is not None:
+                keys[digest] = RunCache.make_key(digest[0], digest[1], analytes, binary)
+                cached = self.cache.get(keys[digest])
+                if cached is not None:
+                    yield from _fan_out(indices, cached)
+                    continue
+            pending.append(digest)
+
+        for task, outputs in self._execute(values_mtrx=values_mtrx[[rows[d][0] for d in pending]],
+                                           template=template,
+                                           input_template=input_template,
+                                           input_filename=input_filename,
+                                           db_template_filename=db_template_filename,
+                                           analytes=analytes):
+            for j, output in zip(task, outputs):
+                if self.cache is not None and output.size:
+                    self.cache.put(keys[pending[j]], output)
+                yield from _fan_out(rows[pending[j]], output)
+
+    ###########################################################################
+    def iter_problem(self, problem: Problem, values: np.ndarray,
+                     analytes: Optional[List[str]] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        '''
+        Run a problem simulation using the specified values, yielding
+        (row_index, result) as runs finish; see iter_sims.
+        '''
+        return self.iter_sims(values_mtrx=values,
+                              pars=problem.names,
+                              input_filename=problem.input_filename,
+                              output_filename=problem.output_filename,
+                              db_template_filename=problem.db_template_filename,
+                              analytes=analytes,
+                              template=problem.db_template(),
+                              input_template=problem.input_template())
+
+    ###########################################################################
+    def run_problem_matrix(self, problem: Problem, values: np.ndarray,
+                           analytes: Optional[List[str]] = None) -> np.ndarray:
+        '''
+        Run a problem simulation and collect the results into one
+        (n_runs, n_steps, n_analytes) array; see collect_results.
+        '''
+        return self.run_results(problem, values, analytes).data
+
+    ###########################################################################
+    def run_results(self, problem: Problem, values: np.ndarray, analytes: Optional[List[str]] = None,
+                    dtype: Any = np.float64, out: Optional[np.ndarray] = None) -> ResultSet:
+        '''
+        Run a problem simulation and collect the results, as runs finish,
+        into a ResultSet labelled with analytes and values.
+
+        dtype: dtype the results are stored as, e.g. np.float32
+        out:   preallocated (n_runs, n_steps, n_analytes) array to fill, e.g.
+               a slice of a larger ensemble
+        '''
+        if analytes is None:
+            analytes = list(DEFAULT_ANALYTES)
+        values = np.asarray(values)
+        return ResultSet.collect(self.iter_problem(problem, values, analytes), analytes, values, dtype=dtype, out=out)
+
+    ###########################################################################
+    def _make_tasks(self,
+                    values_mtrx: np.ndarray,
+                    template: DatabaseTemplate,
+                    input_template: Optional[InputTemplate]) -> List[List[int]]:
+        '''
+        group row indices into phreeqc invocations
+        '''
+        if input_template is None:
+            return [[i] for i in range(len(values_mtrx))]
+
+        # rows rendering the same database can share one phreeqc run
+        groups: Dict[str, List[int]] = {}
+        for i, values in enumerate(values_mtrx):
+            groups.setdefault(template.digest(values), []).append(i)
+        return [rows[start:start + self.batch_size]
+                for rows in groups.values()
+                for start in range(0, len(rows), self.batch_size)]
+
+    ###########################################################################
+    def _execute(self,
+                 values_mtrx: np.ndarray,
+                 template: DatabaseTemplate,
+                 input_template: Optional[InputTemplate],
+                 input_filename: str,
+                 db_template_filename: str,
+                 analytes: List[str]) -> Iterator[Tuple[List[int], List[np.ndarray]]]:
+        '''
+        run phreeqc for every row, serially or over the process pool,
+        yielding (row indices, outputs) of each invocation as it finishes
+        '''
+        if len(values_mtrx) == 0:
+            return
+
+        tasks = self._make_tasks(values_mtrx, template, input_template)
+        if self.coordinator is not None:
+            yield from self._run_sims_remote(tasks=tasks,
+                                             values_mtrx=values_mtrx,
+                                             template=template,
+                                             input_template=input_template,
+                                             input_filename=input_filename,
+                                             db_template_filename=db_template_filename,
+                                             analytes=analytes)
+            return
+
+        if self.max_workers is not None and self.max_workers > 1:
+            yield from self._run_sims_parallel(tasks=tasks,
+                                               values_mtrx=values_mtrx,
+                                               template=template,
+                                               input_template=input_template,
+                                               input_filename=input_filename,
+                                               db_template_filename=db_template_filename,
+                                               analytes=analytes)
+            return
+
+        self._enqueue(len(tasks))
+        queued = len(tasks)
+        try:
+            for task in tasks:
+                for attempt in range(self.retries + 1):
+                    event = self._started(len(task))
+                    queued -= 1
+                    try:
+                        outputs, stats = self._run_local(values_mtrx=values_mtrx[task],
+                                                         template=template,
+                                                         input_template=input_template,
+                                                         input_filename=input_filename,
+                                                         db_template_filename=db_template_filename,
+                                                         analytes=analytes)
+                    except Exception as e:
+                        self._ended(event, error=e)
+                        if attempt < self.retries:
+                            self._enqueue(1)
+                            queued += 1
+                            continue
+                        if self.on_error == 'raise':
+                            raise
+                        outputs = _failed_outputs(len(task))
+                    else:
+                        self._ended(event, stats=stats)
+                    break
+                yield task, outputs
+        finally:
+            self._abandoned(0, queued)
+
+    ###########################################################################
+    def _run_local(self,
+                   values_mtrx: np.ndarray,
+                   template: DatabaseTemplate,
+                   input_template: Optional[InputTemplate],
+                   input_filename: str,
+                   db_template_filename: str,
+                   analytes: List[str]) -> Tuple[List[np.ndarray], RunStats]:
+        '''
+        run rows in this process, in the working directory or in a private
+        directory under scratch_dir
+        '''
+        if self.scratch_dir is None:
+            return _run_rows(phreeqc=self.phreeqc,
+                             template=template,
+                             input_template=input_template,
+                             values_mtrx=values_mtrx,
+                             db_filename=db_template_filename,
+                             input_filename=input_filename,
+                             analytes=analytes)
+        db_filename, input_filename = _scratch_filenames(db_template_filename, input_filename, input_template)
+        with tempfile.TemporaryDirectory(prefix='ml4scm-', dir=self.scratch_dir) as scratch:
+            return _run_rows(phreeqc=self.phreeqc,
+                             template=template,
+                             input_template=input_template,
+                             values_mtrx=values_mtrx,
+                             db_filename=db_filename,
+                             input_filename=input_filename,
+                             analytes=analytes,
+                             cwd=scratch)
+
+    ###########################################################################
+    def _enqueue(self, num_runs: int) -> None:
+        # runs waiting to start, see RunEvent.queued; each is taken off by
+        # _started, or by _abandoned if it never starts
+        with self._events_lock:
+            self._waiting += num_runs
+
+    ###########################################################################
+    def _started(self, num_rows: int) -> RunEvent:
+        # called when the run actually starts, not when it is queued
+        with self._events_lock:
+            self._in_flight += 1
+            self._waiting -= 1
+            event = RunEvent(num_rows=num_rows, start=time.time(), in_flight=self._in_flight,
+                             queued=self._waiting)
+            for observer in self.observers:
+                observer.on_start(event)
+        return event
+
+    ###########################################################################
+    def _ended(self, event: RunEvent, stats: Optional[RunStats] = None,
+               error: Optional[BaseException] = None) -> None:
+        with self._events_lock:
+            self._in_flight -= 1
+            event.latency = time.time() - event.start
+            event.in_flight = self._in_flight
+            event.queued = self._waiting
+            event.stats = stats
+            event.error = error
+            for observer in self.observers:
+                if error is None:
+                    observer.on_finish(event)
+                else:
+                    observer.on_failure(event)
+
+    ###########################################################################
+    def _abandoned(self, num_runs: int, num_queued: int = 0) -> None:
+        # runs started but never ended and runs queued but never started,
+        # e.g. of an abandoned iterator
+        with self._events_lock:
+            self._in_flight -= num_runs
+            self._waiting -= num_queued
+
+    ###########################################################################
+    def _run_sims_parallel(self,
+                           tasks: List[List[int]],
+                           values_mtrx: np.ndarray,
+                           template: DatabaseTemplate,
+                           input_template: Optional[InputTemplate],
+                           input_filename: str,
+                           db_template_filename: str,
+                           analytes: List[str]) -> Iterator[Tuple[List[int], List[np.ndarray]]]:
+        '''
+        run tasks over a process pool, yielding each as it completes
+        '''
+        # workers run phreeqc in scratch directories
+        db_filename, input_filename = _scratch_filenames(db_template_filename, input_filename, input_template)
+        initargs = (self.phreeqc,
+                    template,
+                    input_template,
+                    db_filename,
+                    input_filename,
+                    analytes,
+                    self.scratch_dir)
+        with ProcessPoolExecutor(max_workers=self.max_workers,
+                                 initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            # no more runs are submitted than there are workers, so a run
+            # starts as it is submitted and its event times the run rather
+            # than its wait in the pool's queue. (task, attempt) pairs are
+            # taken from the end
+            pending = [(task, 0) for task in reversed(tasks)]
+            self._enqueue(len(pending))
+            futures: Dict['Future[Tuple[List[np.ndarray], RunStats]]', Tuple[List[int], int]] = {}
+            events: Dict['Future[Tuple[List[np.ndarray], RunStats]]', RunEvent] = {}
+
+            def fill() -> None:
+                while pending and len(futures) < cast(int, self.max_workers):
+                    task, attempt = pending.pop()
+                    future = pool.submit(_run_isolated, values_mtrx[task])
+                    futures[future] = (task, attempt)
+                    events[future] = self._started(len(task))
+
+            try:
+                fill()
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    finished = []
+                    for future in done:
+                        task, attempt = futures.pop(future)
+                        try:
+                            outputs, stats = future.result()
+                        except Exception as e:
+                            self._ended(events.pop(future), error=e)
+                            if attempt < self.retries:
+                                pending.append((task, attempt + 1))
+                                self._enqueue(1)
+                                continue
+                            if self.on_error == 'raise':
+                                raise
+                            finished.append((task, _failed_outputs(len(task))))
+                            continue
+                        self._ended(events.pop(future), stats=stats)
+                        finished.append((task, outputs))
+                    # the workers are kept busy while the results are consumed
+                    fill()
+                    yield from finished
+            finally:
+                # an abandoned iterator should not leave queued runs behind
+                for future in futures:
+                    future.cancel()
+                self._abandoned(len(events), len(pending))
+
+    ###########################################################################
+    def _run_sims_remote(self,
+                         tasks: List[List[int]],
+                         values_mtrx: np.ndarray,
+                         template: DatabaseTemplate,
+                         input_template: Optional[InputTemplate],
+                         input_filename: str,
+                         db_template_filename: str,
+                         analytes: List[str]) -> Iterator[Tuple[List[int], List[np.ndarray]]]:
+        '''
+        run tasks on the workers of the coordinator, yielding each as it completes
+        '''
+        coordinator = cast('Coordinator', self.coordinator)
+        # a task starts when the coordinator hands it to a worker; until
+        # then it is queued. retries are queued inside the coordinator
+        events: Dict[int, RunEvent] = {}
+        handed_out: Set[int] = set()
+
+        def started(i: int) -> None:
+            handed_out.add(i)
+            events[i] = self._started(len(tasks[i]))
+
+        self._enqueue(len(tasks))
+        try:
+            for i, outputs, stats, error in coordinator.run(tasks=[values_mtrx[task] for task in tasks],
+                                                            phreeqc=self.phreeqc,
+                                                            template=template,
+                                                            input_template=input_template,
+                                                            input_filename=input_filename,
+                                                            db_template_filename=db_template_filename,
+                                                            analytes=analytes,
+                                                            retries=self.retries,
+                                                            started=started):
+                if i not in events:
+                    started(i)
+                if error is not None:
+                    self._ended(events.pop(i), error=error)
+                    if self.on_error == 'raise':
+                        raise error
+                    yield tasks[i], _failed_outputs(len(tasks[i]))
+                    continue
+                self._ended(events.pop(i), stats=stats)
+                yield tasks[i], outputs
+        finally:
+            self._abandoned(len(events), len(tasks) - len(handed_out))
+
+    ###########################################################################
+    def _run_row(self, problem: Problem, values: np.ndarray, analytes: List[str]) -> np.ndarray:
+        '''
+        run a single row of a problem in its own scratch directory, retried
+        and masked as run_sims does
+        '''
+        db_filename, input_filename = _scratch_filenames(problem.db_template_filename,
+                                                         problem.input_filename,
+                                                         problem.input_template())
+        attempt = 0
+        while True:
+            event = self._started(1)
+            try:
+                with tempfile.TemporaryDirectory(prefix='ml4scm-', dir=self.scratch_dir) as scratch:
+                    outputs, stats = _run_rows(phreeqc=self.phreeqc,
+                                               template=problem.db_template(),
+                                               input_template=problem.input_template(),
+                                               values_mtrx=np.asarray([values]),
+                                               db_filename=db_filename,
+                                               input_filename=input_filename,
+                                               analytes=analytes,
+                                               cwd=scratch)
+            except BaseException as e:
+                self._ended(event, error=e)
+                if not self._retry(e, attempt):
+                    return FAILED
+                self._enqueue(1)
+                attempt += 1
+                continue
+            self._ended(event, stats=stats)
+            return outputs[0]
+
+    ###########################################################################
+    def _retry(self, error: BaseException, attempt: int) -> bool:
+        # after attempt failed with error: True to run again, False to mask
+        # the row as FAILED; raises error if neither applies. interrupts and
+        # cancellation are never retried
+        if not isinstance(error, Exception):
+            raise error
+        if attempt < self.retries:
+            return True
+        if self.on_error == 'raise':
+            raise error
+        return False
+
+    ###########################################################################
+    def submit(self, problem: Problem, values: np.ndarray,
+               analytes: Optional[List[str]] = None) -> List['Future[np.ndarray]']:
+        '''
+        Queue one run per row of values without blocking and return a
+        concurrent.futures.Future per row, in row order. At most max_workers
+        runs (one per CPU if unset) execute at a time, each in its own
+        scratch directory; queued runs can be cancelled and results collected
+        with concurrent.futures.as_completed. Failed runs are retried and,
+        with on_error='mask', resolve to FAILED instead of raising.
+        '''
+        if analytes is None:
+            analytes = list(DEFAULT_ANALYTES)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers or os.cpu_count(),
+                                                thread_name_prefix='ml4scm')
+        # compile the templates up front rather than racing in the workers
+        problem.db_template()
+        values = np.asarray(values)
+        self._enqueue(len(values))
+        futures = [self._executor.submit(self._run_row, problem, row, analytes) for row in values]
+        for future in futures:
+            self._queued.add(future)
+            future.add_done_callback(self._queued.discard)
+            future.add_done_callback(self._dropped)
+        return futures
+
+    ###########################################################################
+    def _dropped(self, future: 'Future[np.ndarray]') -> None:
+        # a submitted run cancelled before it started never leaves the queue
+        if future.cancelled():
+            self._abandoned(0, 1)
+
+    ###########################################################################
+    async def _run_row_async(self, problem: Problem, values: np.ndarray, analytes: List[str],
+                             semaphore: asyncio.Semaphore) -> np.ndarray:
+        # one row, retried and masked as run_sims does; a retry waits for a
+        # free slot again. the row is queued while it waits for a slot
+        attempt = 0
+        self._enqueue(1)
+        queued = True
+        try:
+            while True:
+                async with semaphore:
+                    event = self._started(1)
+                    queued = False
+                    try:
+                        output, stats = await self._attempt_row_async(problem, values, analytes)
+                    except BaseException as e:
+                        self._ended(event, error=e)
+                        if not self._retry(e, attempt):
+                            return FAILED
+                        self._enqueue(1)
+                        queued = True
+                        attempt += 1
+                        continue
+                self._ended(event, stats=stats)
+                return output
+        finally:
+            if queued:
+                self._abandoned(0, 1)
+
+    ###########################################################################
+    async def _attempt_row_async(self, problem: Problem, values: np.ndarray,
+                                 analytes: List[str]) -> Tuple[np.ndarray, RunStats]:
+        db_filename, input_filename = _scratch_filenames(problem.db_template_filename,
+                                                         problem.input_filename,
+                                                         problem.input_template())
+        loop = asyncio.get_running_loop()
+        # the scratch directory is made, written and removed in the default
+        # executor so the event loop is not blocked
+        start = time.perf_counter()
+        prepared = loop.run_in_executor(None, self._make_scratch, problem, values, db_filename, input_filename)
+        try:
+            scratch, written = await asyncio.shield(prepared)
+        except asyncio.CancelledError:
+            prepared.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or
+                loop.run_in_executor(None, shutil.rmtree, f.result()[0], True))
+            raise
+        render = time.perf_counter() - start
+        try:
+            result = await self.phreeqc.run_async(db_filename=db_filename,
+                                                  in_filename=input_filename,
+                                                  analytes=analytes,
+                                                  cwd=scratch)
+        finally:
+            await asyncio.shield(loop.run_in_executor(None, shutil.rmtree, scratch, True))
+        result.timings['render'] = result.timings.get('render', 0.0) + render
+        stats = RunStats(timings=result.timings, bytes_written=result.bytes_written + written,
+                         bytes_read=result.bytes_read)
+        return _split_rows(problem.input_template(), result.output, 1)[0], stats
+
+    ###########################################################################
+    def _make_scratch(self, problem: Problem, values: np.ndarray, db_filename: str,
+                      input_filename: str) -> Tuple[str, int]:
+        # a scratch directory holding the rendered files of one row, and
+        # the bytes written to it
+        scratch = tempfile.mkdtemp(prefix='ml4scm-', dir=self.scratch_dir)
+        try:
+            written = _write_rows(problem.db_template(), problem.input_template(), np.asarray([values]),
+                                  db_filename, input_filename, scratch)
+        except BaseException:
+            shutil.rmtree(scratch, ignore_errors=True)
+            raise
+        return scratch, written
+
+    ###########################################################################
+    def create_tasks(self, problem: Problem, values: np.ndarray, analytes: Optional[List[str]] = None,
+                     max_concurrency: Optional[int] = None) -> List['asyncio.Task[np.ndarray]']:
+        '''
+        Schedule one asyncio task per row of values on the running event
+        loop, in row order. At most max_concurrency phreeqc processes run at
+        once (max_workers, or one per CPU, if unset). Tasks can be cancelled,
+        which kills a running process, and awaited with asyncio.as_completed.
+        Failed runs are retried and, with on_error='mask', resolve to FAILED
+        instead of raising.
+        '''
+        if analytes is None:
+            analytes = list(DEFAULT_ANALYTES)
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_workers or os.cpu_count() or 1)
+        problem.db_template()
+        return [asyncio.ensure_future(self._run_row_async(problem, row, analytes, semaphore))
+                for row in np.asarray(values)]
+
+    ###########################################################################
+    async def run_problem_async(self, problem: Problem, values: np.ndarray, analytes: Optional[List[str]] = None,
+                                max_concurrency: Optional[int] = None) -> List[np.ndarray]:
+        '''
+        asyncio counterpart of run_problem; see create_tasks. With
+        on_error='raise' the first run to fail for good cancels the rest;
+        with 'mask' every row finishes and failed rows are FAILED.
+        '''
+        tasks = self.create_tasks(problem, values, analytes, max_concurrency)
+        try:
+            return list(await asyncio.gather(*tasks))
+        finally:
+            for task in tasks:
+                task.cancel()
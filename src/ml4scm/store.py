@@ -0,0 +1,198 @@
+import json
+import os
+import os.path
+import tempfile
+from typing import Any, Iterable, List, Optional, Tuple, cast
+
+import numpy as np
+
+from .simulation import Problem, ResultSet, SimulationRunner
+
+
+class EnsembleStore:
+    """
+    On-disk, resumable store for an ensemble of runs.
+
+    The directory holds the parameter matrix (params.npy), a memory-mapped
+    (n_runs, n_steps, n_analytes) result array (results.npy) and a completion
+    bitmap (done.npy). Every run is flushed to disk as soon as it finishes
+    and marked done afterwards, so a restarted job only runs the rows that
+    are still missing. Results are read through memory maps, so analyses
+    never need the whole ensemble in RAM.
+    """
+    def __init__(self, directory: str) -> None:
+        """
+        Open an existing store; see EnsembleStore.open to create one.
+        """
+        if not os.path.exists(os.path.join(directory, 'params.npy')):
+            raise FileNotFoundError('no ensemble store in {}'.format(directory))
+        self.directory = directory
+        with open(self._path('meta.json'), 'r') as fd:
+            self.analytes: List[str] = json.load(fd)['analytes']
+        self.params = cast(np.ndarray, np.load(self._path('params.npy'), mmap_mode='r'))
+        self._done = np.lib.format.open_memmap(self._path('done.npy'), mode='r+')
+        self._results: Optional[np.ndarray] = None
+        if os.path.exists(self._path('results.npy')):
+            self._results = np.lib.format.open_memmap(self._path('results.npy'), mode='r+')
+        return
+
+    @classmethod
+    def open(cls, directory: str, params: np.ndarray, analytes: Optional[List[str]] = None) -> 'EnsembleStore':
+        """
+        Open the store in directory, creating it for params if it does not
+        exist yet.
+
+        params:   (n_runs, n_pars) parameter matrix of the ensemble
+        analytes: analytes stored per run; Defaults to U concentration
+        """
+        if analytes is None:
+            analytes = ['U']
+        params = np.asarray(params, dtype=float)
+        if not os.path.exists(os.path.join(directory, 'params.npy')):
+            os.makedirs(directory, exist_ok=True)
+            _atomic_save(os.path.join(directory, 'done.npy'), np.zeros(len(params), dtype=bool))
+            with open(os.path.join(directory, 'meta.json'), 'w') as fd:
+                json.dump({'analytes': analytes}, fd)
+            # params.npy is written last and marks the store as initialized
+            _atomic_save(os.path.join(directory, 'params.npy'), params)
+
+        store = cls(directory)
+        if store.analytes != analytes or not np.array_equal(store.params, params):
+            raise ValueError('{} holds a different ensemble; remove it or use another directory'.format(directory))
+        return store
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __len__(self) -> int:
+        return len(self.params)
+
+    @property
+    def done(self) -> np.ndarray:
+        """
+        Copy of the completion bitmap, one flag per row.
+        """
+        return np.array(self._done)
+
+    @property
+    def complete(self) -> bool:
+        return bool(np.all(self._done))
+
+    def missing(self) -> np.ndarray:
+        """
+        Indices of the rows that have not been run yet.
+        """
+        return cast(np.ndarray, np.flatnonzero(~np.asarray(self._done)))
+
+    def write(self, i: int, result: np.ndarray) -> None:
+        """
+        Flush the run_sims result of row i ([sim#, analyte1, ...] rows) to
+        disk and mark the row done. A failed run (an empty result, see
+        SimulationRunner's on_error) leaves the row missing, so the next
+        run tries it again.
+        """
+        if np.size(result) == 0:
+            return
+        analytes = np.asarray(result)[1:].T
+        if self._results is None:
+            self._results = np.lib.format.open_memmap(self._path('results.npy'), mode='w+', dtype=float,
+                                                      shape=(len(self),) + analytes.shape)
+            self._results[:] = np.nan
+        if analytes.shape != self._results.shape[1:]:
+            raise ValueError('run {} has {} steps of {} analytes, expected {} of {}'.format(
+                i, analytes.shape[0], analytes.shape[1], self._results.shape[1], self._results.shape[2]))
+        self._results[i] = analytes
+        # the data must be on disk before the row is marked done
+        cast(Any, self._results).flush()
+        self._done[i] = True
+        cast(Any, self._done).flush()
+        return
+
+    def write_all(self, results: Iterable[Tuple[int, np.ndarray]]) -> None:
+        """
+        Write (row_index, result) pairs, e.g. from SimulationRunner.iter_sims.
+        """
+        for i, result in results:
+            self.write(i, result)
+        return
+
+    def extend(self, params: np.ndarray) -> None:
+        """
+        Append rows to the ensemble; they start out missing and the rows
+        already run are kept.
+        """
+        params = np.asarray(params, dtype=float).reshape(-1, self.params.shape[1])
+        if not len(params):
+            return
+        num_rows = len(self) + len(params)
+        if self._results is not None:
+            old = self._results
+            tmp = self._path('results.npy.tmp')
+            grown = np.lib.format.open_memmap(tmp, mode='w+', dtype=float, shape=(num_rows,) + old.shape[1:])
+            grown[:len(old)] = old
+            grown[len(old):] = np.nan
+            cast(Any, grown).flush()
+            del grown, old
+            os.replace(tmp, self._path('results.npy'))
+            self._results = np.lib.format.open_memmap(self._path('results.npy'), mode='r+')
+        # params.npy is replaced last, as when the store is created
+        _atomic_save(self._path('done.npy'), np.concatenate([np.asarray(self._done), np.zeros(len(params), bool)]))
+        self._done = np.lib.format.open_memmap(self._path('done.npy'), mode='r+')
+        _atomic_save(self._path('params.npy'), np.concatenate([np.asarray(self.params), params]))
+        self.params = cast(np.ndarray, np.load(self._path('params.npy'), mmap_mode='r'))
+        return
+
+    def run(self, sim: SimulationRunner, problem: Problem, chunk_size: Optional[int] = None) -> np.ndarray:
+        """
+        Run the missing rows of the ensemble, flushing each as it finishes.
+
+        chunk_size: maximum number of rows handed to sim at once; all
+                    missing rows if not provided
+        return:     the memory-mapped (n_runs, n_steps, n_analytes) results
+        """
+        missing = self.missing()
+        step = chunk_size or max(len(missing), 1)
+        for start in range(0, len(missing), step):
+            rows = missing[start:start + step]
+            values = np.asarray(self.params[rows])
+            results = sim.iter_problem(problem=problem, values=values, analytes=self.analytes)
+            self.write_all((int(rows[j]), result) for j, result in results)
+        return self.results()
+
+    def results(self) -> np.ndarray:
+        """
+        Read-only memory map of the (n_runs, n_steps, n_analytes) results;
+        rows that are not done yet are nan.
+        """
+        if self._results is None:
+            raise RuntimeError('no run has been stored in {} yet'.format(self.directory))
+        return cast(np.ndarray, np.load(self._path('results.npy'), mmap_mode='r'))
+
+    def result_set(self) -> ResultSet:
+        """
+        The memory-mapped results labelled with the analytes and parameter
+        rows of the store; rows that are not done yet are nan.
+        """
+        return ResultSet(self.results(), self.analytes, self.params)
+
+    def observations(self, analyte: Optional[str] = None) -> np.ndarray:
+        """
+        (n_runs, n_steps) memory-mapped results of one analyte, the layout
+        the sensitivity analyses take as Y. Requires a complete ensemble.
+
+        analyte: name of the analyte; Defaults to the first stored one
+        """
+        if not self.complete:
+            raise RuntimeError('{} of {} runs in {} are missing'.format(
+                len(self.missing()), len(self), self.directory))
+        i = 0 if analyte is None else self.analytes.index(analyte)
+        return cast(np.ndarray, self.results()[:, :, i])
+
+
+def _atomic_save(filename: str, array: np.ndarray) -> None:
+    # readers never see a partially written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp, filename)
+    return
@@ -0,0 +1,262 @@
+from typing import Callable, Optional, Sequence, Tuple, cast
+
+import numpy as np
+from scipy.linalg import cho_solve, solve_triangular
+from scipy.optimize import minimize as scipy_minimize
+
+from .simulation import Problem, SimulationRunner, failed_runs
+
+
+class GaussianProcess:
+    """
+    Gaussian process regression with a squared exponential kernel and one
+    length scale per input, shared by every output column.
+
+    Inputs are scaled to the unit box given by lower and upper, outputs are
+    standardized per column. Points added with add are folded into the
+    Cholesky factor incrementally; the hyperparameters and the output
+    scaling are refitted by fit, which add calls every refit_every points.
+    """
+    def __init__(self, lower: Sequence[float], upper: Sequence[float], noise: float = 1e-6,
+                 refit_every: int = 50) -> None:
+        """
+        lower, upper: bounds of the inputs
+        noise:        lower bound of the noise variance, in standardized units
+        refit_every:  refit the hyperparameters after this many added points
+        """
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.noise = noise
+        self.refit_every = refit_every
+        # log length scales, log signal variance, log noise variance
+        self.theta = np.concatenate([np.log(np.full(len(self.lower), 0.3)), [0.0, np.log(noise)]])
+        self.X = np.empty((0, len(self.lower)))
+        self.Y = np.empty((0, 0))
+        self._L: Optional[np.ndarray] = None
+        self._alpha: Optional[np.ndarray] = None
+        self._y_mean = np.zeros(0)
+        self._y_std = np.ones(0)
+        self._since_fit = 0
+        return
+
+    def __len__(self) -> int:
+        return len(self.X)
+
+    def _unit(self, X: np.ndarray) -> np.ndarray:
+        width = np.where(self.upper > self.lower, self.upper - self.lower, 1.0)
+        return cast(np.ndarray, (np.asarray(X, dtype=float) - self.lower) / width)
+
+    def _kernel(self, A: np.ndarray, B: np.ndarray, theta: np.ndarray) -> np.ndarray:
+        scale = np.exp(theta[:len(self.lower)])
+        d2 = np.sum(np.square((A[:, None, :] - B[None, :, :]) / scale), axis=2)
+        return cast(np.ndarray, np.exp(theta[-2]) * np.exp(-0.5 * d2))
+
+    def _gram(self, U: np.ndarray, theta: np.ndarray) -> np.ndarray:
+        return cast(np.ndarray, self._kernel(U, U, theta) + (np.exp(theta[-1]) + 1e-10) * np.eye(len(U)))
+
+    def _neg_log_likelihood(self, theta: np.ndarray, U: np.ndarray, Z: np.ndarray) -> float:
+        # marginal likelihood of all (standardized) output columns
+        try:
+            L = np.linalg.cholesky(self._gram(U, theta))
+        except np.linalg.LinAlgError:
+            return 1e25
+        alpha = cho_solve((L, True), Z)
+        return float(0.5 * np.sum(Z * alpha) + Z.shape[1] * np.sum(np.log(np.diag(L))))
+
+    def fit(self, X: Optional[np.ndarray] = None, Y: Optional[np.ndarray] = None) -> 'GaussianProcess':
+        """
+        Fit the hyperparameters by maximum marginal likelihood, on X and Y if
+        given (replacing the training data) or on the data added so far.
+        """
+        if X is not None and Y is not None:
+            X = np.asarray(X, dtype=float)
+            Y = np.asarray(Y, dtype=float).reshape(len(X), -1)
+            self._check(X, Y)
+            self.X, self.Y = X, Y
+        if len(self.X) == 0:
+            raise ValueError('no training data')
+        self._y_mean = self.Y.mean(axis=0)
+        std = self.Y.std(axis=0)
+        self._y_std = np.where(std > 0, std, 1.0)
+        U, Z = self._unit(self.X), (self.Y - self._y_mean) / self._y_std
+
+        bounds = [(np.log(1e-3), np.log(10.0))] * len(self.lower) + [(np.log(1e-3), np.log(1e3)),
+                                                                      (np.log(self.noise), 0.0)]
+        best = scipy_minimize(self._neg_log_likelihood, self.theta, args=(U, Z), method='L-BFGS-B',
+                              bounds=bounds)
+        if np.isfinite(best.fun):
+            self.theta = best.x
+        self._factor(U, Z)
+        self._since_fit = 0
+        return self
+
+    @staticmethod
+    def _check(X: np.ndarray, Y: np.ndarray) -> None:
+        # e.g. the nan rows of failed runs, see simulation.failed_runs
+        if not (np.all(np.isfinite(X)) and np.all(np.isfinite(Y))):
+            raise ValueError('training data must be finite')
+
+    def _factor(self, U: np.ndarray, Z: np.ndarray) -> None:
+        self._L = np.linalg.cholesky(self._gram(U, self.theta))
+        self._alpha = cho_solve((self._L, True), Z)
+
+    def add(self, X: np.ndarray, Y: np.ndarray) -> None:
+        """
+        Add training points. The Cholesky factor is extended with the new
+        rows; the hyperparameters are refitted every refit_every points.
+        """
+        X = np.asarray(X, dtype=float).reshape(-1, len(self.lower))
+        if len(X) == 0:
+            return
+        Y = np.asarray(Y, dtype=float).reshape(len(X), -1)
+        # checked before anything is stacked, so a bad batch leaves the model as it was
+        self._check(X, Y)
+        if len(self.Y) and Y.shape[1] != self.Y.shape[1]:
+            raise ValueError('{} outputs per point, the model has {}'.format(Y.shape[1], self.Y.shape[1]))
+        if self._L is None or self._since_fit + len(X) >= self.refit_every:
+            self.X = np.vstack([self.X, X])
+            self.Y = np.vstack([self.Y, Y]) if len(self.Y) else Y
+            self.fit()
+            return
+
+        # block Cholesky update with fixed hyperparameters
+        U_old, U_new = self._unit(self.X), self._unit(X)
+        B = solve_triangular(self._L, self._kernel(U_old, U_new, self.theta), lower=True)
+        C = np.linalg.cholesky(self._gram(U_new, self.theta) - B.T @ B)
+        n = len(self.X)
+        L = np.zeros((n + len(X), n + len(X)))
+        L[:n, :n], L[n:, :n], L[n:, n:] = self._L, B.T, C
+        self._L = L
+        self.X = np.vstack([self.X, X])
+        self.Y = np.vstack([self.Y, Y])
+        self._alpha = cho_solve((self._L, True), (self.Y - self._y_mean) / self._y_std)
+        self._since_fit += len(X)
+        return
+
+    def predict(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Predictive mean and standard deviation, both (len(X), n_outputs).
+        """
+        if self._L is None or self._alpha is None:
+            raise RuntimeError('the surrogate has not been fitted')
+        U = self._unit(X)
+        Ks = self._kernel(U, self._unit(self.X), self.theta)
+        mean = Ks @ self._alpha
+        v = solve_triangular(self._L, Ks.T, lower=True)
+        var = np.maximum(np.exp(self.theta[-2]) - np.sum(np.square(v), axis=0), 0.0)
+        return mean * self._y_std + self._y_mean, np.sqrt(var)[:, None] * self._y_std
+
+    def loo_error(self) -> np.ndarray:
+        """
+        Leave-one-out RMSE of every output column, in output units; the
+        prediction error expected at points like the training points.
+        """
+        if self._L is None or self._alpha is None:
+            raise RuntimeError('the surrogate has not been fitted')
+        K_inv = cho_solve((self._L, True), np.eye(len(self._L)))
+        resid = self._alpha / np.diag(K_inv)[:, None] * self._y_std
+        return cast(np.ndarray, np.sqrt(np.mean(np.square(resid), axis=0)))
+
+
+class Emulator:
+    """
+    Surrogate of a Problem's analyte curves, trained on the runs made
+    through a SimulationRunner.
+
+    run and screen answer parameter sets from the surrogate where it is
+    confident and send only the uncertain or promising ones to phreeqc;
+    every run made is added to the surrogate.
+    """
+    def __init__(self, sim: SimulationRunner, problem: Problem, analyte: str = 'U',
+                 model: Optional[GaussianProcess] = None) -> None:
+        """
+        model: regression model with fit / add / predict / loo_error;
+               a GaussianProcess over problem.bounds if not provided
+        """
+        self.sim = sim
+        self.problem = problem
+        self.analyte = analyte
+        if model is None:
+            model = GaussianProcess([b.lower for b in problem.bounds], [b.upper for b in problem.bounds])
+        self.model = model
+        self.num_runs = 0
+        return
+
+    def simulate(self, params: np.ndarray) -> np.ndarray:
+        """
+        Run params through phreeqc and train on the results of the runs
+        that did not fail.
+
+        return: (len(params), n_steps) concentrations; nan rows for runs
+                that failed, see SimulationRunner's on_error
+        """
+        params = np.asarray(params, dtype=float)
+        concs = self.sim.run_results(self.problem, params, [self.analyte])[self.analyte]
+        if concs.shape[1] == 0 and len(self.model):
+            # every run failed; nan rows as wide as the trained outputs
+            concs = np.full((len(params), self.model.Y.shape[1]), np.nan)
+        ok = ~failed_runs(concs)
+        self.model.add(params[ok], concs[ok])
+        self.num_runs += len(params)
+        return cast(np.ndarray, concs)
+
+    @staticmethod
+    def _costs(func: Callable[[np.ndarray], np.ndarray], concs: np.ndarray, minimize: bool) -> np.ndarray:
+        # costs of concentrations; failed runs get the worst possible cost
+        costs = np.asarray(func(concs * 1e6), dtype=float).reshape(-1)
+        costs[failed_runs(concs)] = np.inf if minimize else -np.inf
+        return costs
+
+    @property
+    def error(self) -> np.ndarray:
+        """
+        Leave-one-out RMSE of the surrogate per step.
+        """
+        return self.model.loo_error()
+
+    def _uncertain(self, std: np.ndarray, max_std: float) -> np.ndarray:
+        # predictive std above max_std times the spread of the training outputs
+        spread = np.std(self.model.Y, axis=0)
+        return cast(np.ndarray, np.any(std > max_std * np.where(spread > 0, spread, 1.0), axis=1))
+
+    def run(self, params: np.ndarray, max_std: float = 0.05) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Concentrations of every row of params. Rows whose predictive std
+        exceeds max_std times the spread of the training outputs are run
+        through phreeqc, the rest are predicted.
+
+        return: (len(params), n_steps) concentrations and the mask of rows
+                that were simulated; rows whose run failed are nan
+        """
+        params = np.asarray(params, dtype=float)
+        if len(self.model) == 0:
+            return self.simulate(params), np.ones(len(params), dtype=bool)
+        concs, std = self.model.predict(params)
+        simulated = self._uncertain(std, max_std)
+        if np.any(simulated):
+            concs[simulated] = self.simulate(params[simulated])
+        return concs, simulated
+
+    def screen(self, params: np.ndarray, func: Callable[[np.ndarray], np.ndarray], keep: float = 0.1,
+               max_std: float = 0.05, minimize: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Cost of every row of params, pre-screened by the surrogate. The keep
+        fraction of rows with the best predicted cost and every uncertain
+        row are run through phreeqc; the other costs are predicted.
+
+        func:    vectorized cost of an (n, n_steps) matrix of concentrations
+                 scaled by 1e6, as grid_search_f takes, e.g. estimators.rss_func
+        return:  (len(params),) costs and the mask of rows that were simulated;
+                 rows whose run failed cost inf (-inf if not minimize)
+        """
+        params = np.asarray(params, dtype=float)
+        if len(self.model) == 0:
+            return self._costs(func, self.simulate(params), minimize), np.ones(len(params), dtype=bool)
+        concs, std = self.model.predict(params)
+        costs = self._costs(func, concs, minimize)
+        order = np.argsort(costs if minimize else -costs)
+        simulated = self._uncertain(std, max_std)
+        simulated[order[:int(np.ceil(keep * len(params)))]] = True
+        if np.any(simulated):
+            costs[simulated] = self._costs(func, self.simulate(params[simulated]), minimize)
+        return costs, simulated
@@ -1,10 +1,192 @@
 """
-    Dummy conftest.py for ml4scm.
+    conftest.py for ml4scm.
+
+    Provides a stand-in ``phreeqc`` executable so that the simulation plumbing
+    can be exercised without a PHREEQC installation.  The fake binary sums all
+    numbers found in the database and in each ``END``-delimited simulation of
+    the input file and writes a selected-output file with three ``react``
+    steps per simulation.  ``fake_iphreeqc`` builds a shared library with the
+    same behaviour behind the IPhreeqc C API (skipped without a C compiler).
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     - https://docs.pytest.org/en/stable/fixture.html
     - https://docs.pytest.org/en/stable/writing_plugins.html
 """
 
-# import pytest
+import os
+import shutil
+import stat
+import subprocess
+import sys
+
+import pytest
+
+FAKE_PHREEQC = r'''#!{python}
+import re
+import sys
+
+
+def numbers(text):
+    return [float(x) for x in re.findall(r'(?<![\w.])-?\d+\.?\d*(?:[eE][-+]?\d+)?', text)]
+
+
+in_file, out_file, db_file = sys.argv[1:4]
+with open(db_file) as fd:
+    db_total = sum(numbers(fd.read()))
+
+sel_file = 'selected.out'
+blocks = [[]]
+with open(in_file) as fd:
+    for line in fd:
+        m = re.match(r'\s*-file\s+(.*?)\s*$', line)
+        if m:
+            sel_file = m.group(1)
+            continue
+        if line.strip().upper() == 'END':
+            blocks.append([])
+        else:
+            blocks[-1].append(line)
+if not ''.join(blocks[-1]).strip():
+    blocks.pop()
+
+with open(sel_file, 'w') as fd:
+    fd.write('         sim\t     state\t        pH\t         U\t\n')
+    for sim, block in enumerate(blocks, start=1):
+        total = db_total + sum(numbers(''.join(block)))
+        fd.write('{:12d}\t{:>10s}\t{:12.4f}\t{:12.4e}\t\n'.format(sim, 'i_soln', 7.0, 0.0))
+        for step in range(1, 4):
+            fd.write('{:12d}\t{:>10s}\t{:12.4f}\t{:12.4e}\t\n'.format(sim, 'react', 7.0 + step, total * step * 1e-6))
+with open(out_file, 'w') as fd:
+    fd.write('fake phreeqc listing\n')
+print('fake phreeqc done')
+'''
+
+
+@pytest.fixture
+def fake_phreeqc(tmp_path):
+    """Path to an executable stand-in for the phreeqc binary."""
+    path = os.path.join(str(tmp_path), 'bin', 'phreeqc')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fd:
+        fd.write(FAKE_PHREEQC.replace('{python}', sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+@pytest.fixture
+def sim_files(tmp_path):
+    """A minimal database template and input file in ``tmp_path``."""
+    with open(os.path.join(str(tmp_path), 'db.tpl'), 'w') as fd:
+        fd.write('# template header, discarded\n')
+        fd.write('SOLUTION_MASTER_SPECIES\n')
+        fd.write('log_k PAR_A\n')
+        fd.write('delta_h PAR_B\n')
+    with open(os.path.join(str(tmp_path), 'input.pqi'), 'w') as fd:
+        fd.write('SELECTED_OUTPUT\n')
+        fd.write('    -file output.sel\n')
+        fd.write('END\n')
+    return {
+        'db_template_filename': os.path.join(str(tmp_path), 'db'),
+        'input_filename': os.path.join(str(tmp_path), 'input.pqi'),
+        'output_filename': 'output.sel',
+    }
+
+
+FAKE_IPHREEQC = r'''
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define MAX_IDS 64
+static double db_total[MAX_IDS];
+static char selected[MAX_IDS][1 << 16];
+static char error[MAX_IDS][256];
+static int used[MAX_IDS];
+static int null_strings = 0;
+
+static double sum_numbers(const char *text, size_t len)
+{
+    char *copy = strndup(text, len), *save = NULL, *tok;
+    double total = 0.0;
+    for (tok = strtok_r(copy, " \t\r\n", &save); tok; tok = strtok_r(NULL, " \t\r\n", &save)) {
+        char *end;
+        double v = strtod(tok, &end);
+        if (end != tok && *end == '\0')
+            total += v;
+    }
+    free(copy);
+    return total;
+}
+
+int CreateIPhreeqc(void)
+{
+    int id;
+    for (id = 0; id < MAX_IDS; id++)
+        if (!used[id]) {
+            used[id] = 1;
+            return id;
+        }
+    return -1;
+}
+int DestroyIPhreeqc(int id) { used[id] = 0; return 0; }
+/* test hooks: instances alive, and NULL in place of empty strings */
+int LiveInstances(void) { int id, n = 0; for (id = 0; id < MAX_IDS; id++) n += used[id]; return n; }
+void SetNullStrings(int tf) { null_strings = tf; }
+int SetOutputFileOn(int id, int tf) { return 0; }
+int SetErrorFileOn(int id, int tf) { return 0; }
+int SetLogFileOn(int id, int tf) { return 0; }
+int SetSelectedOutputFileOn(int id, int tf) { return 0; }
+int SetSelectedOutputStringOn(int id, int tf) { return 0; }
+const char *GetErrorString(int id) { return null_strings ? NULL : error[id]; }
+const char *GetWarningString(int id) { return null_strings ? NULL : ""; }
+const char *GetSelectedOutputString(int id) { return selected[id]; }
+
+int LoadDatabaseString(int id, const char *input)
+{
+    db_total[id] = sum_numbers(input, strlen(input));
+    return 0;
+}
+
+int RunString(int id, const char *input)
+{
+    const char *line = input, *block = input;
+    char *out = selected[id];
+    int sim = 0, step;
+    out += sprintf(out, "sim\tstate\tpH\tU\t\n");
+    while (*line) {
+        const char *eol = strchr(line, '\n');
+        size_t len = eol ? (size_t)(eol - line) : strlen(line);
+        char buf[16] = "", word[8] = "";
+        if (len < sizeof(buf)) {
+            memcpy(buf, line, len);
+            buf[len] = '\0';
+            sscanf(buf, "%7s", word);
+        }
+        if (strcmp(word, "END") == 0) {
+            double total = db_total[id] + sum_numbers(block, line - block);
+            sim++;
+            out += sprintf(out, "%d\ti_soln\t7\t0\t\n", sim);
+            for (step = 1; step <= 3; step++)
+                out += sprintf(out, "%d\treact\t%g\t%.10e\t\n", sim, 7.0 + step, total * step * 1e-6);
+            block = eol ? eol + 1 : line + len;
+        }
+        line = eol ? eol + 1 : line + len;
+    }
+    error[id][0] = '\0';
+    return 0;
+}
+'''
+
+
+@pytest.fixture
+def fake_iphreeqc(tmp_path):
+    """Path to a shared library standing in for libiphreeqc."""
+    cc = shutil.which('cc') or shutil.which('gcc')
+    if cc is None:
+        pytest.skip('no C compiler to build the IPhreeqc stand-in')
+    src = os.path.join(str(tmp_path), 'fake_iphreeqc.c')
+    lib = os.path.join(str(tmp_path), 'libfake_iphreeqc.so')
+    with open(src, 'w') as fd:
+        fd.write(FAKE_IPHREEQC)
+    subprocess.run([cc, '-shared', '-fPIC', '-o', lib, src], check=True)
+    return lib
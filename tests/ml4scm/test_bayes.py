@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from ml4scm.bayes import bayes_param_count, bayes_param_count_by_original, param_counts_by_generation
+
+
+def _reference_count(pp_mtrx, original_params, start):
+    # the list.index based counting bayes_param_count used to do
+    counts = np.zeros(len(original_params))
+    for i in range(start, len(pp_mtrx)):
+        for p in pp_mtrx[i]:
+            counts[original_params.tolist().index(np.asarray(p).tolist())] += 1
+    return counts
+
+
+@pytest.mark.parametrize('shape', [(6,), (6, 2), (6, 3)])
+def test_param_counts_match_list_index(shape):
+    rng = np.random.default_rng(1)
+    original = rng.integers(0, 4, size=shape).astype(float)
+    original[3] = original[1]  # duplicates resolve to the first occurrence
+    pp = original[rng.integers(0, len(original), size=(5, len(original)))]
+    pp[0] = original
+    assert np.array_equal(bayes_param_count(pp), 1 + _reference_count(pp, original, 1))
+    assert np.array_equal(bayes_param_count_by_original(pp, original), _reference_count(pp, original, 0))
+    assert param_counts_by_generation(pp, original).shape == (5, len(original))
+
+
+def test_param_counts_reject_unknown_particles():
+    original = np.array([[1.0, 2.0], [3.0, 4.0]])
+    with pytest.raises(ValueError):
+        bayes_param_count_by_original(np.array([[[1.0, 2.0], [5.0, 6.0]]]), original)
+
+
+def test_bayes_resample_reuses_runs_and_stops_early(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    from ml4scm.bayes import bayes_resample
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import Bound, Problem, SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0.5, 2), Bound(0.5, 4)], num_vars=2, **sim_files)
+    runner = SimulationRunner(PHREEQC(fake_phreeqc))
+    exp_U = [3.0, 6.0, 9.0]
+
+    full = bayes_resample(runner, problem, exp_U, num_trials=8, num_sets=20, pool_size=10, rng=0)
+    assert full['pp'].shape == (8, 20, 2) and full['stopped'] == 'num_trials'
+    assert runner.metrics.rows <= 20  # only the first generation is simulated
+    d = full['diagnostics']
+    assert np.all((d['ess'] >= 1) & (d['ess'] <= 20))
+    assert np.isnan(d['drift'][0]) and np.all(d['drift'][1:] >= 0)
+    # later generations only hold copies of simulated particles
+    assert np.allclose(full['cc'][1:, :, 0], np.sum(full['pp'][1:], axis=2) * 1e-6, rtol=1e-3)
+
+    early = bayes_resample(runner, problem, exp_U, num_trials=50, num_sets=20, pool_size=10, rng=0, tol=1e-3)
+    assert early['stopped'] in ('tol', 'collapsed') and len(early['pp']) < 50
+    n = min(len(early['pp']), len(full['pp']))
+    assert np.array_equal(early['pp'][:n], full['pp'][:n])  # same draws up to the stop
+
+    balanced = bayes_resample(runner, problem, exp_U, num_trials=8, num_sets=20, pool_size=10, rng=0,
+                              ess_threshold=1e-3)
+    assert balanced['stopped'] == 'ess' and len(balanced['pp']) == 1
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pytest
+
+from ml4scm.cache import RunCache
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import SimulationRunner
+
+
+def test_run_sims_dedups_and_reuses_cache(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [1.0, 2.0]])
+    kwargs = dict(values_mtrx=values, pars=['PAR_A', 'PAR_B'], analytes=['U'], **sim_files)
+    runner = SimulationRunner(PHREEQC(fake_phreeqc), cache=RunCache(str(tmp_path / 'cache')))
+    first = runner.run_sims(**kwargs)
+    assert np.array_equal(first[0], first[2])
+    # duplicate rows get their own arrays
+    first[0][1] = 0
+    assert not np.array_equal(first[0], first[2])
+    first[0] = first[2].copy()
+    assert len(runner.cache._entries()) == 2
+
+    def no_runs(values_mtrx, **kwargs):
+        assert len(values_mtrx) == 0
+        return []
+    monkeypatch.setattr(runner, '_execute', no_runs)
+    second = runner.run_sims(**kwargs)
+    for a, b in zip(first, second):
+        assert np.array_equal(a, b)
+    assert second[0] is not second[2]
+
+
+def test_run_cache_evicts_least_recently_used(tmp_path):
+    cache = RunCache(str(tmp_path), max_bytes=2500)
+    for key in ['aa01', 'bb02', 'cc03']:
+        cache.put(key, np.zeros(100))
+        os.utime(cache._path(key), (0, {'aa01': 1, 'bb02': 3, 'cc03': 2}[key]))
+    cache.put('dd04', np.zeros(100))
+    assert cache.get('aa01') is None
+    assert cache.get('bb02') is not None
+    assert cache.get('dd04') is not None
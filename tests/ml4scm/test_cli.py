@@ -0,0 +1,45 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from ml4scm import sampling
+from ml4scm.cli import load_problem, main, shard_rows
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import SimulationRunner
+
+
+def test_sharded_run_and_merge(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('problem.json', 'w') as fd:
+        json.dump({'names': ['PAR_A', 'PAR_B'], 'bounds': [[0, 1], [2, 3]], 'db_template_filename': 'db',
+                   'input_filename': 'input.pqi', 'output_filename': 'output.sel'}, fd)
+    problem = load_problem('problem.json')
+    assert problem.db_template_filename == sim_files['db_template_filename']
+
+    for i in range(3):
+        main(['run', 'problem.json', '-n', '7', '--seed', '1', '--shard', '{}/3'.format(i), '--phreeqc',
+              fake_phreeqc, '--analytes', 'U', 'pH', '-o', 'shards' + os.sep])
+    assert not os.path.exists('db.txt')
+    with np.load('shards/shard-00001-of-00003.npz') as shard:
+        assert list(shard['rows']) == list(shard_rows(7, 1, 3)) == [3, 4]
+
+    with pytest.raises(SystemExit):
+        main(['merge', 'shards/shard-00000-of-00003.npz', 'shards/shard-00002-of-00003.npz'])
+    main(['merge'] + ['shards/shard-{:05d}-of-00003.npz'.format(i) for i in range(3)] + ['-o', 'all.npz'])
+
+    params = sampling.sample(problem.bounds, 7, method='lhs', rng=1)
+    expected = SimulationRunner(PHREEQC(fake_phreeqc)).run_problem_matrix(problem, params, ['U', 'pH'])
+    with np.load('all.npz') as merged:
+        assert np.allclose(merged['params'], params)
+        assert np.allclose(merged['results'], expected)
+        assert list(merged['analytes']) == ['U', 'pH']
+
+    # the same design from a parameter file; shards of a sampled design need a seed
+    main(['sample', 'problem.json', '-n', '7', '--seed', '1', '-o', 'params.npy'])
+    main(['run', 'problem.json', '--params', 'params.npy', '--phreeqc', fake_phreeqc, '-o', 'one.npz'])
+    with np.load('one.npz') as shard:
+        assert np.allclose(shard['results'], expected[:, :, :1])
+    with pytest.raises(SystemExit):
+        main(['run', 'problem.json', '--shard', '0/2', '--phreeqc', fake_phreeqc])
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import ml4scm
+from ml4scm.cluster import Coordinator, TaskFailed
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import Bound, Problem, SimulationRunner
+
+# kills the worker running it the first time, then behaves like phreeqc.
+# the marker is created atomically: workers starting at once must not all
+# see it missing and all die
+KILL_ONCE = '''#!{python}
+import os, signal, sys
+try:
+    os.close(os.open({marker!r}, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+except FileExistsError:
+    os.execv({phreeqc!r}, [{phreeqc!r}] + sys.argv[1:])
+os.kill(os.getppid(), signal.SIGKILL)
+sys.exit(1)
+'''
+
+
+def _workers(coordinator, num_workers):
+    env = dict(os.environ, ML4SCM_AUTHKEY='secret',
+               PYTHONPATH=os.path.dirname(os.path.dirname(ml4scm.__file__)))
+    address = '{}:{}'.format(*coordinator.address)
+    return [subprocess.Popen([sys.executable, '-m', 'ml4scm.cluster', address], env=env)
+            for _ in range(num_workers)]
+
+
+def test_coordinator_reassigns_tasks_of_dead_workers(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    wrapper = str(tmp_path / 'kill_once')
+    with open(wrapper, 'w') as fd:
+        fd.write(KILL_ONCE.format(python=sys.executable, marker=str(tmp_path / 'killed'), phreeqc=fake_phreeqc))
+    os.chmod(wrapper, 0o755)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    params = np.random.default_rng(0).uniform(0, 10, size=(12, 2))
+    expected = SimulationRunner(PHREEQC(fake_phreeqc)).run_problem_matrix(problem, params)
+
+    with Coordinator(authkey='secret', timeout=10) as coordinator:
+        workers = _workers(coordinator, 3)
+        try:
+            runner = SimulationRunner(PHREEQC(wrapper), coordinator=coordinator)
+            assert np.allclose(runner.run_problem_matrix(problem, params), expected)
+            assert runner.metrics.finished == len(params) and runner.metrics.in_flight == 0
+            # a task is in flight once a worker has it, and each worker holds one
+            assert runner.metrics.started == len(params) and runner.metrics.max_in_flight <= 3
+            # tasks wait in the coordinator's queue until a worker takes them
+            assert runner.metrics.max_queued == len(params) - 1 and runner.metrics.queued == 0
+            assert [w.poll() for w in workers].count(-9) == 1
+
+            runner = SimulationRunner(PHREEQC(str(tmp_path / 'missing')), coordinator=coordinator)
+            with pytest.raises(TaskFailed):
+                runner.run_problem_matrix(problem, params[:2])
+            assert runner.metrics.failed == 1 and runner._waiting == 0
+        finally:
+            coordinator.close()
+            for worker in workers:
+                worker.wait(timeout=10)
+    assert [w.returncode for w in workers].count(0) == 2
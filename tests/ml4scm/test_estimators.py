@@ -0,0 +1,40 @@
+import numpy as np
+
+from ml4scm.estimators import log_likelihood, log_likelihoods, normalize_log_weights, ll_func
+
+
+def test_log_likelihoods_match_single_run_form():
+    rng = np.random.default_rng(0)
+    concs = rng.random((5, 6)) * 1e-6
+    measured = rng.random(6)
+    ll = log_likelihoods(concs, measured)
+    for row, value in zip(concs, ll):
+        scaled = row * 1e6
+        expected = -np.sum((scaled - measured) ** 2) / np.std(scaled) ** 2
+        assert np.isclose(value, expected)
+        assert np.isclose(np.exp(value), log_likelihood(row, measured))
+    assert np.allclose(log_likelihoods(concs, measured, sigma=[2.0] * 6),
+                       -0.5 * np.sum(((concs * 1e6 - measured) / 2.0) ** 2, axis=1))
+
+
+def test_normalize_log_weights_survives_underflow():
+    w = normalize_log_weights(np.array([-5000.0, -5001.0, -7000.0]))
+    assert np.isclose(np.sum(w), 1.0)
+    assert np.isclose(w[0] / w[1], np.e)
+
+
+def test_ll_func_is_vectorized():
+    f = ll_func([1.0, 2.0, 3.0])
+    concs = np.array([[1.1, 2.2, 2.9], [0.5, 2.0, 3.5]])
+    assert np.allclose(f(concs), [f(row) for row in concs])
+
+
+def test_ll_func_scores_a_perfect_fit_highest():
+    # concs as grid_search_f passes them, already scaled by 1e6
+    exp_U = [3.0, 6.0, 9.0]
+    concs = np.array([[3.0, 6.0, 9.0], [3.5, 6.0, 8.0], [300.0, 600.0, 900.0]])
+    for sigma in [None, 0.1]:
+        ll = ll_func(exp_U, sigma)(concs)
+        assert ll[0] == 0 and np.argmax(ll) == 0 and np.all(np.isfinite(ll))
+    # far too small to survive exp, but still weighted in log space
+    assert np.exp(ll[1]) < 1e-20 and np.isclose(normalize_log_weights(ll)[0], 1.0)
@@ -0,0 +1,42 @@
+import numpy as np
+
+from ml4scm.estimators import ll_func, rss_func
+from ml4scm.grid_search import adaptive_grid_search, adaptive_search, grid_search_f, grid_search_rss
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import Bound, Problem, SimulationRunner
+
+
+def test_adaptive_search_beats_dense_grid_with_fewer_evaluations():
+    def rosenbrock(p):
+        return (1 - p[:, 0]) ** 2 + 100 * (p[:, 1] - p[:, 0] ** 2) ** 2
+
+    points, costs = adaptive_search(rosenbrock, [-2, -2], [2, 2], budget=250)
+    assert len(points) == len(costs) <= 250
+    assert len(np.unique(points, axis=0)) == len(points)
+    xs = np.linspace(-2, 2, 50)
+    grid = np.array([[x, y] for x in xs for y in xs])
+    assert costs.min() <= rosenbrock(grid).min()
+    assert np.allclose(points[np.argmin(costs)], [1, 1], atol=0.05)
+
+    # without a budget the search stops on the tolerance
+    points, costs = adaptive_search(lambda p: -np.sum(np.square(p - 0.3), axis=1), [0, 0], [1, 1],
+                                    budget=10 ** 6, tol=1e-3, minimize=False)
+    assert len(points) < 1000
+    assert np.allclose(points[np.argmax(costs)], [0.3, 0.3], atol=1e-3)
+
+
+def test_adaptive_grid_search_runs_problem(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 2), Bound(0, 4)], num_vars=2, **sim_files)
+    runner = SimulationRunner(PHREEQC(fake_phreeqc))
+    exp_U = [3.0, 6.0, 9.0]  # PAR_A + PAR_B == 3
+    params, costs = adaptive_grid_search(runner, problem, rss_func(exp_U), budget=60, tol=0.05)
+    assert len(params) <= 60
+    assert np.allclose(costs, grid_search_rss(runner, problem, params, exp_U)[:, 0])
+    assert abs(np.sum(params[np.argmin(costs)]) - 3) < 0.05
+
+    # log likelihoods peak at 0, on the runs that fit exactly
+    ll = grid_search_f(runner, problem, np.array([[1.0, 2.0], [1.5, 2.0], [2.0, 4.0]]), ll_func(exp_U, 0.1))
+    assert np.isclose(ll[0, 0], 0, atol=1e-6) and np.argmax(ll) == 0
+    params, ll = adaptive_grid_search(runner, problem, ll_func(exp_U, 0.1), budget=60, tol=0.05, minimize=False)
+    assert abs(np.sum(params[np.argmax(ll)]) - 3) < 0.05
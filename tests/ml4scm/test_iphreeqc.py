@@ -0,0 +1,54 @@
+import numpy as np
+
+from ml4scm.iphreeqc import IPhreeqcEngine
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import Bound, Problem, SimulationRunner
+
+
+def test_iphreeqc_engine_matches_subprocess_engine(fake_phreeqc, fake_iphreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [3.0, 4.5]])
+    expected = SimulationRunner(PHREEQC(fake_phreeqc)).run_problem(problem, values, analytes=['U'])
+
+    engine = IPhreeqcEngine(fake_iphreeqc)
+    before = set(tmp_path.iterdir())
+    results = SimulationRunner(PHREEQC(engine=engine)).run_problem(problem, values, analytes=['U'])
+    assert set(tmp_path.iterdir()) == before  # nothing rendered to disk
+    for a, b in zip(results, expected):
+        assert np.allclose(a, b, rtol=1e-3)
+
+    parallel = SimulationRunner(PHREEQC(engine=engine), max_workers=2).run_problem(problem, values, analytes=['U'])
+    for a, b in zip(parallel, results):
+        assert np.allclose(a, b)
+
+
+def test_iphreeqc_instances_are_destroyed(fake_iphreeqc, sim_files, tmp_path, monkeypatch):
+    import ctypes
+    import gc
+    monkeypatch.chdir(tmp_path)
+    lib = ctypes.CDLL(fake_iphreeqc)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [3.0, 4.5]])
+    engine = IPhreeqcEngine(fake_iphreeqc)
+
+    # the instances of the submit threads go with the threads
+    with SimulationRunner(PHREEQC(engine=engine), max_workers=2) as runner:
+        for future in runner.submit(problem, values, analytes=['U']):
+            future.result()
+        assert lib.LiveInstances() > 0
+    gc.collect()
+    assert lib.LiveInstances() == 0
+
+    # NULL strings read as empty ones
+    lib.SetNullStrings(1)
+    try:
+        result = engine.run_strings('log_k 1\n', 'SOLUTION\nEND\n', ['U'])
+    finally:
+        lib.SetNullStrings(0)
+    assert result.stdout == '' and result.stderr == ''
+    assert lib.LiveInstances() == 1
+    engine.close()
+    assert lib.LiveInstances() == 0
+    assert engine.run_strings('log_k 1\n', 'SOLUTION\nEND\n', ['U']).output.shape == (2, 3)
+    engine.close()
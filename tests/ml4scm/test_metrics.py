@@ -0,0 +1,100 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from ml4scm.metrics import JsonLinesObserver, RunObserver
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import Bound, Problem, SimulationRunner
+
+
+def test_runner_reports_stage_timings_and_metrics(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+
+    result = PHREEQC(fake_phreeqc).run_strings('log_k 1\n', 'SELECTED_OUTPUT\n    -file out.sel\nEND\n', ['U'])
+    assert set(result.timings) == {'render', 'run', 'parse'}
+    assert result.bytes_written > 0 and result.bytes_read > 0
+
+    lines = io.StringIO()
+    for workers in [None, 2]:
+        runner = SimulationRunner(PHREEQC(fake_phreeqc), max_workers=workers, observers=[JsonLinesObserver(lines)])
+        runner.run_problem(problem, values, analytes=['U'])
+        metrics = runner.metrics.as_dict()
+        assert metrics['started'] == metrics['finished'] == metrics['rows'] == 3
+        assert metrics['in_flight'] == 0 and metrics['max_in_flight'] >= 1
+        # every run but the first was waiting when the first one started
+        assert metrics['queued'] == 0 and metrics['max_queued'] == 2
+        assert metrics['latency']['p50'] <= metrics['latency']['p99']
+        assert set(metrics['timings']) == {'render', 'run', 'parse'}
+        assert metrics['bytes_written'] > 0 and metrics['bytes_read'] > 0
+        assert json.loads(runner.metrics.to_json())['rows'] == 3
+    events = [json.loads(line) for line in lines.getvalue().splitlines()]
+    kinds = [e['event'] for e in events]
+    assert kinds.count('start') == kinds.count('finish') == 6
+    # the serial runs: the queue drains one run at a time
+    assert [e['queued'] for e in events[:6]] == [2, 2, 1, 1, 0, 0]
+
+    class Failures(RunObserver):
+        def __init__(self):
+            self.errors = []
+
+        def on_failure(self, event):
+            self.errors.append(event.error)
+
+    failures = Failures()
+    runner = SimulationRunner(PHREEQC(fake_phreeqc), observers=[failures])
+
+    def broken(**kwargs):
+        raise RuntimeError('phreeqc failed')
+    monkeypatch.setattr(runner.phreeqc, 'run', broken)
+    with pytest.raises(RuntimeError):
+        runner.run_problem(problem, values, analytes=['U'])
+    assert len(failures.errors) == 1 and runner.metrics.failed == 1
+    assert runner.metrics.in_flight == 0
+
+
+def test_events_count_running_runs_on_every_path(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    import asyncio
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.arange(12, dtype=float).reshape(6, 2)
+
+    # queued runs are not in flight yet
+    runner = SimulationRunner(PHREEQC(fake_phreeqc), max_workers=2)
+    runner.run_problem(problem, values, analytes=['U'])
+    assert runner.metrics.started == runner.metrics.finished == 6
+    assert runner.metrics.max_in_flight == 2
+    assert runner.metrics.max_queued == 5 and runner.metrics.queued == 0
+
+    with runner:
+        for future in runner.submit(problem, values, analytes=['U']):
+            future.result()
+    assert runner.metrics.finished == 12 and runner.metrics.in_flight == 0
+    assert runner.metrics.queued == 0
+
+    # rows waiting for one of the 3 slots are queued
+    class Queue(RunObserver):
+        def __init__(self):
+            self.depths = []
+
+        def on_start(self, event):
+            self.depths.append(event.queued)
+    queue = Queue()
+    runner.observers.append(queue)
+    asyncio.run(runner.run_problem_async(problem, values, analytes=['U'], max_concurrency=3))
+    metrics = runner.metrics.as_dict()
+    assert metrics['finished'] == metrics['started'] == 18 and metrics['in_flight'] == 0
+    assert metrics['max_in_flight'] <= 3
+    assert metrics['queued'] == 0 and max(queue.depths) >= 1 and queue.depths[-1] == 0
+    assert set(metrics['timings']) == {'render', 'run', 'parse'}
+
+    def broken(**kwargs):
+        raise RuntimeError('phreeqc failed')
+    monkeypatch.setattr(runner.phreeqc, 'run', broken)
+    with runner:
+        with pytest.raises(RuntimeError):
+            runner.submit(problem, values[:1], analytes=['U'])[0].result()
+    assert runner.metrics.failed == 1 and runner.metrics.in_flight == 0 and runner.metrics.queued == 0
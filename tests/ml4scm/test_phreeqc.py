@@ -1,11 +1,61 @@
 import pytest
-import re
 from ml4scm.phreeqc import PHREEQC
 
-def test_filter_react_states():
-    input_obs	= '           1	       react	        3.56	  9.6316e-08	  2.9772e-09	  6.1726e-10	  1.7752e-17	  7.4692e-26	  4.4651e-08	  1.9047e-13	  2.3979e-04	  1.1088e-09	  4.7299e-15	  5.9546e-06 '
-    assert PHREEQC._filter_react_states([input_obs,input_obs], 2) == [re.split(r"\s+", input_obs), re.split(r"\s+", input_obs)]
 
+def test_database_template_matches_write_db_from_template(sim_files, tmp_path):
+    from ml4scm.phreeqc import DatabaseTemplate
+    db = sim_files['db_template_filename']
+    template = DatabaseTemplate.from_file(db, ['PAR_A', 'PAR_B'])
+    PHREEQC.write_db_from_template(db, ['PAR_A', 'PAR_B'], [1.5, 2.5], outfile=str(tmp_path / 'expected'))
+    template.write([1.5, 2.5], outfile=str(tmp_path / 'rendered'))
+    assert (tmp_path / 'rendered.txt').read_text() == (tmp_path / 'expected.txt').read_text()
 
 
+def test_database_template_validates_and_prefers_longest_name():
+    from ml4scm.phreeqc import DatabaseTemplate
+    with pytest.raises(ValueError):
+        DatabaseTemplate('log_k K1', ['K1', 'K2'])
+    template = DatabaseTemplate('K10 K1 K10', ['K1', 'K10'])
+    assert template.render([1, 2]) == '2 1 2'
 
+
+def test_parse_output_filters_react_rows_across_chunks():
+    import io
+    import numpy as np
+    sel = io.StringIO(
+        '         sim\t     state\t        pH\t         U\t\n'
+        '           1\t    i_soln\t      7.0000\t  0.0000e+00\t\n'
+        '           1\t     react\t      8.0000\t  1.0000e-06\t\n'
+        '           1\t     react\t      9.0000\t  2.0000e-06\t\n'
+        '\n'
+        '           2\t     react\t     10.0000\t  3.0000e-06\t\n'
+    )
+    opt = PHREEQC.parse_output(sel, ['U', 'pH'], chunk_rows=2)
+    assert np.allclose(opt, [[1, 1, 2], [1e-6, 2e-6, 3e-6], [8, 9, 10]])
+
+
+def test_parse_output_rejects_ragged_rows():
+    import io
+    # the short and the long row hold as many fields as two good rows
+    sel = io.StringIO(
+        '         sim\t     state\t        pH\t         U\t\n'
+        '           1\t     react\t      8.0000\t\n'
+        '           1\t     react\t      9.0000\t  2.0000e-06\t 5\t\n'
+    )
+    with pytest.raises(ValueError, match='has 3 fields, expected 4'):
+        PHREEQC.parse_output(sel, ['U'])
+    with pytest.raises(ValueError, match='has 4 fields, expected 3'):
+        PHREEQC.parse_output(io.StringIO('sim state U\n1 react 1e-6 7\n'), ['U'])
+
+
+def test_engine_requires_run_and_identity():
+    from ml4scm.phreeqc import Engine
+
+    class RunOnly(Engine):
+        def run(self, db_filename, in_filename, analytes=None, cwd=None):
+            raise AssertionError
+
+    with pytest.raises(TypeError):
+        Engine()
+    with pytest.raises(TypeError):
+        RunOnly()
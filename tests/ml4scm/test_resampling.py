@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from ml4scm import resampling
+from ml4scm.grid_search import gs_resample
+
+
+@pytest.mark.parametrize('scheme', ['systematic', 'stratified'])
+def test_low_variance_schemes_hit_expected_counts(scheme):
+    idx = resampling.resample(np.array([0.5, 0.25, 0.25, 0.0]), 8, scheme=scheme, rng=3)
+    assert np.array_equal(np.bincount(idx, minlength=4), [4, 2, 2, 0])
+
+
+def test_multinomial_is_reproducible_and_skips_zero_weights():
+    w = np.array([0.2, 0.0, 0.8])
+    a = resampling.resample(w, 1000, rng=np.random.default_rng(5))
+    assert np.array_equal(a, resampling.resample(w, 1000, rng=5))
+    assert not np.any(a == 1)
+    assert abs(np.mean(a == 2) - 0.8) < 0.05
+
+
+def test_gs_resample_preallocates_history():
+    gsll = np.array([[0.0], [1.0], [3.0], [0.0]])
+    pp = gs_resample(5, gsll, rng=0)
+    assert pp.shape == (5, 4)
+    assert np.array_equal(pp[0], np.arange(4))
+    assert set(np.unique(pp[1])) <= {1, 2}
+
+    # log weights far below exp's range, e.g. from estimators.ll_func
+    pp = gs_resample(3, np.array([[-5000.0], [-1e9], [-4000.0], [np.nan]]), rng=0, log=True)
+    assert np.all(pp[1:] == 2)
+
+
+def test_resample_history_draws_independent_generations():
+    w = np.array([0.2, 0.0, 0.8])
+    history = resampling.resample_history(w, 3, 'systematic', rng=1)
+    rng = np.random.default_rng(1)
+    assert np.array_equal(history[0], np.arange(3))
+    for row in history[1:]:
+        assert np.array_equal(row, resampling.resample(w, 3, 'systematic', rng))
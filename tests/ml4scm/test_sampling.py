@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from ml4scm import sampling
+from ml4scm.simulation import Bound
+
+BOUNDS = [Bound(1, 2), Bound(-5, 5), Bound(0, 1e-3)]
+
+
+@pytest.mark.parametrize('method', ['uniform', 'lhs', 'sobol', 'grid'])
+def test_sample_within_bounds_and_reproducible(method):
+    a = sampling.sample(BOUNDS, 64, method=method, rng=42)
+    b = sampling.sample(BOUNDS, 64, method=method, rng=np.random.default_rng(42))
+    assert a.shape == (64, 3)
+    assert np.array_equal(a, b)
+    assert np.all(a >= [1, -5, 0]) and np.all(a <= [2, 5, 1e-3])
+
+
+def test_latin_hypercube_fills_every_stratum():
+    x = sampling.latin_hypercube(BOUNDS, 50, rng=0)
+    unit = (x - [1, -5, 0]) / [1, 10, 1e-3]
+    for col in unit.T:
+        assert sorted(np.floor(col * 50).astype(int)) == list(range(50))
+
+
+def test_iter_design_chunks_match_single_draw():
+    chunks = list(sampling.iter_design(BOUNDS, 10, chunk_size=4, rng=7))
+    assert [len(c) for c in chunks] == [4, 4, 2]
+    assert np.array_equal(np.vstack(chunks), sampling.uniform(BOUNDS, 10, rng=7))
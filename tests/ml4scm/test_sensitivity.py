@@ -0,0 +1,117 @@
+import warnings
+
+import numpy as np
+from SALib.analyze import sobol as sas
+from SALib.sample import morris as morris_sample
+from SALib.sample import saltelli
+
+from ml4scm.sensitivity import morris_analysis, morris_matrices, morris_summary, sobol_matrices
+from ml4scm.simulation import Bound, Problem
+
+
+def _problem():
+    return Problem(names=['a', 'b', 'c'], bounds=[Bound(0, 1), Bound(-1, 2), Bound(0, 3)], num_vars=3,
+                   db_template_filename='db', output_filename='out.sel', input_filename='input.pqi')
+
+
+def test_morris_matrices_match_salib_per_column():
+    problem = _problem()
+    X = morris_sample.sample(problem.to_salib(), 20, num_levels=4, seed=1)
+    Y = np.stack([X[:, 0] + t * X[:, 1] ** 2 + X[:, 0] * X[:, 2] for t in range(1, 6)], axis=1)
+    mu, mu_star, sigma, conf = morris_matrices(problem, X, Y, rng=0)
+    ref = morris_summary(morris_analysis(problem, X, Y))
+    for a, b in zip([mu, mu_star, sigma], ref):
+        assert np.allclose(a, b)
+    # different bootstrap draws, same spread
+    assert conf.shape == ref[3].shape
+    assert np.allclose(conf, ref[3], rtol=0.5)
+    parallel = morris_matrices(problem, X, Y, rng=0, max_workers=2)
+    assert np.allclose(parallel[3], conf)
+
+
+def test_sobol_matrices_match_salib_per_column():
+    problem = _problem()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        X = saltelli.sample(problem.to_salib(), 64)
+    Y = np.stack([np.sin(X[:, 0]) + t * X[:, 1] ** 2 + X[:, 0] * X[:, 2] for t in range(1, 4)], axis=1)
+    S = sobol_matrices(problem, Y, rng=0)
+    ref = [sas.analyze(problem.to_salib(), Y[:, i], seed=0) for i in range(Y.shape[1])]
+    for key in ['S1', 'ST', 'S2']:
+        assert np.allclose(S[key], np.stack([d[key] for d in ref], axis=-1), equal_nan=True)
+    assert S['S1_conf'].shape == (3, 3)
+    assert np.all(np.isnan(S['S2_conf'][np.tril_indices(3)]))
+
+
+def test_matrices_read_memmapped_observations_in_column_blocks(tmp_path, monkeypatch):
+    import ml4scm.sensitivity
+    problem = _problem()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        X = saltelli.sample(problem.to_salib(), 16)
+    Y = np.stack([np.sin(X[:, 0]) + t * X[:, 1] ** 2 for t in range(1, 6)], axis=1)
+    np.save(str(tmp_path / 'Y.npy'), Y)
+    S = sobol_matrices(problem, Y, rng=0)
+    Xm = morris_sample.sample(problem.to_salib(), 10, num_levels=4, seed=1)
+    Ym = np.stack([Xm[:, 0] + t * Xm[:, 1] ** 2 for t in range(1, 6)], axis=1)
+    np.save(str(tmp_path / 'Ym.npy'), Ym)
+    M = morris_matrices(problem, Xm, Ym, rng=0)
+
+    # two columns per block; the bootstrap draws are shared by every block
+    monkeypatch.setattr(ml4scm.sensitivity, '_BLOCK_BYTES', 16 * len(Y))
+    blocked = sobol_matrices(problem, np.load(str(tmp_path / 'Y.npy'), mmap_mode='r'), rng=0)
+    for key in S:
+        assert np.allclose(blocked[key], S[key], equal_nan=True)
+    monkeypatch.setattr(ml4scm.sensitivity, '_BLOCK_BYTES', 16 * len(Ym))
+    for a, b in zip(morris_matrices(problem, Xm, np.load(str(tmp_path / 'Ym.npy'), mmap_mode='r'), rng=0), M):
+        assert np.allclose(a, b)
+
+
+def test_sobol_pipeline_reuses_runs_when_n_grows(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.sensitivity import sobol_pipeline, morris_pipeline
+    from ml4scm.simulation import SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(1, 2), Bound(3, 4)], num_vars=2, **sim_files)
+    runner = SimulationRunner(PHREEQC(fake_phreeqc))
+    ran = []
+    iter_problem = runner.iter_problem
+    monkeypatch.setattr(runner, 'iter_problem', lambda problem, values, analytes: ran.append(len(values)) or
+                        iter_problem(problem, values, analytes))
+    store = str(tmp_path / 'sobol')
+
+    X, Y, S = sobol_pipeline(runner, problem, 4, store=store, seed=0, num_resamples=10)
+    # with two parameters BA_1 and AB_2 hold the same points
+    assert sum(ran) == len(np.unique(X, axis=0)) == 16
+    assert np.allclose(Y, np.sum(X, axis=1)[:, None] * np.arange(1, 4) * 1e-6, rtol=1e-3)
+    assert S['S1'].shape == (2, 3)
+
+    ran.clear()
+    X2, Y2, _ = sobol_pipeline(runner, problem, 8, store=store, seed=0, num_resamples=10)
+    assert sum(ran) == len(np.unique(X2, axis=0)) - 16
+    assert np.allclose(Y2[:len(Y)], Y)
+
+    ran.clear()
+    X, Y, _ = morris_pipeline(runner, problem, 10, seed=1, num_resamples=10, chunk_size=7)
+    assert sum(ran) == len(np.unique(X, axis=0)) < len(X) and max(ran) == 7
+    assert np.allclose(Y, np.sum(X, axis=1)[:, None] * np.arange(1, 4) * 1e-6, rtol=1e-3)
+
+
+def test_failed_runs_drop_their_trajectory_or_block():
+    problem = _problem()
+    X = morris_sample.sample(problem.to_salib(), 10, num_levels=4, seed=1)
+    Y = (X[:, 0] + X[:, 1] ** 2)[:, None]
+    failed = Y.copy()
+    failed[5] = np.nan  # second trajectory
+    keep = np.r_[0:4, 8:len(X)]
+    for a, b in zip(morris_matrices(problem, X, failed, rng=0)[:3], morris_matrices(problem, X[keep], Y[keep])[:3]):
+        assert np.allclose(a, b)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        X = saltelli.sample(problem.to_salib(), 16)
+    Y = (np.sin(X[:, 0]) + X[:, 1] ** 2)[:, None]
+    failed = Y.copy()
+    failed[-1] = np.nan  # last block
+    S = sobol_matrices(problem, failed, rng=0)
+    assert np.allclose(S['S1'], sobol_matrices(problem, Y[:-8], rng=0)['S1'])
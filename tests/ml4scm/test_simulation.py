@@ -1,3 +1,6 @@
+import os
+import sys
+import time
 import pytest
 import ml4scm
 import numpy as np
@@ -40,3 +43,314 @@ def test_get_random_values():
     bounds = [Bound(x, y) for x, y in zip(lower, upper)]
     r = get_random_values(bounds, 2)
     assert np.allclose(expected, r)
+
+def test_run_sims_parallel_matches_serial(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [0.5, 0.25], [10.0, 20.0]])
+    kwargs = dict(values_mtrx=values, pars=['PAR_A', 'PAR_B'], analytes=['U'], **sim_files)
+    serial = SimulationRunner(PHREEQC(fake_phreeqc)).run_sims(**kwargs)
+    parallel = SimulationRunner(PHREEQC(fake_phreeqc), max_workers=2).run_sims(**kwargs)
+    assert len(parallel) == len(values)
+    for s, p, row in zip(serial, parallel, values):
+        assert np.allclose(s, p)
+        assert np.allclose(p[1], np.sum(row) * np.arange(1, 4) * 1e-6, rtol=1e-3)
+
+
+def test_run_problem_batches_input_template_rows(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    with open(str(tmp_path / 'input_tpl.tpl'), 'w') as fd:
+        fd.write('# template header, discarded\n')
+        fd.write('SELECTED_OUTPUT\n    -file output.sel\nSOLUTION\n    amount PAR_C\nEND\n')
+    problem = Problem(names=['PAR_A', 'PAR_B', 'PAR_C'],
+                      bounds=[Bound(0, 1)] * 3,
+                      num_vars=3,
+                      input_template_filename=str(tmp_path / 'input_tpl'),
+                      **sim_files)
+    values = np.array([[1.0, 2.0, 0.5], [1.0, 2.0, 4.0], [3.0, 2.0, 0.5], [1.0, 2.0, 8.0]])
+
+    runner = SimulationRunner(PHREEQC(fake_phreeqc))
+    calls = []
+    run = runner.phreeqc.run
+    monkeypatch.setattr(runner.phreeqc, 'run', lambda **kw: calls.append(kw) or run(**kw))
+    results = runner.run_problem(problem, values, analytes=['U'])
+    assert len(calls) == 2
+    for result, row in zip(results, values):
+        assert np.allclose(result[0], [1, 1, 1])
+        assert np.allclose(result[1], np.sum(row) * np.arange(1, 4) * 1e-6, rtol=1e-3)
+
+    parallel = SimulationRunner(PHREEQC(fake_phreeqc), max_workers=2, batch_size=2)
+    for a, b in zip(parallel.run_problem(problem, values, analytes=['U']), results):
+        assert np.allclose(a, b)
+
+
+def test_async_and_submitted_runs_match_run_problem(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    import asyncio
+    from concurrent.futures import as_completed
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+    expected = SimulationRunner(PHREEQC(fake_phreeqc)).run_problem(problem, values, analytes=['U'])
+
+    runner = SimulationRunner(PHREEQC(fake_phreeqc), max_workers=2)
+    results = asyncio.run(runner.run_problem_async(problem, values, analytes=['U']))
+    for a, b in zip(results, expected):
+        assert np.allclose(a, b)
+
+    with runner:
+        futures = runner.submit(problem, values, analytes=['U'])
+        assert len(list(as_completed(futures))) == 3
+        for future, b in zip(futures, expected):
+            assert np.allclose(future.result(), b)
+
+
+
+# records its pid and sleeps before running phreeqc
+SLOW_PHREEQC = '''#!{python}
+import os, sys, time
+open(os.path.join({pids!r}, str(os.getpid())), 'w').close()
+time.sleep({sleep})
+os.execv({phreeqc!r}, [{phreeqc!r}] + sys.argv[1:])
+'''
+
+
+def _slow_phreeqc(tmp_path, fake_phreeqc, sleep):
+    pids = tmp_path / 'pids'
+    pids.mkdir(parents=True)
+    path = str(tmp_path / 'slow')
+    with open(path, 'w') as fd:
+        fd.write(SLOW_PHREEQC.format(python=sys.executable, pids=str(pids), sleep=sleep, phreeqc=fake_phreeqc))
+    os.chmod(path, 0o755)
+    return path, pids
+
+
+def test_cancelled_runs_are_dropped_or_killed(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    import asyncio
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0]])
+    slow, pids = _slow_phreeqc(tmp_path, fake_phreeqc, 60)
+    scratch = tmp_path / 'scratch'
+    scratch.mkdir()
+    runner = SimulationRunner(PHREEQC(slow), scratch_dir=str(scratch))
+
+    async def cancel_running_task():
+        tasks = runner.create_tasks(problem, values[:1], analytes=['U'])
+        while not os.listdir(str(pids)):
+            await asyncio.sleep(0.05)
+        tasks[0].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tasks[0]
+        return int(os.listdir(str(pids))[0])
+
+    start = time.monotonic()
+    pid = asyncio.run(cancel_running_task())
+    assert time.monotonic() - start < 30
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+    assert os.listdir(str(scratch)) == [] and runner._waiting == 0
+
+    # with one worker the second run waits in the queue and can be cancelled
+    runner = SimulationRunner(PHREEQC(_slow_phreeqc(tmp_path / 'quick', fake_phreeqc, 1)[0]), max_workers=1)
+    with runner:
+        running, queued = runner.submit(problem, values, analytes=['U'])
+        assert queued.cancel()
+        assert np.allclose(running.result()[1], 3 * np.arange(1, 4) * 1e-6, rtol=1e-3)
+        assert queued.cancelled()
+    # neither cancelled run is left counted as queued
+    assert runner._waiting == 0
+
+
+def test_iter_sims_streams_rows_into_collected_matrix(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import SimulationRunner, collect_results
+    from ml4scm.grid_search import grid_search, grid_search_rss
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [1.0, 2.0]])
+    expected = np.sum(values, axis=1)[:, None] * np.arange(1, 4) * 1e-6
+
+    for workers in [None, 2]:
+        runner = SimulationRunner(PHREEQC(fake_phreeqc), max_workers=workers)
+        streamed = list(runner.iter_problem(problem, values, analytes=['pH', 'U']))
+        assert sorted(i for i, _ in streamed) == [0, 1, 2]
+        mtrx = collect_results(streamed, len(values))
+        assert mtrx.shape == (3, 3, 2)
+        assert np.allclose(mtrx[:, :, 0], [8, 9, 10])
+        assert np.allclose(mtrx[:, :, 1], expected, rtol=1e-3)
+
+    res = grid_search(runner, problem, values)
+    assert np.allclose(res, expected, rtol=1e-3)
+    rss = grid_search_rss(runner, problem, values, [3.0, 6.0, 9.0])
+    assert rss.shape == (3, 1)
+    assert np.allclose(rss[:, 0], np.sum(np.square([3.0, 6.0, 9.0] - res * 1e6), axis=1))
+
+    with pytest.raises(ValueError):
+        collect_results([(0, np.zeros((2, 3))), (1, np.zeros((2, 4)))], 2)
+
+
+# hangs on databases holding 666 and fails the first run of 777, otherwise phreeqc
+FLAKY_PHREEQC = '''#!{python}
+import os, sys, time
+db = open(sys.argv[3]).read()
+if '666' in db:
+    time.sleep(60)
+if '777' in db and not os.path.exists({marker!r}):
+    open({marker!r}, 'w').close()
+    sys.exit(1)
+os.execv({phreeqc!r}, [{phreeqc!r}] + sys.argv[1:])
+'''
+
+
+def test_timeouts_retries_and_masked_failures(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    import subprocess
+    import sys
+    from ml4scm.bayes import _bayes_eval
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import FAILED, SimulationRunner, failed_runs
+    monkeypatch.chdir(tmp_path)
+    flaky = str(tmp_path / 'flaky')
+    with open(flaky, 'w') as fd:
+        fd.write(FLAKY_PHREEQC.format(python=sys.executable, marker=str(tmp_path / 'failed'),
+                                      phreeqc=fake_phreeqc))
+    os.chmod(flaky, 0o755)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [666.0, 0.0], [777.0, 0.0]])
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        SimulationRunner(PHREEQC(flaky, timeout=0.5)).run_problem_matrix(problem, values[:2])
+
+    for workers in [None, 2]:
+        if os.path.exists(str(tmp_path / 'failed')):
+            os.remove(str(tmp_path / 'failed'))
+        runner = SimulationRunner(PHREEQC(flaky, timeout=0.5), max_workers=workers, retries=1, on_error='mask')
+        assert dict(runner.iter_problem(problem, values, ['U']))[1] is FAILED
+        # the hanging row timed out twice, the flaky one failed once
+        assert runner.metrics.failed == 3 and runner.metrics.finished == 2
+
+    # submit and create_tasks retry and mask the same way
+    import asyncio
+    expected = 777 * np.arange(1, 4) * 1e-6
+    with SimulationRunner(PHREEQC(flaky, timeout=0.5), max_workers=3, retries=1, on_error='mask') as runner:
+        os.remove(str(tmp_path / 'failed'))
+        results = [future.result() for future in runner.submit(problem, values, ['U'])]
+        assert results[1] is FAILED and np.allclose(results[2][1], expected, rtol=1e-3)
+        os.remove(str(tmp_path / 'failed'))
+        results = asyncio.run(runner.run_problem_async(problem, values, ['U']))
+        assert results[1] is FAILED and np.allclose(results[2][1], expected, rtol=1e-3)
+        assert runner.metrics.failed == 6 and runner.metrics.finished == 4
+
+    concs, weights, _ = _bayes_eval(runner, problem, values, [3.0, 6.0, 9.0], sigma=1.0)
+    assert list(failed_runs(concs)) == [False, True, False]
+    assert np.allclose(concs[2], 777 * np.arange(1, 4) * 1e-6, rtol=1e-3)
+    assert weights[1] == 0 and np.isclose(np.sum(weights), 1)
+
+
+def test_every_run_failing_under_mask(sim_files, tmp_path, monkeypatch):
+    from ml4scm.bayes import _bayes_eval
+    from ml4scm.estimators import rss_func
+    from ml4scm.grid_search import grid_search_f, grid_search_rss
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.sensitivity import ensemble_sim, evaluate_design
+    from ml4scm.simulation import SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    failing = str(tmp_path / 'failing')
+    with open(failing, 'w') as fd:
+        fd.write('#!/bin/sh\nexit 1\n')
+    os.chmod(failing, 0o755)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [0.5, 0.25]])
+    runner = SimulationRunner(PHREEQC(failing), on_error='mask')
+
+    # no run to take the number of steps from: 0 steps of every analyte
+    results = runner.run_results(problem, values)
+    assert results.data.shape == (3, 0, 2) and results.failed.all()
+    assert results['U'].shape == (3, 0)
+
+    # every run costs nan, and no run can be weighted
+    assert np.all(np.isnan(grid_search_rss(runner, problem, values, [3.0, 6.0, 9.0])))
+    assert np.all(np.isnan(grid_search_f(runner, problem, values, rss_func([3.0, 6.0, 9.0]))))
+    with pytest.raises(ValueError, match='no run has a finite'):
+        _bayes_eval(runner, problem, values, [3.0, 6.0, 9.0])
+    assert ensemble_sim(PHREEQC(failing), problem, values, on_error='mask').shape == (3, 0)
+    assert evaluate_design(runner, problem, values, chunk_size=2).shape == (3, 0)
+
+
+def test_minimal_io_runs_leave_nothing_on_disk(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    import subprocess
+    import sys
+    from ml4scm.phreeqc import PHREEQC, SubprocessEngine
+    from ml4scm.simulation import SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0]])
+    scratch = tmp_path / 'shm'
+    scratch.mkdir()
+    before = sorted(os.listdir(str(tmp_path)))
+
+    engine = SubprocessEngine(fake_phreeqc, keep_files=False, max_output=4)
+    for workers in [None, 2]:
+        runner = SimulationRunner(PHREEQC(engine=engine), max_workers=workers, scratch_dir=str(scratch))
+        concs = runner.run_problem_matrix(problem, values, ['U'])[:, :, 0]
+        assert np.allclose(concs, np.sum(values, axis=1)[:, None] * np.arange(1, 4) * 1e-6, rtol=1e-3)
+        assert os.listdir(str(scratch)) == []
+    assert sorted(os.listdir(str(tmp_path))) == before
+
+    with open(str(scratch / 'db.txt'), 'w') as fd:
+        fd.write('log_k 1\n')
+    result = engine.run('db', sim_files['input_filename'], cwd=str(scratch))
+    assert result.stdout == 'fake' and result.bytes_read > 0
+    assert os.listdir(str(scratch)) == ['db.txt']
+
+    failing = str(tmp_path / 'failing')
+    with open(failing, 'w') as fd:
+        fd.write('#!{}\nimport sys\nsys.stderr.write("x" * 100000 + "no convergence")\nsys.exit(3)\n'.format(
+            sys.executable))
+    os.chmod(failing, 0o755)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        SubprocessEngine(failing, max_output=0).run('db', sim_files['input_filename'], cwd=str(scratch))
+    assert e.value.stderr.endswith('no convergence') and len(e.value.stderr) == SubprocessEngine.FAILURE_TAIL
+
+
+def test_run_results_labels_and_views_the_ensemble(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    from ml4scm.phreeqc import PHREEQC
+    from ml4scm.simulation import ResultSet, SimulationRunner
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [0.5, 0.25]])
+    runner = SimulationRunner(PHREEQC(fake_phreeqc))
+
+    results = runner.run_results(problem, values)
+    assert results.analytes == ['pH', 'U'] and len(results) == 3 and results.num_steps == 3
+    assert results.data.flags['C_CONTIGUOUS'] and results.params is values
+    assert np.shares_memory(results['U'], results.data)
+    assert np.allclose(results['U'], np.sum(values, axis=1)[:, None] * np.arange(1, 4) * 1e-6, rtol=1e-3)
+    assert np.allclose(results['pH'], [8, 9, 10])
+    assert np.array_equal(results.data, runner.run_problem_matrix(problem, values))
+    assert not np.any(results.failed)
+    with pytest.raises(KeyError):
+        results['Fe']
+
+    single = results.astype(np.float32)
+    assert single.data.dtype == np.float32 and single.astype(np.float32) is single
+    assert np.allclose(single['U'], results['U'])
+    tail = results.runs(slice(1, None))
+    assert np.shares_memory(tail.data, results.data) and np.array_equal(tail.params, values[1:])
+
+    # runs collected straight into a slice of a larger ensemble
+    ensemble = np.full((5, 3, 1), -1.0, dtype=np.float32)
+    part = runner.run_results(problem, values[:2], ['U'], dtype=np.float32, out=ensemble[2:4])
+    assert np.shares_memory(part.data, ensemble) and np.allclose(ensemble[2:4, :, 0], results['U'][:2])
+    assert np.all(ensemble[[0, 1, 4]] == -1)
+
+    with pytest.raises(ValueError):
+        ResultSet(results.data, ['U'])
+    with pytest.raises(ValueError):
+        ResultSet(results.data, ['pH', 'U'], values[:2])
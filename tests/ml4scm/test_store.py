@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import Bound, Problem, SimulationRunner
+from ml4scm.store import EnsembleStore
+
+
+def test_ensemble_store_resumes_missing_rows(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 1)] * 2, num_vars=2, **sim_files)
+    params = np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0], [7.0, 8.0]])
+    directory = str(tmp_path / 'ensemble')
+    runner = SimulationRunner(PHREEQC(fake_phreeqc))
+
+    # simulate a crash after two runs were flushed
+    store = EnsembleStore.open(directory, params)
+    store.write_all(r for r in runner.iter_problem(problem, params[:2], analytes=['U']))
+    del store
+
+    store = EnsembleStore.open(directory, params)
+    assert list(store.missing()) == [2, 3]
+    with pytest.raises(RuntimeError):
+        store.observations()
+    ran = []
+    iter_problem = runner.iter_problem
+    monkeypatch.setattr(runner, 'iter_problem', lambda problem, values, analytes: ran.append(len(values)) or
+                        iter_problem(problem, values, analytes))
+    results = store.run(runner, problem)
+    assert ran == [2]
+    assert isinstance(results, np.memmap)
+    assert store.complete
+    expected = np.sum(params, axis=1)[:, None] * np.arange(1, 4) * 1e-6
+    assert np.allclose(EnsembleStore(directory).observations('U'), expected, rtol=1e-3)
+    result_set = store.result_set()
+    assert isinstance(result_set.data, np.memmap) and np.array_equal(result_set.params, params)
+    assert np.allclose(result_set['U'], expected, rtol=1e-3)
+
+    with pytest.raises(ValueError):
+        EnsembleStore.open(directory, params[::-1])
@@ -0,0 +1,101 @@
+import numpy as np
+
+from ml4scm.estimators import rss_func
+from ml4scm.phreeqc import PHREEQC
+from ml4scm.simulation import Bound, Problem, SimulationRunner
+from ml4scm.surrogate import Emulator, GaussianProcess
+
+
+def test_gaussian_process_incremental_update_matches_refit():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 1, size=(30, 2))
+    Y = np.column_stack([np.sin(3 * X[:, 0]) + X[:, 1], X[:, 0] * X[:, 1]])
+    gp = GaussianProcess([0, 0], [1, 1], refit_every=100).fit(X[:20], Y[:20])
+    gp.add(X[20:], Y[20:])
+    assert len(gp) == 30
+
+    full = GaussianProcess([0, 0], [1, 1])
+    full.X, full.Y, full.theta = X, Y, gp.theta
+    full._y_mean, full._y_std = gp._y_mean, gp._y_std
+    full._factor(full._unit(X), (Y - gp._y_mean) / gp._y_std)
+    test = rng.uniform(0, 1, size=(10, 2))
+    for a, b in zip(gp.predict(test), full.predict(test)):
+        assert np.allclose(a, b)
+
+    mean, std = gp.predict(test)
+    truth = np.column_stack([np.sin(3 * test[:, 0]) + test[:, 1], test[:, 0] * test[:, 1]])
+    assert np.all(np.abs(mean - truth) < 0.05)
+    assert np.all(std < 0.05)
+    assert np.all(gp.loo_error() < 0.05)
+
+
+def test_emulator_simulates_only_uncertain_and_promising_rows(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 2), Bound(0, 4)], num_vars=2, **sim_files)
+    runner = SimulationRunner(PHREEQC(fake_phreeqc))
+    emulator = Emulator(runner, problem)
+    rng = np.random.default_rng(1)
+
+    concs, simulated = emulator.run(rng.uniform([0, 0], [2, 4], size=(15, 2)))
+    assert simulated.all() and emulator.num_runs == 15
+
+    params = rng.uniform([0, 0], [2, 4], size=(40, 2))
+    concs, simulated = emulator.run(params, max_std=0.01)
+    expected = np.sum(params, axis=1)[:, None] * np.arange(1, 4) * 1e-6
+    assert simulated.sum() < len(params)
+    assert emulator.num_runs == 15 + simulated.sum()
+    assert np.allclose(concs, expected, rtol=1e-2, atol=1e-8)
+    assert np.all(emulator.error < 1e-7)
+
+    costs, simulated = emulator.screen(params, rss_func([3.0, 6.0, 9.0]), keep=0.1)
+    assert simulated[np.argsort(costs)[:4]].all()
+    assert abs(np.sum(params[np.argmin(costs)]) - 3) < 0.2
+
+
+# fails every run whose PAR_A (the log_k of the database) is above 1.5
+FAILING_PHREEQC = '''#!{python}
+import os, sys
+for line in open(sys.argv[3]):
+    if line.startswith('log_k') and float(line.split()[1]) > 1.5:
+        sys.exit(1)
+os.execv({phreeqc!r}, [{phreeqc!r}] + sys.argv[1:])
+'''
+
+
+def test_emulator_skips_masked_runs(fake_phreeqc, sim_files, tmp_path, monkeypatch):
+    import os
+    import sys
+    import pytest
+    monkeypatch.chdir(tmp_path)
+    failing = str(tmp_path / 'failing')
+    with open(failing, 'w') as fd:
+        fd.write(FAILING_PHREEQC.format(python=sys.executable, phreeqc=fake_phreeqc))
+    os.chmod(failing, 0o755)
+    problem = Problem(names=['PAR_A', 'PAR_B'], bounds=[Bound(0, 2), Bound(0, 4)], num_vars=2, **sim_files)
+    emulator = Emulator(SimulationRunner(PHREEQC(failing), on_error='mask'), problem)
+    rng = np.random.default_rng(2)
+
+    params = rng.uniform([0, 0], [2, 4], size=(20, 2))
+    concs, simulated = emulator.run(params)
+    failed = params[:, 0] > 1.5
+    assert failed.any() and simulated.all() and emulator.num_runs == 20
+    assert np.all(np.isnan(concs[failed])) and not np.any(np.isnan(concs[~failed]))
+    assert len(emulator.model) == np.sum(~failed)
+
+    costs, simulated = emulator.screen(params, rss_func([3.0, 6.0, 9.0]), keep=1.0)
+    assert simulated.all() and np.all(costs[failed] == np.inf) and np.all(np.isfinite(costs[~failed]))
+    assert len(emulator.model) == 2 * np.sum(~failed)
+
+    # a batch in which every run fails is nan (inf) throughout, trained or not
+    doomed = params[failed][:3]
+    concs = emulator.simulate(doomed)
+    assert concs.shape == (3, 3) and np.all(np.isnan(concs))
+    fresh = Emulator(SimulationRunner(PHREEQC(failing), on_error='mask'), problem)
+    costs, simulated = fresh.screen(doomed, rss_func([3.0, 6.0, 9.0]))
+    assert simulated.all() and np.all(costs == np.inf) and len(fresh.model) == 0
+
+    # a bad batch is refused before the model changes
+    before = len(emulator.model)
+    with pytest.raises(ValueError):
+        emulator.model.add(params[:2], np.full((2, 3), np.nan))
+    assert len(emulator.model) == before and len(emulator.model.Y) == before
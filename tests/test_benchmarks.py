@@ -0,0 +1,28 @@
+import json
+import os
+import sys
+
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+
+
+@pytest.fixture
+def run_benchmarks(monkeypatch):
+    monkeypatch.syspath_prepend(BENCHMARKS)
+    import run_benchmarks
+    yield run_benchmarks
+    sys.modules.pop('run_benchmarks', None)
+
+
+def test_benchmarks_write_every_stage(run_benchmarks, tmp_path):
+    output = str(tmp_path / 'bench.json')
+    environ = dict(os.environ)
+    run_benchmarks.main(['--sizes', '2', '5', '--repeat', '1', '--trials', '2', '--max-spawn', '1', '-o', output])
+    with open(output) as fd:
+        results = json.load(fd)['results']
+    stages = {'render', 'render_template', 'spawn', 'parse', 'grid_search', 'bayes_resample', 'bayes_param_count'}
+    assert {(r['stage'], r['size']) for r in results} == {(s, n) for s in stages for n in [2, 5]}
+    assert all(r['min'] >= 0 for r in results)
+    assert run_benchmarks.compare(results, results)
+    assert dict(os.environ) == environ